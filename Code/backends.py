@@ -0,0 +1,228 @@
+import os
+import re
+from abc import ABC, abstractmethod
+
+from manifest import table_files
+from metrics import add_counts, statement_counts
+from pipeline_sql import copy_sql, put_sql, truncate_sql, with_ledger
+from raw_schema import RAW_SCHEMA
+from staging import LocalStage, SnowflakeStage, StagingCache
+
+# Setup script with the raw/dwh DDL and the initial dimension/fact build
+SNOWFLAKE_SQL = os.path.join(os.path.dirname(os.path.abspath(__file__)), "snowflake.sql")
+
+
+def split_sql(text):
+    """Statements of a SQL script, with -- comments removed."""
+    text = "\n".join(line.split("--", 1)[0] for line in text.splitlines())
+    return [s.strip() for s in text.split(";") if s.strip()]
+
+
+def is_query(statement):
+    return re.match(r"(SELECT|WITH)\b", statement, re.I) is not None
+
+
+class Backend(ABC):
+    """Where the pipeline runs: truncate, load and MERGE, one call per DAG task.
+
+    ``run`` takes one statement or a list of them (like SnowflakeOperator) and
+    returns the row counts they report (metrics.statement_counts), summed.
+    """
+
+    def run(self, sql):
+        return add_counts(*self.run_each(sql))
+
+    @abstractmethod
+    def run_each(self, sql):
+        """Counts of every statement run, in order."""
+
+    @abstractmethod
+    def query(self, sql):
+        """Rows of one query, as a list of tuples."""
+
+    def run_stage(self, sql, batch, stage, data_dir):
+        """``sql`` committed with its ledger row (with_ledger); the counts of ``sql`` alone."""
+        return add_counts(*self.run_each(with_ledger(sql, batch, stage, data_dir))[:-2])
+
+    def truncate(self, table):
+        self.run(truncate_sql(table))
+
+    @abstractmethod
+    def load(self, table, fmt, data_dir, after=(), before=()):
+        """COPY the table's files between ``before`` (change-set deletes) and ``after``
+        (ledger rows), in one transaction.
+
+        Returns the COPY's counts (rows_loaded, and on Snowflake rows_parsed and errors_seen).
+        """
+
+    def init_schema(self, path=SNOWFLAKE_SQL):
+        # The setup script minus its example analytical queries
+        with open(path) as f:
+            self.run([s for s in split_sql(f.read()) if not is_query(s)])
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class SnowflakeBackend(Backend):
+    """The warehouse itself, through the same Airflow connection the DAG uses."""
+
+    def __init__(self, conn_id="snowflake_conn", stage_cache_dir=None):
+        from airflow.providers.snowflake.hooks.snowflake import SnowflakeHook
+        self.hook = SnowflakeHook(snowflake_conn_id=conn_id)
+        # With a cache dir, uploads go through the content-addressed staging cache
+        self.staging = StagingCache(SnowflakeStage(self), stage_cache_dir) if stage_cache_dir else None
+
+    def run_each(self, sql):
+        results = self.hook.run(sql, handler=statement_counts, return_last=False)
+        return [results] if isinstance(results, dict) else list(results or [])
+
+    def query(self, sql):
+        return self.hook.get_records(sql)
+
+    def load(self, table, fmt, data_dir, after=(), before=()):
+        if self.staging is None:
+            self.run(put_sql(table, fmt, data_dir))
+            copy = [copy_sql(table, fmt)]
+        else:
+            names = self.staging.stage_files(table, table_files(data_dir, table, fmt))
+            copy = [copy_sql(table, fmt, names)] if names else []
+        before = list(before)
+        counts = self.run_each(["BEGIN;"] + before + copy + list(after) + ["COMMIT;"])
+        return add_counts(*counts[1 + len(before):1 + len(before) + len(copy)])
+
+
+# Snowflake-only syntax in snowflake.sql / pipeline_sql.py and its DuckDB form
+DUCKDB_MACROS = [
+    """CREATE OR REPLACE MACRO to_char(d, f) AS strftime(d,
+         replace(replace(replace(replace(f, 'YYYY', '%Y'), 'MM', '%m'), 'DD', '%d'), 'DY', '%a'))""",
+    "CREATE OR REPLACE MACRO to_number(s) AS CAST(s AS BIGINT)",
+    "CREATE OR REPLACE MACRO dateadd_day(n, d) AS CAST(CAST(d AS DATE) + CAST(n AS INTEGER) AS DATE)",
+]
+SKIPPED = re.compile(r"(USE|GRANT|CREATE\s+OR\s+REPLACE\s+DATABASE)\b", re.I)
+
+
+def duckdb_type(sql_type):
+    sql_type = re.sub(r"\bNUMBER\s*\(", "DECIMAL(", sql_type, flags=re.I)
+    return re.sub(r"\bINT\b", "BIGINT", sql_type, flags=re.I)
+
+
+def to_duckdb(statement):
+    """Statements (zero or more) that do in DuckDB what ``statement`` does in Snowflake."""
+    if SKIPPED.match(statement):
+        return []
+    statement = re.sub(r"^CREATE\s+OR\s+REPLACE\s+SCHEMA\b", "CREATE SCHEMA IF NOT EXISTS",
+                       statement, flags=re.I)
+    out = []
+    # IDENTITY columns draw from a sequence named after their table
+    table = re.match(r"CREATE\s+OR\s+REPLACE\s+TABLE\s+([\w.]+)", statement, re.I)
+    if table and re.search(r"\bIDENTITY\b", statement, re.I):
+        seq = f"{table.group(1)}_seq"
+        out.append(f"CREATE OR REPLACE SEQUENCE {seq}")
+        statement = re.sub(r"\bIDENTITY\b", f"DEFAULT nextval('{seq}')", statement, flags=re.I)
+    # No clustering keys in DuckDB; its zone maps prune on insertion order
+    statement = re.sub(r"\)\s*CLUSTER\s+BY\s*\([^)]*\)\s*$", ")", statement, flags=re.I)
+    # Foreign keys are informational in Snowflake; DuckDB would enforce them
+    statement = re.sub(r"\bREFERENCES\s+[\w.]+\s*\([^)]*\)", "", statement, flags=re.I)
+    statement = duckdb_type(statement)
+    statement = re.sub(r"TABLE\s*\(\s*GENERATOR\s*\(\s*ROWCOUNT\s*=>\s*(\d+)\s*\)\s*\)",
+                       r"range(\1) AS generator(seq)", statement, flags=re.I)
+    statement = re.sub(r"\bseq[1248]\s*\(\s*\)", "seq", statement, flags=re.I)
+    statement = re.sub(r"\bDATEADD\s*\(\s*'?day'?\s*,", "dateadd_day(", statement, flags=re.I)
+    out.append(statement)
+    return out
+
+
+def csv_column(name, sql_type):
+    # COPY's lenient CSV parsing: trimmed, and a value that does not parse
+    # becomes NULL instead of failing the load
+    value = f"NULLIF(TRIM({name}), '')"
+    sql_type = duckdb_type(sql_type)
+    if sql_type in ("VARCHAR", "TEXT"):
+        return f"{value} AS {name}"
+    if sql_type == "DATE":
+        # Snowflake also accepts timestamps for DATE columns
+        value = f"TRY_CAST({value} AS TIMESTAMP)"
+    return f"TRY_CAST({value} AS {sql_type}) AS {name}"
+
+
+class DuckDBBackend(Backend):
+    """Embedded warehouse for local runs and offline timing.
+
+    Runs the Snowflake SQL after rewriting the few Snowflake-only constructs it
+    uses (see ``to_duckdb``). Loads read the batch files in place: without a
+    stage dir PUT is a no-op, and COPY becomes an INSERT ... SELECT over the files.
+    """
+
+    def __init__(self, path=":memory:", stage_dir=None, stage_cache_dir=None):
+        import duckdb
+        self.path = path
+        # With a stage dir, loads go through the staging cache and read the
+        # staged .gz objects, as COPY would (``stage_cache_dir`` defaults to below it)
+        self.stage = LocalStage(stage_dir) if stage_dir else None
+        self.staging = StagingCache(self.stage, stage_cache_dir or os.path.join(stage_dir, ".cache")) \
+            if stage_dir else None
+        self.conn = duckdb.connect(path)
+        for macro in DUCKDB_MACROS:
+            self.conn.execute(macro)
+
+    def run_each(self, sql):
+        results = []
+        for statement in [sql] if isinstance(sql, str) else sql:
+            results.append(add_counts(*(statement_counts(self.conn.execute(translated))
+                                        for part in split_sql(statement)
+                                        for translated in to_duckdb(part))))
+        return results
+
+    def query(self, sql):
+        return self.conn.execute(sql).fetchall()
+
+    def load(self, table, fmt, data_dir, after=(), before=()):
+        files = table_files(data_dir, table, fmt)
+        if self.staging is not None:
+            files = [self.stage.path(table, name) for name in self.staging.stage_files(table, files)]
+        loaded = 0
+        self.conn.execute("BEGIN")
+        try:
+            self.run(list(before))
+            if files:
+                loaded = self.insert_files(table, fmt, files)
+            self.run(list(after))
+        except Exception:
+            self.conn.execute("ROLLBACK")
+            raise
+        self.conn.execute("COMMIT")
+        return {"rows_loaded": loaded}
+
+    def insert_files(self, table, fmt, files):
+        """Rows inserted into raw.{table} from ``files``."""
+        if fmt == "parquet":
+            return self.conn.execute(f"INSERT INTO raw.{table} BY NAME SELECT * FROM read_parquet(?)",
+                                     [files]).fetchone()[0]
+        # Positional, like COPY: the header is skipped, not matched
+        columns = RAW_SCHEMA[table]
+        select = ", ".join(csv_column(name, sql_type) for name, sql_type in columns)
+        return self.conn.execute(
+            f"""INSERT INTO raw.{table}
+            SELECT {select}
+            FROM read_csv(?, header = true, all_varchar = true, quote = '"',
+                          null_padding = true, names = ?)""",
+            [files, [name for name, _ in columns]]).fetchone()[0]
+
+    def close(self):
+        self.conn.close()
+
+
+BACKENDS = {"duckdb": DuckDBBackend, "snowflake": SnowflakeBackend}
+
+
+def make_backend(name, target=None, **options):
+    """``target`` is the DuckDB database file or the Snowflake connection id."""
+    cls = BACKENDS[name]
+    return cls(target, **options) if target else cls(**options)
@@ -0,0 +1,331 @@
+"""Benchmark generation and the load/MERGE pipeline, stage by stage.
+
+Each stage runs in a fresh process, so its peak memory is its own. Results are
+written as JSON; compare two result files to catch regressions:
+
+    python benchmark.py run --scales 1 10 --product-names product_names.csv --out base.json
+    python benchmark.py compare base.json new.json --threshold 0.1
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import runpy
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+
+from data_unclean_gen import TABLES as UNCLEAN_TABLES
+from manifest import file_rows, table_files
+from pipeline_sql import KEYED_FACT_TABLE, MERGES, RAW_TABLES, load_action, plan_load
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_BATCHES = [os.path.join(HERE, "..", "Data", b) for b in ("Batch1", "Batch2", "Batch3")]
+DELTA_ORDERS = 3500     # new_data.py orders per delta at scale 1
+AS_OF = "2025-06-01"    # fixed, so every run generates the same data
+
+# Metrics compared between result files, and whether higher is better
+METRICS = {"seconds": False, "rows_per_sec": True, "peak_rss_mb": False, "bytes": False,
+           "cleanse_seconds": False}
+
+
+# --- A. STAGES (run in a child process) ---
+
+def run_script(script, argv):
+    """A generator script as if run from the command line."""
+    sys.argv = [script] + list(argv)
+    runpy.run_path(os.path.join(HERE, script), run_name="__main__")
+    return {}
+
+
+WORKER_STAGES = {
+    "merge_dim_date": ["extend_dim_date"],
+    "merge_fact_order_item": ["resolve_fact_keys", f"copy_{KEYED_FACT_TABLE}"],
+}
+
+
+def run_load(db, data_dir, fmt, mode, manifest_path, clean_dir, key_cache_dir, init):
+    """One local pipeline run; per-table rows and seconds."""
+    from backends import DuckDBBackend
+    from local_run import run_pipeline
+
+    with DuckDBBackend(db) as backend:
+        if init:
+            backend.init_schema()
+        targets = {t: f"raw.{t}" for t in RAW_TABLES}
+        targets.update({m[len("merge_"):]: f"dwh.{m[len('merge_'):]}" for m in MERGES})
+        count = {name: f"SELECT COUNT(*) FROM {t}" for name, t in targets.items()}
+        before = {name: backend.query(q)[0][0] for name, q in count.items()}
+        plan = plan_load(mode, data_dir, fmt, manifest_path)
+        timings = run_pipeline(backend, data_dir, fmt, mode, manifest_path, clean_dir,
+                               key_cache_dir)
+        after = {name: backend.query(q)[0][0] for name, q in count.items()}
+
+    tables = {}
+    for table in RAW_TABLES:
+        action = load_action(plan, table)
+        if action is None:
+            continue
+        rows = after[table] - (before[table] if action == "append" else 0)
+        seconds = timings.get(f"truncate_{table}", 0) + timings[f"copy_{table}"]
+        tables[table] = {"rows": rows, "seconds": seconds}
+    for merge in MERGES:
+        if merge in timings:
+            name = merge[len("merge_"):]
+            # Worker stages feeding a MERGE count towards it
+            seconds = timings[merge] + sum(timings.get(s, 0) for s in WORKER_STAGES.get(merge, []))
+            tables[name] = {"rows": after[name] - before[name], "seconds": seconds}
+    return {"tables": tables, "cleanse_seconds": timings.get("cleanse", 0)}
+
+
+def _child(fn, args):
+    with open(os.devnull, "w") as null, redirect_stdout(null):
+        start = time.perf_counter()
+        result = fn(*args)
+        seconds = time.perf_counter() - start
+    # ru_maxrss is in KiB on Linux; children covers generator worker pools
+    peak = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return seconds, peak / 1024, result
+
+
+def measure(fn, *args):
+    ctx = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(1, mp_context=ctx) as pool:
+        return pool.submit(_child, fn, args).result()
+
+
+# --- B. RESULTS ---
+
+def dir_tables(data_dir, fmt, names=RAW_TABLES):
+    """Rows and bytes of every table file (raw tables by default) in a directory."""
+    tables = {}
+    for table in names:
+        files = table_files(data_dir, table, fmt)
+        if files:
+            tables[table] = {"rows": sum(file_rows(p) for p in files),
+                             "bytes": sum(os.path.getsize(p) for p in files)}
+    return tables
+
+
+def rate(rows, seconds):
+    return round(rows / seconds, 1) if seconds > 0 else None
+
+
+def stage_result(stage, seconds, peak_mb, tables, bytes_written):
+    for t in tables.values():
+        if "seconds" in t:
+            t["rows_per_sec"] = rate(t["rows"], t["seconds"])
+            t["seconds"] = round(t["seconds"], 4)
+    rows = sum(t["rows"] for t in tables.values())
+    print(f"  {stage}: {seconds:.2f}s, {rows} rows, peak {peak_mb:.0f} MB")
+    return {"stage": stage, "seconds": round(seconds, 4), "rows": rows,
+            "rows_per_sec": rate(rows, seconds), "peak_rss_mb": round(peak_mb, 1),
+            "bytes": bytes_written, "tables": tables}
+
+
+def size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def bench_load(db, data_dir, fmt, mode, manifest_path, init, stage, preresolve=False):
+    # Validated files and the key cache land next to the database, like local_run.py
+    before = size(db)
+    seconds, peak, result = measure(run_load, db, data_dir, fmt, mode, manifest_path,
+                                    f"{db}.clean", f"{db}.keys" if preresolve else None, init)
+    stage = stage_result(stage, seconds, peak, result["tables"], size(db) - before)
+    stage["cleanse_seconds"] = round(result["cleanse_seconds"], 4)
+    return stage
+
+
+def bench_scale(scale, work, args):
+    print(f"scale {scale}")
+    full = os.path.join(work, "full")
+    delta = os.path.join(work, "delta")
+    db = os.path.join(work, "bench.duckdb")
+    manifest_path = os.path.join(work, "manifest.json")
+    stages = []
+
+    seconds, peak, _ = measure(run_script, "data_gen.py", [
+        "--scale", str(scale), "--out", full, "--format", args.format,
+        "--categories", args.categories, "--product-names", args.product_names,
+        "--workers", str(args.workers), "--seed", "0", "--as-of", AS_OF])
+    tables = dir_tables(full, args.format)
+    stages.append(stage_result("generate_full", seconds, peak, tables,
+                               sum(t["bytes"] for t in tables.values())))
+
+    seconds, peak, _ = measure(run_script, "new_data.py", [
+        "--orders", str(int(DELTA_ORDERS * scale)), "--in", full, "--out", delta,
+        "--format", args.format, "--seed", "0"])
+    tables = dir_tables(delta, args.format)
+    stages.append(stage_result("generate_delta", seconds, peak, tables,
+                               sum(t["bytes"] for t in tables.values())))
+
+    stages.append(bench_load(db, full, args.format, "full", manifest_path, True, "load_full",
+                             args.preresolve))
+    stages.append(bench_load(db, delta, args.format, "incremental", manifest_path, False,
+                             "load_incremental", args.preresolve))
+    return {"scale": scale, "stages": stages}
+
+
+def bench_repo_batches(work, args):
+    # The shipped batches: a full load, then the two drops incrementally
+    print("repo batches")
+    db = os.path.join(work, "batches.duckdb")
+    manifest_path = os.path.join(work, "batches_manifest.json")
+    stages = []
+    for i, data_dir in enumerate(REPO_BATCHES):
+        mode = "full" if i == 0 else "incremental"
+        stage = f"load_{os.path.basename(data_dir).lower()}"
+        stages.append(bench_load(db, data_dir, "csv", mode, manifest_path, i == 0, stage,
+                                 args.preresolve))
+    return {"scale": "batches", "stages": stages}
+
+
+def bench_dirty(rows, work, args):
+    # data_unclean_gen.py output, mapped to raw.* and pushed through cleanse and load
+    print(f"dirty {rows} rows")
+    unclean = os.path.join(work, "unclean")
+    mapped = os.path.join(work, "mapped")
+    stages = []
+
+    seconds, peak, _ = measure(run_script, "data_unclean_gen.py", [
+        "--rows", str(rows), "--out", unclean, "--format", args.format,
+        "--workers", str(args.workers), "--seed", "0", "--as-of", AS_OF])
+    tables = dir_tables(unclean, args.format, UNCLEAN_TABLES + ["order_items"])
+    stages.append(stage_result("generate_dirty", seconds, peak, tables,
+                               sum(t["bytes"] for t in tables.values())))
+
+    seconds, peak, _ = measure(run_script, "unclean_mapping.py", [
+        "--in", unclean, "--out", mapped, "--format", args.format])
+    tables = dir_tables(mapped, args.format)
+    stages.append(stage_result("map_dirty", seconds, peak, tables,
+                               sum(t["bytes"] for t in tables.values())))
+
+    stages.append(bench_load(os.path.join(work, "dirty.duckdb"), mapped, args.format, "full",
+                             os.path.join(work, "manifest.json"), True, "load_dirty",
+                             args.preresolve))
+    return {"scale": "dirty", "stages": stages}
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    runs = []
+    with tempfile.TemporaryDirectory(dir=args.work) as work:
+        if not args.skip_batches:
+            runs.append(bench_repo_batches(work, args))
+        for scale in args.scales:
+            scale_dir = os.path.join(work, f"scale-{scale}")
+            os.makedirs(scale_dir)
+            runs.append(bench_scale(scale, scale_dir, args))
+        if args.dirty_rows:
+            dirty_dir = os.path.join(work, "dirty")
+            os.makedirs(dirty_dir)
+            runs.append(bench_dirty(args.dirty_rows, dirty_dir, args))
+    result = {"revision": git_revision(), "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": platform.python_version(), "cpus": os.cpu_count(),
+              "format": args.format, "workers": args.workers, "preresolve": args.preresolve,
+              "runs": runs}
+    with open(args.out, "w") as f:
+        json.dump(result, f, indent=2)
+    print(f"wrote {args.out}")
+
+
+# --- C. COMPARE ---
+
+def flatten(result):
+    """{(scale, stage, table or None, metric): value} for the compared metrics."""
+    values = {}
+    for r in result["runs"]:
+        for s in r["stages"]:
+            for metric in METRICS:
+                values[(str(r["scale"]), s["stage"], None, metric)] = s.get(metric)
+            for table, t in s["tables"].items():
+                for metric in METRICS:
+                    if metric in t:
+                        values[(str(r["scale"]), s["stage"], table, metric)] = t[metric]
+    return values
+
+
+def compare(args):
+    with open(args.base) as f:
+        base = flatten(json.load(f))
+    with open(args.new) as f:
+        new = flatten(json.load(f))
+
+    regressions = 0
+    print(f"{'scale':>8} {'stage':<18} {'table':<20} {'metric':<12} {'base':>12} {'new':>12} {'change':>8}")
+    for key in sorted(base.keys() & new.keys(), key=str):
+        scale, stage, table, metric = key
+        old, cur = base[key], new[key]
+        if not old or cur is None:
+            continue
+        # Per-table timings of a few milliseconds are mostly noise
+        if table is not None and metric in ("seconds", "rows_per_sec"):
+            timing = (scale, stage, table, "seconds")
+            if max(base[timing], new.get(timing) or 0) < args.min_seconds:
+                continue
+        change = (cur - old) / old
+        worse = -change if METRICS[metric] else change
+        flag = ""
+        if worse > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        if flag or (not args.regressions_only and abs(change) > args.threshold):
+            print(f"{scale:>8} {stage:<18} {table or '-':<20} {metric:<12} "
+                  f"{old:>12.4g} {cur:>12.4g} {change:>+8.1%}{flag}")
+    for scale, stage in sorted({k[:2] for k in base.keys() ^ new.keys()}):
+        print(f"only in one file: scale {scale} {stage}")
+    print(f"{regressions} regression(s) above {args.threshold:.0%}")
+    return 1 if regressions else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data pipeline locally.")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p = sub.add_parser("run", help="run the benchmark and write a JSON result")
+    p.add_argument("--scales", type=float, nargs="+", default=[1.0])
+    p.add_argument("--out", default="benchmark.json")
+    p.add_argument("--work", default=None, help="scratch directory (default: system temp)")
+    p.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    p.add_argument("--workers", type=int, default=1, help="data_gen.py processes")
+    p.add_argument("--categories", default=os.path.join(REPO_BATCHES[0], "categories.csv"))
+    p.add_argument("--product-names", default="product_names.csv")
+    p.add_argument("--skip-batches", action="store_true",
+                   help="do not benchmark loading Data/Batch1..3")
+    p.add_argument("--preresolve", action="store_true",
+                   help="resolve fact keys with key_cache.py and append the fact")
+    p.add_argument("--dirty-rows", type=int, default=0,
+                   help="also benchmark data_unclean_gen.py output with this many rows per table")
+
+    p = sub.add_parser("compare", help="compare two result files")
+    p.add_argument("base")
+    p.add_argument("new")
+    p.add_argument("--threshold", type=float, default=0.10,
+                   help="relative change that counts as a regression")
+    p.add_argument("--min-seconds", type=float, default=0.05,
+                   help="ignore per-table timings below this")
+    p.add_argument("--regressions-only", action="store_true")
+
+    args = parser.parse_args()
+    if args.command == "run":
+        run(args)
+    else:
+        sys.exit(compare(args))
+
+
+if __name__ == "__main__":
+    main()
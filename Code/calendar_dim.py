@@ -0,0 +1,131 @@
+"""dim_date rows for any set of dates, fiscal and holiday attributes included.
+
+dim_date is not prefilled. Before each fact build, extend_dim_date adds the
+calendar rows between the first and last order, review or inventory snapshot
+date of the batch that the dimension does not have yet. To load a range up front instead:
+
+    python calendar_dim.py --start 2020-01-01 --end 2030-12-31 --out calendar
+
+and load calendar/dim_date_extension.csv with the pipeline's EXTEND_DIM_DATE.
+"""
+import argparse
+import calendar
+import os
+from datetime import date
+
+import numpy as np
+import pandas as pd
+
+from pipeline_sql import DATE_EXTENSION_TABLE
+from raw_schema import columns
+from writers import WRITERS, make_writer
+
+# First month of the fiscal year; a fiscal year is named after the calendar
+# year it ends in (February start: FY2026 = Feb 2025 .. Jan 2026)
+FISCAL_START_MONTH = int(os.environ.get("ECOM_FISCAL_START_MONTH", "2"))
+
+# US federal holidays: (name, month, day) on a fixed date, or
+# (name, month, weekday, n) on the n-th weekday of the month (-1: the last)
+HOLIDAYS = [
+    ("New Year's Day", 1, 1),
+    ("Martin Luther King Jr. Day", 1, calendar.MONDAY, 3),
+    ("Presidents' Day", 2, calendar.MONDAY, 3),
+    ("Memorial Day", 5, calendar.MONDAY, -1),
+    ("Juneteenth", 6, 19),
+    ("Independence Day", 7, 4),
+    ("Labor Day", 9, calendar.MONDAY, 1),
+    ("Columbus Day", 10, calendar.MONDAY, 2),
+    ("Veterans Day", 11, 11),
+    ("Thanksgiving Day", 11, calendar.THURSDAY, 4),
+    ("Christmas Day", 12, 25),
+]
+
+
+def holidays(years):
+    """{date: holiday name} for the given years."""
+    found = {}
+    for year in years:
+        for rule in HOLIDAYS:
+            if len(rule) == 3:
+                name, month, day = rule
+            else:
+                name, month, weekday, n = rule
+                days = [week[weekday] for week in calendar.monthcalendar(year, month) if week[weekday]]
+                day = days[n if n < 0 else n - 1]
+            found[date(year, month, day)] = name
+    return found
+
+
+def date_rows(dates, fiscal_start_month=FISCAL_START_MONTH):
+    """raw.dim_date_extension rows for ``dates`` (anything pd.to_datetime takes)."""
+    d = pd.Series(pd.to_datetime(dates)).dt.normalize()
+    iso = d.dt.isocalendar()
+    # Months since the fiscal year started, 0..11
+    shifted = (d.dt.month - fiscal_start_month) % 12
+    names = pd.Series(holidays(range(d.dt.year.min(), d.dt.year.max() + 1)) if len(d) else {},
+                      dtype=object)
+    names.index = pd.to_datetime(names.index)
+    holiday = d.map(names)
+    rows = pd.DataFrame({
+        "date_key": d.dt.year * 10000 + d.dt.month * 100 + d.dt.day,
+        "actual_date": d,
+        "day_name": d.dt.strftime("%a"),
+        "day_of_month": d.dt.day,
+        "week": iso["week"].astype(np.int64),
+        "month": d.dt.month,
+        "quarter": d.dt.quarter,
+        "year": d.dt.year,
+        "is_weekend": d.dt.dayofweek >= 5,
+        "fiscal_year": d.dt.year + (fiscal_start_month > 1) * (d.dt.month >= fiscal_start_month),
+        "fiscal_quarter": shifted // 3 + 1,
+        "is_holiday": holiday.notna(),
+        "holiday_name": holiday,
+    })
+    return rows[columns(DATE_EXTENSION_TABLE)]
+
+
+# Dates the facts key on: order dates, review dates, and the inventory snapshot's
+FACT_DATES = """
+SELECT MIN(d), MAX(d) FROM (
+  SELECT order_date AS d FROM raw.orders
+  UNION ALL SELECT review_date FROM raw.reviews
+  UNION ALL SELECT CAST(MAX(last_updated) AS DATE) FROM raw.inventory
+) dates
+"""
+
+
+def missing_dates(backend):
+    """Dates from the first to the last fact date (FACT_DATES) that dwh.dim_date lacks."""
+    low, high = backend.query(FACT_DATES)[0]
+    if low is None:
+        return pd.DatetimeIndex([])
+    span = pd.date_range(low, high, freq="D")
+    have = backend.query(f"SELECT date_key FROM dwh.dim_date WHERE date_key BETWEEN "
+                         f"{span[0]:%Y%m%d} AND {span[-1]:%Y%m%d}")
+    keys = span.year * 10000 + span.month * 100 + span.day
+    return span[~np.isin(keys, [k for (k,) in have])]
+
+
+def extend_dim_date(backend, out_dir, fmt="csv", fiscal_start_month=FISCAL_START_MONTH):
+    """Writes {out_dir}/dim_date_extension.<fmt> with the dates the loaded facts need.
+
+    Returns the number of dates written; the file is written (header only)
+    even when none are missing, so loading it is always safe.
+    """
+    rows = date_rows(missing_dates(backend), fiscal_start_month)
+    with make_writer(fmt, out_dir) as out:
+        out.write(DATE_EXTENSION_TABLE, rows)
+    return len(rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write dim_date rows for a range of dates.")
+    parser.add_argument("--start", required=True, help="first date, YYYY-MM-DD")
+    parser.add_argument("--end", required=True, help="last date, YYYY-MM-DD")
+    parser.add_argument("--out", default=".")
+    parser.add_argument("--fiscal-start-month", type=int, default=FISCAL_START_MONTH)
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    args = parser.parse_args()
+    with make_writer(args.format, args.out) as out:
+        out.write(DATE_EXTENSION_TABLE, date_rows(pd.date_range(args.start, args.end, freq="D"),
+                                                  args.fiscal_start_month))
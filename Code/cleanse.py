@@ -0,0 +1,296 @@
+"""Validate a batch against raw.* before it is loaded.
+
+Each table is streamed once, in chunks. Values are coerced to their raw.*
+type, checked against the rules below, and foreign keys are checked against
+the keys of the parent tables. Good rows go to ``{out}/{table}.<fmt>``. Rejected
+rows go to ``{out}/quarantine/{table}.csv`` as they were read, with a reason code
+per failed check:
+
+    missing:<col>   NULL or placeholder ('N/A', '###', ...) in a required column
+    type:<col>      value does not parse as the column type
+    enum:<col>      value outside the allowed set
+    range:<col>     value outside the allowed range
+    fk:<col>        no such key in the parent table
+    duplicate_key   key already seen in this table, or, for an appended table,
+                    in the clean files of the batch cleaned before
+    columns         more fields than the table has columns
+
+    python cleanse.py --in Data/Batch1 --out Data/Batch1/clean
+"""
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from manifest import read_manifest, table_files, write_manifest
+from raw_schema import RAW_SCHEMA, columns
+from writers import WRITERS, CsvWriter, make_writer
+
+CHUNK_ROWS = 200_000
+QUARANTINE_DIR = "quarantine"
+# Batch each table's clean files in the out directory were cleaned from
+CLEANSED_MANIFEST = ".cleansed.json"
+# Values that mean "no value", whatever the column type
+NULL_TOKENS = {"", "n/a", "na", "null", "none", "nan", "unknown", "###"}
+BOOLEANS = {"true": True, "t": True, "1": True, "yes": True, "y": True,
+            "false": False, "f": False, "0": False, "no": False, "n": False}
+# Extra fields read past the schema, to tell over-long rows apart
+SPARE_COLUMNS = 4
+
+# Keys, required columns, foreign keys and value rules per raw table.
+# Key and foreign key columns are always required.
+RULES = {
+    "categories": {"key": ["category_id"]},
+    "order_statuses": {"key": ["order_status_id"], "required": ["status_name"]},
+    "shippers": {"key": ["shipper_id"]},
+    "customers": {"key": ["customer_id"]},
+    "products": {"key": ["product_id"], "min": {"base_price": 0}},
+    "addresses": {"key": ["address_id"], "fk": {"customer_id": "customers"}},
+    "product_categories": {"key": ["product_id", "category_id"],
+                           "fk": {"product_id": "products", "category_id": "categories"}},
+    "inventory": {"key": ["inventory_id"], "fk": {"product_id": "products"},
+                  "min": {"quantity_available": 0, "reorder_level": 0}},
+    "customer_wishlist": {"key": ["customer_id", "product_id"],
+                          "fk": {"customer_id": "customers", "product_id": "products"}},
+    "reviews": {"key": ["review_id"], "fk": {"product_id": "products", "customer_id": "customers"},
+                "min": {"rating": 1}, "max": {"rating": 5}},
+    "orders": {"key": ["order_id"], "required": ["order_date"],
+               "fk": {"customer_id": "customers", "order_status_id": "order_statuses",
+                      "ship_address_id": "addresses", "shipper_id": "shippers"},
+               "min": {"total_amount": 0}},
+    "order_items": {"key": ["order_id", "product_id"],
+                    "fk": {"order_id": "orders", "product_id": "products"},
+                    "required": ["quantity", "unit_price"],
+                    "min": {"quantity": 1, "unit_price": 0}},
+    "payments": {"key": ["payment_id"], "fk": {"order_id": "orders"},
+                 "required": ["amount"],
+                 "enum": {"payment_method": {"Visa", "Mastercard", "Stripe", "PayPal",
+                                             "Card", "Cash", "UPI", "Wallet"},
+                          "status": {"Captured", "Pending", "Failed", "Refunded"}}},
+}
+
+
+def clean_order(tables):
+    """``tables`` with every table after the parents its foreign keys point to."""
+    ordered = []
+
+    def visit(table):
+        if table not in ordered:
+            for parent in RULES[table].get("fk", {}).values():
+                if parent in tables:
+                    visit(parent)
+            ordered.append(table)
+    for table in tables:
+        visit(table)
+    return ordered
+
+
+# --- A. COERCION ---
+
+def coerce(s, sql_type):
+    """(typed values, mask of values that did not parse) for a stripped string column."""
+    if sql_type == "INT" or sql_type.startswith("NUMBER"):
+        num = pd.to_numeric(s, errors="coerce")
+        bad = s.notna() & num.isna()
+        if sql_type == "INT":
+            bad |= num.notna() & (num % 1 != 0)
+            return num.where(~bad).astype("Int64"), bad
+        precision, scale = (int(x) for x in sql_type[sql_type.index("(") + 1:-1].split(","))
+        bad |= num.abs() >= 10 ** (precision - scale)
+        return num.where(~bad).round(scale), bad
+    if sql_type in ("DATE", "TIMESTAMP"):
+        ts = pd.to_datetime(s, errors="coerce", format="ISO8601")
+        bad = s.notna() & ts.isna()
+        return (ts.dt.normalize() if sql_type == "DATE" else ts), bad
+    if sql_type == "BOOLEAN":
+        flag = s.str.lower().map(BOOLEANS)
+        return flag.astype("boolean"), s.notna() & flag.isna()
+    return s, pd.Series(False, index=s.index)
+
+
+def key_codes(df, key):
+    # One int64 per row for single or two-column integer keys
+    codes = df[key[0]].to_numpy("int64", na_value=0)
+    if len(key) == 2:
+        codes = codes * (1 << 32) + df[key[1]].to_numpy("int64", na_value=0)
+    return codes
+
+
+def contains(seen, codes):
+    return np.fromiter(map(seen.__contains__, codes.tolist()), bool, len(codes))
+
+
+# --- B. CLEANSING ---
+
+class TableCleaner:
+    """Checks the chunks of one table; keeps the keys it accepted for its children."""
+
+    def __init__(self, table, parents, loaded=()):
+        """``loaded``: key codes already in the warehouse, rejected as duplicates."""
+        self.table = table
+        self.rules = RULES[table]
+        self.schema = RAW_SCHEMA[table]
+        self.parents = parents
+        self.seen = set()
+        self.loaded = set(loaded)
+        fks = list(self.rules.get("fk", {}))
+        self.required = list(dict.fromkeys(self.rules["key"] + fks + self.rules.get("required", [])))
+
+    def clean(self, raw):
+        """(clean typed rows, rejected raw rows with a reason column) for one chunk."""
+        names = columns(self.table)
+        strings = raw[names].apply(lambda s: s.str.strip())
+        strings = strings.mask(strings.apply(lambda s: s.str.lower().isin(NULL_TOKENS)))
+        checks = []
+        spare = [c for c in raw.columns if c not in names]
+        if spare:
+            checks.append(("columns", (raw[spare].notna() & (raw[spare] != "")).any(axis=1)))
+
+        typed = {}
+        for name, sql_type in self.schema:
+            typed[name], bad = coerce(strings[name], sql_type)
+            checks.append((f"type:{name}", bad))
+        typed = pd.DataFrame(typed)
+
+        for name in self.required:
+            checks.append((f"missing:{name}", strings[name].isna()))
+        for name, allowed in self.rules.get("enum", {}).items():
+            checks.append((f"enum:{name}", typed[name].notna() & ~typed[name].isin(allowed)))
+        for name, low in self.rules.get("min", {}).items():
+            checks.append((f"range:{name}", (typed[name] < low).fillna(False)))
+        for name, high in self.rules.get("max", {}).items():
+            checks.append((f"range:{name}", (typed[name] > high).fillna(False)))
+        for name, parent in self.rules.get("fk", {}).items():
+            keys = self.parents.get(parent)
+            if keys is not None:
+                ids = typed[name].to_numpy("int64", na_value=-1)
+                checks.append((f"fk:{name}", pd.Series(keys.get_indexer(ids) < 0, index=typed.index)
+                               & typed[name].notna()))
+
+        bad = np.zeros(len(typed), bool)
+        for _, mask in checks:
+            bad |= np.asarray(mask, bool)
+
+        # Duplicates last, so a rejected row never claims a key
+        codes = key_codes(typed, self.rules["key"])
+        ok = ~bad
+        dup = np.zeros(len(typed), bool)
+        dup[ok] = (contains(self.seen, codes[ok]) | contains(self.loaded, codes[ok])
+                   | pd.Series(codes[ok]).duplicated().to_numpy())
+        checks.append(("duplicate_key", dup))
+        bad |= dup
+        self.seen.update(codes[~bad].tolist())
+
+        rejected = raw[bad].copy()
+        reason = pd.Series("", index=rejected.index)
+        for code, mask in checks:
+            hit = np.asarray(mask, bool)[bad]
+            reason[hit] = reason[hit] + code + ";"
+        rejected.insert(0, "reason", reason.str.rstrip(";"))
+        return typed[~bad], rejected
+
+    def keys(self):
+        """Accepted keys as a hash index, for checking the foreign keys of child tables."""
+        return pd.Index(np.fromiter(self.seen, "int64", len(self.seen)))
+
+
+def read_chunks(path, table, fmt, chunk_rows):
+    """String chunks of a table file, positional like COPY, plus spare columns for long rows."""
+    names = columns(table)
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows):
+            yield batch.to_pandas().reindex(columns=names).astype("string").fillna("").astype(object)
+        return
+    spare = [f"_extra{i}" for i in range(SPARE_COLUMNS)]
+    yield from pd.read_csv(path, header=None, skiprows=1, names=names + spare, dtype=str,
+                           keep_default_na=False, chunksize=chunk_rows)
+
+
+def parent_keys(table, data_dir, fmt):
+    """Keys of a parent table from already-clean files, or None when there are none."""
+    files = table_files(data_dir, table, fmt)
+    if not files:
+        return None
+    key = RULES[table]["key"][0]
+    if fmt == "parquet":
+        ids = pd.concat(pd.read_parquet(p, columns=[key])[key] for p in files)
+    else:
+        ids = pd.concat(pd.read_csv(p, usecols=[columns(table).index(key)]).iloc[:, 0] for p in files)
+    return pd.Index(ids.dropna().astype("int64").unique())
+
+
+def clean_keys(table, data_dir, fmt):
+    """Key codes (key_codes) of a table's clean files."""
+    key = RULES[table]["key"]
+    codes = set()
+    for path in table_files(data_dir, table, fmt):
+        df = pd.read_parquet(path, columns=key) if fmt == "parquet" else pd.read_csv(path, usecols=key)
+        codes.update(key_codes(df, key).tolist())
+    return codes
+
+
+def cleanse(data_dir, out_dir, tables=None, fmt="csv", chunk_rows=CHUNK_ROWS, ref_dirs=(),
+            append=(), batch=None):
+    """Cleans ``tables`` (default: every raw table with files in ``data_dir``).
+
+    Foreign keys to a table that is not being cleaned are checked against its
+    clean files in ``out_dir`` (from an earlier run) or ``ref_dirs``; with none
+    found, that foreign key is not checked. Tables in ``append`` are appended
+    to raw.*, so their keys must be new: keys in their clean files from the
+    batch cleaned before are rejected too. ``batch`` is this batch's id; a
+    retried batch does not reject its own keys. Returns {table: (clean rows, rejected rows)}.
+    """
+    tables = [t for t in (RULES if tables is None else tables) if table_files(data_dir, t, fmt)]
+    parents = {}
+    for table in clean_order(tables):
+        for parent in RULES[table].get("fk", {}).values():
+            if parent in parents or parent in tables:
+                continue
+            for ref in (out_dir,) + tuple(ref_dirs):
+                parents[parent] = parent_keys(parent, ref, fmt)
+                if parents[parent] is not None:
+                    break
+            if parents[parent] is None:
+                print(f"{table}: no {parent} keys found, foreign key not checked")
+
+    cleansed_path = os.path.join(out_dir, CLEANSED_MANIFEST)
+    cleansed = read_manifest(cleansed_path)
+    quarantine = CsvWriter(os.path.join(out_dir, QUARANTINE_DIR), metric="quarantine")
+    with make_writer(fmt, out_dir) as clean_out:
+        for table in clean_order(tables):
+            # Rejects from an earlier run of this table are superseded
+            if os.path.exists(quarantine.path(table)):
+                os.remove(quarantine.path(table))
+            loaded = ()
+            if table in append and batch and cleansed.get(table) not in (None, batch):
+                loaded = clean_keys(table, out_dir, fmt)
+            cleaner = TableCleaner(table, parents, loaded)
+            for path in table_files(data_dir, table, fmt):
+                for raw in read_chunks(path, table, fmt, chunk_rows):
+                    good, rejected = cleaner.clean(raw)
+                    clean_out.write(table, good)
+                    if len(rejected):
+                        quarantine.write(table, rejected)
+            parents[table] = cleaner.keys()
+            if batch:
+                cleansed[table] = batch
+                write_manifest(cleansed_path, cleansed)
+        print("clean:")
+    print("quarantined:")
+    quarantine.close()
+    return {t: (clean_out.rows.get(t, 0), quarantine.rows.get(t, 0)) for t in tables}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate and clean a batch before loading.")
+    parser.add_argument("--in", dest="in_dir", default=".", help="batch directory")
+    parser.add_argument("--out", default="clean", help="clean files; quarantine/ goes below it")
+    parser.add_argument("--tables", nargs="+", default=None, help="only these tables")
+    parser.add_argument("--ref", nargs="*", default=[],
+                        help="clean batches holding parent keys missing from this one")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    args = parser.parse_args()
+    cleanse(args.in_dir, args.out, args.tables, args.format, args.chunk_rows, args.ref)
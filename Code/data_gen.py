@@ -1,152 +1,367 @@
-import pandas as pd, numpy as np, random
+import argparse
+import pandas as pd, numpy as np
 from faker import Faker
-fake = Faker()
+from manifest import write_batch_manifest
+from metrics import record
+from pipeline_sql import RAW_TABLES
+from sharding import run_shards, shard_seed
+from unique_keys import email_tokens, mix64, sku_codes
+from writers import WRITERS, chunks, make_writer
+
+# Row counts at scale factor 1 (the shape of Data/Batch1). Every other table is
+# either fixed (order_statuses, categories) or derived from these.
+BASE_ROWS = {
+    "customers": 5000,
+    "shippers": 500,
+    "products": 20000,
+    "addresses": 3000,
+    "customer_wishlist": 3000,
+    "orders": 10000,
+    "reviews": 3000,
+}
+CATEGORIES_PER_PRODUCT = 2
+MAX_LINES_PER_ORDER = 4
+POOL_SIZE = 2000            # distinct Faker values drawn per text column
+CHUNK_ROWS = 100_000        # rows per shard; also the unit written at once
+PAYMENT_METHODS = np.array(["Visa", "Mastercard", "Stripe", "PayPal"])
+
+
+def scaled_rows(scale):
+    return {t: max(1, int(round(n * scale))) for t, n in BASE_ROWS.items()}
+
+
+def build_pools(fake, size=POOL_SIZE):
+    # Faker is slow per call, so sample each column once and index into it with NumPy
+    pools = {
+        "first_name": fake.first_name,
+        "last_name": fake.last_name,
+        "user_name": fake.user_name,
+        "email_domain": fake.free_email_domain,
+        "phone": fake.phone_number,
+        "company": fake.company,
+        "description": lambda: fake.text(max_nb_chars=60),
+        "sentence": fake.sentence,
+        "line1": fake.street_address,
+        "line2": fake.secondary_address,
+        "city": fake.city,
+        "state": fake.state_abbr,
+        "postal_code": fake.postcode,
+    }
+    return {name: np.array([fn() for _ in range(size)], dtype=object) for name, fn in pools.items()}
+
+
+class GenContext:
+    """Everything a shard needs, derived only from the run parameters.
+
+    Each worker rebuilds it from the same arguments, so the Faker pools, product
+    names and price key are identical in every process.
+    """
+    def __init__(self, scale, seed, as_of, categories_path, product_names_path):
+        self.rows = scaled_rows(scale)
+        self.seed = seed
+        self.as_of = pd.Timestamp(as_of)
+        self.decade_start = pd.Timestamp(year=self.as_of.year // 10 * 10, month=1, day=1)
+        self.year_start = pd.Timestamp(year=self.as_of.year, month=1, day=1)
+        fake = Faker()
+        fake.seed_instance(seed)
+        self.pools = build_pools(fake)
+        self.categories = pd.read_csv(categories_path)
+        self.category_ids = self.categories["category_id"].values
+        self.names = load_product_names(product_names_path, self.rows["products"], seed)
+        self.price_key = np.random.default_rng([seed]).integers(0, 2**63)
+        # Unique per id by construction (seeded permutations), in any shard
+        self.skus = sku_codes(self.rows["products"], seed)
+        self.email_tokens = email_tokens(self.rows["customers"], seed)
+
+    def rng(self, table, shard):
+        return np.random.default_rng(shard_seed(self.seed, table, shard))
+
+
+def pick(rng, pool, n):
+    return pool[rng.integers(0, len(pool), n)]
+
+
+def random_datetimes(rng, n, start, end):
+    span_us = (end - start) // pd.Timedelta(microseconds=1)
+    offsets = rng.integers(0, span_us, n) * 1000
+    return pd.to_datetime(start.value + offsets)
+
+
+def make_emails(rng, ctx, ids):
+    # The fixed-width token before the @ is unique per id, whatever the user name
+    users = pd.Series(pick(rng, ctx.pools["user_name"], len(ids)))
+    domains = pd.Series(pick(rng, ctx.pools["email_domain"], len(ids)))
+    return (users + "." + ctx.email_tokens(ids) + "@" + domains).values
+
+
+def product_prices(product_ids, price_key):
+    # Prices are a pure function of the product id, so any chunk of order_items
+    # can price its lines without holding a products-sized array in memory.
+    u = mix64(np.asarray(product_ids, dtype=np.uint64) ^ np.uint64(price_key)) >> np.uint64(11)
+    return np.round(5 + u * (495 / 2**53), 2)
+
 
 # --- A. PARENT TABLES --------------------------------------------------------
-customers = pd.DataFrame({
-    "customer_id": range(1, 5001),
-    "first_name":  [fake.first_name() for _ in range(5000)],
-    "last_name":   [fake.last_name()  for _ in range(5000)],
-    "email":       [fake.unique.email() for _ in range(5000)],
-    "phone":       [fake.phone_number() for _ in range(5000)],
-    "date_joined": [fake.date_time_this_decade() for _ in range(5000)]
-})
-print('Customers generated')
-
-shippers = pd.DataFrame({
-    "shipper_id": range(1, 501),
-    "name": [fake.company() for _ in range(500)],
-    "phone": [fake.phone_number() for _ in range(500)],
-    "tracking_url_template": [f"https://track.example/{i}/{{}}" for i in range(500)]
-})
-print('Shippers generated')
-
-order_statuses = pd.DataFrame({
-    "order_status_id": [1,2,3,4],
-    "status_name": ["Pending","Processing","Shipped","Delivered"],
-    "description": ["", "", "", ""]
-})
-print('Order statuses generated')
-
-
-# # save to CSV
-customers.to_csv("customers.csv", index=False)
-shippers.to_csv("shippers.csv", index=False)
-order_statuses.to_csv("order_statuses.csv", index=False)
-
-categories = pd.read_csv("categories.csv")
-print('Categories generated')
-
-product_names = pd.read_csv("product_names.csv")
-
-product_names = product_names.sample(n=20000, random_state=42)
-
-# --- B. PRODUCTS -------------------------------------------------------------
-products = pd.DataFrame({
-    "product_id": range(1, 20001),
-    "name": [product_names["Product Name"].iloc[i] for i in range(20000)],
-    "description": [fake.text(max_nb_chars=60) for _ in range(20000)],
-    "sku": [fake.unique.bothify(text="??#####") for _ in range(20000)],
-    "base_price": [round(random.uniform(5,500),2) for _ in range(20000)],
-    "created_at": [fake.date_time_this_decade() for _ in range(20000)]
-})
-products.to_csv("products.csv", index=False)
-print('Products generated')
+def gen_customers(ctx, shard, start, stop):
+    rng = ctx.rng("customers", shard)
+    ids = np.arange(start, stop)
+    n = len(ids)
+    return {"customers": pd.DataFrame({
+        "customer_id": ids,
+        "first_name":  pick(rng, ctx.pools["first_name"], n),
+        "last_name":   pick(rng, ctx.pools["last_name"], n),
+        "email":       make_emails(rng, ctx, ids),
+        "phone":       pick(rng, ctx.pools["phone"], n),
+        "date_joined": random_datetimes(rng, n, ctx.decade_start, ctx.as_of),
+    })}
+
+
+def gen_shippers(ctx, shard, start, stop):
+    rng = ctx.rng("shippers", shard)
+    ids = np.arange(start, stop)
+    n = len(ids)
+    return {"shippers": pd.DataFrame({
+        "shipper_id": ids,
+        "name": pick(rng, ctx.pools["company"], n),
+        "phone": pick(rng, ctx.pools["phone"], n),
+        "tracking_url_template": "https://track.example/" + pd.Series(ids - 1).astype(str).values + "/{}",
+    })}
+
+
+def gen_order_statuses(ctx, shard, start, stop):
+    return {"order_statuses": pd.DataFrame({
+        "order_status_id": [1,2,3,4],
+        "status_name": ["Pending","Processing","Shipped","Delivered"],
+        "description": ["", "", "", ""]
+    })}
+
+
+def gen_categories(ctx, shard, start, stop):
+    # Copied from the input so the batch directory is complete in any format
+    return {"categories": ctx.categories}
+
+
+# --- B. PRODUCTS & THEIR DEPENDENTS -----------------------------------------
+def gen_products(ctx, shard, start, stop):
+    ids = np.arange(start, stop)
+    n = len(ids)
+    rng = ctx.rng("products", shard)
+    products = pd.DataFrame({
+        "product_id": ids,
+        "name": ctx.names[(ids - 1) % len(ctx.names)],
+        "description": pick(rng, ctx.pools["description"], n),
+        "sku": ctx.skus(ids),
+        "base_price": product_prices(ids, ctx.price_key),
+        "created_at": random_datetimes(rng, n, ctx.decade_start, ctx.as_of),
+    })
+
+    rng = ctx.rng("inventory", shard)
+    inventory = pd.DataFrame({
+        "inventory_id": ids,
+        "product_id": ids,
+        "quantity_available": rng.integers(0, 300, n),
+        "reorder_level": rng.integers(20, 50, n),
+        "last_updated": random_datetimes(rng, n, ctx.year_start, ctx.as_of),
+    })
+
+    # junction: two categories per product
+    rng = ctx.rng("product_categories", shard)
+    product_categories = pd.DataFrame({
+        "product_id": np.repeat(ids, CATEGORIES_PER_PRODUCT),
+        "category_id": rng.choice(ctx.category_ids, n * CATEGORIES_PER_PRODUCT),
+    }).drop_duplicates()
+    return {"products": products, "inventory": inventory,
+            "product_categories": product_categories}
+
 
 # --- C. DEPENDENT TABLES -----------------------------------------------------
-inventory = pd.DataFrame({
-    "inventory_id": range(1,20001),
-    "product_id": products["product_id"],
-    "quantity_available": np.random.randint(0,300,20000),
-    "reorder_level": np.random.randint(20,50,20000),
-    "last_updated": [fake.date_time_this_year() for _ in range(20000)]
-})
-inventory.to_csv("inventory.csv", index=False)
-print('Inventory generated')
-
-addresses = pd.DataFrame({
-    "address_id": range(1,3001),
-    "customer_id": np.random.choice(customers["customer_id"],3000),
-    "line1": [fake.street_address() for _ in range(3000)],
-    "line2": [fake.secondary_address() for _ in range(3000)],
-    "city": [fake.city() for _ in range(3000)],
-    "state": [fake.state_abbr() for _ in range(3000)],
-    "postal_code": [fake.postcode() for _ in range(3000)],
-    "country": ["USA"]*3000,
-    "is_default": np.random.choice([True,False], 3000, p=[0.7,0.3]),
-})
-addresses.to_csv("addresses.csv", index=False)
-print('Addresses generated')
-
-# --- D. JUNCTIONS (ONE PARENT EACH) -----------------------------------------
-product_categories = pd.DataFrame({
-    "product_id": np.repeat(products["product_id"], 2),    # three cats per product
-    "category_id": np.random.choice(categories["category_id"], 40000),
-}).drop_duplicates()
-product_categories.to_csv("product_categories.csv", index=False)
-print('Product categories generated')
-
-customer_wishlist = pd.DataFrame({
-    "customer_id": np.random.choice(customers["customer_id"], 3000),
-    "product_id": np.random.choice(products["product_id"], 3000),
-    "added_at": [fake.date_time_this_year() for _ in range(3000)]
-}).drop_duplicates()
-customer_wishlist.to_csv("customer_wishlist.csv", index=False)
-print('Customer wishlist generated')
-
-# --- E. ORDERS ---------------------------------------------------------------
-orders = pd.DataFrame({
-    "order_id": range(1,10001),
-    "customer_id": np.random.choice(customers["customer_id"], 10000),
-    "order_status_id": np.random.choice(order_statuses["order_status_id"], 10000),
-    "ship_address_id": np.random.choice(addresses["address_id"], 10000),
-    "shipper_id": np.random.choice(shippers["shipper_id"], 10000),
-    "order_date": [fake.date_time_this_decade() for _ in range(10000)],
-    "total_amount": 0.0   # will update later
-})
-orders.to_csv("orders.csv", index=False)
-
-# --- F. PAYMENTS -------------------------------------------------------------
-payments = pd.DataFrame({
-    "payment_id": range(1,10001),
-    "order_id": orders["order_id"],
-    "payment_method": np.random.choice(["Visa","Mastercard","Stripe","PayPal"], 10000),
-    "payment_date": orders["order_date"],
-    "amount": 0.0,   # same as order total later
-    "status": "Captured"
-})
-payments.to_csv("payments.csv", index=False)
-
-# --- G. ORDER_ITEMS & REVIEWS -----------------------------------------------
-order_items = []
-for oid in orders["order_id"]:
-    n_lines = random.randint(1,4)
-    chosen = np.random.choice(products["product_id"], n_lines, replace=False)
-    for pid in chosen:
-        qty  = random.randint(1,10)
-        price = products.loc[products["product_id"]==pid, "base_price"].iloc[0]
-        order_items.append([oid, pid, qty, price])
-
-order_items = pd.DataFrame(order_items, columns=["order_id","product_id","quantity","unit_price"])
-order_items.to_csv("order_items.csv", index=False)
-print('Order items generated')
-
-# backfill totals
-totals = order_items.groupby("order_id").apply(lambda df: (df["quantity"]*df["unit_price"]).sum())
-orders["total_amount"]  = orders["order_id"].map(totals)
-payments["amount"]      = payments["order_id"].map(totals)
-orders.to_csv("orders.csv", index=False)
-payments.to_csv("payments.csv", index=False)
-print('Totals backfilled in orders and payments')
+def gen_addresses(ctx, shard, start, stop):
+    rng = ctx.rng("addresses", shard)
+    ids = np.arange(start, stop)
+    n = len(ids)
+    return {"addresses": pd.DataFrame({
+        "address_id": ids,
+        "customer_id": rng.integers(1, ctx.rows["customers"] + 1, n),
+        "line1": pick(rng, ctx.pools["line1"], n),
+        "line2": pick(rng, ctx.pools["line2"], n),
+        "city": pick(rng, ctx.pools["city"], n),
+        "state": pick(rng, ctx.pools["state"], n),
+        "postal_code": pick(rng, ctx.pools["postal_code"], n),
+        "country": "USA",
+        "is_default": rng.random(n) < 0.7,
+    })}
+
+
+def gen_customer_wishlist(ctx, shard, start, stop):
+    rng = ctx.rng("customer_wishlist", shard)
+    n = stop - start
+    return {"customer_wishlist": pd.DataFrame({
+        "customer_id": rng.integers(1, ctx.rows["customers"] + 1, n),
+        "product_id": rng.integers(1, ctx.rows["products"] + 1, n),
+        "added_at": random_datetimes(rng, n, ctx.year_start, ctx.as_of),
+    }).drop_duplicates()}
+
+
+# --- D. ORDERS, ORDER_ITEMS & PAYMENTS ---------------------------------------
+def gen_orders(ctx, shard, start, stop):
+    """Orders for ids [start, stop) with their line items and payments.
+
+    Line items are drawn and priced in the same pass, so order and payment
+    totals are known before anything is written.
+    """
+    rng = ctx.rng("orders", shard)
+    rows = ctx.rows
+    ids = np.arange(start, stop)
+    n = len(ids)
+    order_dates = random_datetimes(rng, n, ctx.decade_start, ctx.as_of)
+
+    n_lines = rng.integers(1, MAX_LINES_PER_ORDER + 1, n)
+    order_items = pd.DataFrame({
+        "order_id": np.repeat(ids, n_lines),
+        "product_id": rng.integers(1, rows["products"] + 1, n_lines.sum()),
+    }).drop_duplicates()
+    order_items["quantity"] = rng.integers(1, 11, len(order_items))
+    order_items["unit_price"] = product_prices(order_items["product_id"].values, ctx.price_key)
+
+    line_totals = order_items["quantity"].values * order_items["unit_price"].values
+    totals = np.round(np.bincount(order_items["order_id"].values - start,
+                                  weights=line_totals, minlength=n), 2)
+
+    orders = pd.DataFrame({
+        "order_id": ids,
+        "customer_id": rng.integers(1, rows["customers"] + 1, n),
+        "order_status_id": rng.integers(1, 5, n),
+        "ship_address_id": rng.integers(1, rows["addresses"] + 1, n),
+        "shipper_id": rng.integers(1, rows["shippers"] + 1, n),
+        "order_date": order_dates,
+        "total_amount": totals,
+    })
+    payments = pd.DataFrame({
+        "payment_id": ids,
+        "order_id": ids,
+        "payment_method": PAYMENT_METHODS[rng.integers(0, len(PAYMENT_METHODS), n)],
+        "payment_date": order_dates,
+        "amount": totals,
+        "status": "Captured",
+    })
+    return {"orders": orders, "order_items": order_items, "payments": payments}
+
 
 # REVIEWS
-reviews = pd.DataFrame({
-    "review_id": range(1,3001),
-    "product_id": np.random.choice(products["product_id"], 3000),
-    "customer_id": np.random.choice(customers["customer_id"], 3000),
-    "rating": np.random.randint(1,6,3000),
-    "review_text": [fake.sentence() for _ in range(3000)],
-    "review_date": [fake.date_time_this_year() for _ in range(3000)]
-})
-reviews.to_csv("reviews.csv", index=False)
-print('Reviews generated')
\ No newline at end of file
+def gen_reviews(ctx, shard, start, stop):
+    rng = ctx.rng("reviews", shard)
+    ids = np.arange(start, stop)
+    n = len(ids)
+    return {"reviews": pd.DataFrame({
+        "review_id": ids,
+        "product_id": rng.integers(1, ctx.rows["products"] + 1, n),
+        "customer_id": rng.integers(1, ctx.rows["customers"] + 1, n),
+        "rating": rng.integers(1, 6, n),
+        "review_text": pick(rng, ctx.pools["sentence"], n),
+        "review_date": random_datetimes(rng, n, ctx.year_start, ctx.as_of),
+    })}
+
+
+# (shard generator, row-count key) in write order; a None key means one fixed shard
+GENERATORS = [
+    (gen_customers, "customers"),
+    (gen_shippers, "shippers"),
+    (gen_order_statuses, None),
+    (gen_categories, None),
+    (gen_products, "products"),
+    (gen_addresses, "addresses"),
+    (gen_customer_wishlist, "customer_wishlist"),
+    (gen_orders, "orders"),
+    (gen_reviews, "reviews"),
+]
+
+
+def load_product_names(path, n, seed=42):
+    # Names cycle once the (bounded) source file is exhausted
+    product_names = pd.read_csv(path)["Product Name"]
+    return product_names.sample(n=min(n, len(product_names)), random_state=seed).values
+
+
+def shard_tasks(rows, chunk_rows):
+    tasks = []
+    for gen, key in GENERATORS:
+        n = rows[key] if key else 1
+        for shard, (lo, hi) in enumerate(chunks(n, chunk_rows)):
+            tasks.append((gen.__name__, shard, lo, hi))
+    return tasks
+
+
+_ctx = None
+_out_dir = None
+_fmt = "csv"
+
+
+def _init_worker(ctx_args, out_dir, fmt):
+    global _ctx, _out_dir, _fmt
+    _ctx, _out_dir, _fmt = GenContext(*ctx_args), out_dir, fmt
+
+
+def _write_part(task):
+    name, shard, lo, hi = task
+    # Closed here, so Parquet parts get their footer; generate() reports the counts
+    with make_writer(_fmt, _out_dir, part=shard, report=False) as out:
+        for table, df in globals()[name](_ctx, shard, lo, hi).items():
+            out.write(table, df)
+    return out.rows, out.seconds
+
+
+def generate(scale=1.0, out_dir=".", categories_path="categories.csv",
+             product_names_path="product_names.csv", chunk_rows=CHUNK_ROWS,
+             seed=0, as_of=None, workers=1, parts=False, fmt="csv"):
+    """Generates a batch shard by shard.
+
+    Every shard draws from its own seed (seed, table, shard), so the data is
+    identical for any worker count. With ``parts`` (implied by workers > 1)
+    each shard writes ``{table}-{shard:05d}.<fmt>``; otherwise shards are
+    streamed in order into a single ``{table}.<fmt>``.
+    """
+    as_of = pd.Timestamp(as_of) if as_of else pd.Timestamp.now().normalize()
+    ctx_args = (scale, seed, as_of, categories_path, product_names_path)
+    tasks = shard_tasks(scaled_rows(scale), chunk_rows)
+
+    if workers > 1 or parts:
+        counts, seconds = {}, {}
+        for rows, spent in run_shards(_write_part, tasks, workers, _init_worker,
+                                      (ctx_args, out_dir, fmt)):
+            for table, n in rows.items():
+                counts[table] = counts.get(table, 0) + n
+                seconds[table] = seconds.get(table, 0) + spent[table]
+        for table, n in counts.items():
+            print(f"{table}: {n} rows")
+            # Worker seconds, summed over the table's shards
+            record(f"write_{table}", seconds[table], rows=n, workers=workers)
+        return
+
+    ctx = GenContext(*ctx_args)
+    with make_writer(fmt, out_dir) as out:
+        for name, shard, lo, hi in tasks:
+            for table, df in globals()[name](ctx, shard, lo, hi).items():
+                out.write(table, df)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic e-commerce batch.")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="scale factor; 1 reproduces the Batch1 row counts")
+    parser.add_argument("--out", default=".", help="output directory")
+    parser.add_argument("--categories", default="categories.csv")
+    parser.add_argument("--product-names", default="product_names.csv")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS,
+                        help="rows per shard; bounds peak memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--as-of", default=None,
+                        help="upper bound for generated timestamps (default: today 00:00)")
+    parser.add_argument("--workers", type=int, default=1, help="generator processes")
+    parser.add_argument("--parts", action="store_true",
+                        help="write one part file per shard even with a single worker")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv", help="output file format")
+    args = parser.parse_args()
+    generate(args.scale, args.out, args.categories, args.product_names, args.chunk_rows,
+             args.seed, args.as_of, args.workers, args.parts, args.format)
+    write_batch_manifest(args.out, RAW_TABLES, args.format, generator="data_gen.py",
+                         seed=args.seed, scale=args.scale, as_of=args.as_of)
@@ -1,172 +1,250 @@
-import random
-from faker import Faker
-import pandas as pd
-from datetime import datetime, timedelta
-
-fake = Faker()
-Faker.seed(0)
-random.seed(0)
-
-# Utility functions
-def generate_unique_ids(n):
-    ids = list(range(1, n + 1))
-    random.shuffle(ids)
-    return ids
-
-N = 7000
-
-# ID pools
-customer_ids = generate_unique_ids(N)
-seller_ids = generate_unique_ids(N)
-category_ids = generate_unique_ids(N)
-product_ids = generate_unique_ids(N)
-order_ids = generate_unique_ids(N)
-review_ids = generate_unique_ids(N)
-payment_ids = generate_unique_ids(N)
-address_ids = generate_unique_ids(N)
-wishlist_ids = generate_unique_ids(N)
-delivery_ids = generate_unique_ids(N)
-
-# Storage
-dataframes = {
-    "customers": [], "sellers": [], "categories": [], "products": [],
-    "orders": [], "order_items": [], "addresses": [],
-    "reviews": [], "payments": [], "wishlists": [], "deliveries": []
-}
-
-# Helpers to introduce errors
-def maybe_null(val):
-    return val if random.random() > 0.1 else None
-
-def maybe_wrong_type(val):
-    return val if random.random() > 0.1 else random.choice(['N/A', 'unknown', '###'])
-
-def maybe_invalid_enum(enum_list):
-    return random.choice(enum_list + ['INVALID', ''])
-
-def maybe_invalid_fk(fk_list):
-    return random.choice(fk_list + [999999, None])
-
-# Data generators
-def generate_customer(cid):
-    return {
-        'Customer_id': cid,
-        'FirstName': maybe_null(fake.first_name()),
-        'MiddleName': '' if random.random() > 0.9 else fake.first_name(),
-        'LastName': fake.last_name(),
-        'Email': fake.email() if random.random() > 0.05 else 'not-an-email',
-        'DateOfBirth': maybe_wrong_type(fake.date_of_birth(minimum_age=18, maximum_age=80)),
-        'Phone': maybe_wrong_type(fake.random_number(digits=10)),
-        'Age': maybe_null(random.randint(18, 80))
-    }
-
-def generate_seller(sid):
-    return {
-        'Seller_id': sid,
-        'Name': maybe_null(fake.company()),
-        'Phone': maybe_wrong_type(fake.phone_number()),
-        'Total_sales': maybe_wrong_type(round(random.uniform(1000, 100000), 2))
-    }
-
-def generate_category(cid):
-    return {
-        'Category_id': cid,
-        'Category_name': maybe_null(fake.word()),
-        'Description': fake.sentence()
-    }
-
-def generate_product(pid):
-    return {
-        'Product_id': pid,
-        'Product_name': maybe_wrong_type(fake.word()),
-        'MRP': maybe_wrong_type(round(random.uniform(5, 2000), 2)),
-        'Stock': random.choice([True, False, 'yes', 'no']) if random.random() < 0.1 else random.choice([True, False]),
-        'Brand': fake.company(),
-        'Category_CategoryID': maybe_invalid_fk(category_ids),
-        'Seller_Seller_id': maybe_invalid_fk(seller_ids)
-    }
-
-def generate_order(oid):
-    return {
-        'Order_id': oid,
-        'Order_date': maybe_wrong_type(fake.date_time_between(start_date='-1y', end_date='now')),
-        'Order_amount': maybe_wrong_type(round(random.uniform(100, 3000), 2)),
-        'Shipping_Date': maybe_wrong_type(fake.date_time_between(start_date='now', end_date='+10d')),
-        'Order_status': maybe_invalid_enum(['Pending', 'Shipped', 'Delivered', 'Cancelled']),
-        'Customer_customer_id': maybe_invalid_fk(customer_ids)
-    }
-
-def generate_orderitem():
-    return {
-        'Order_Order_id': maybe_invalid_fk(order_ids),
-        'Product_product_id': maybe_invalid_fk(product_ids),
-        'MRP': maybe_wrong_type(round(random.uniform(5, 2000), 2)),
-        'Quantity': maybe_wrong_type(random.randint(1, 5))
-    }
-
-def generate_address(aid):
-    return {
-        'Address_id': aid,
-        'Apart_no': maybe_wrong_type(random.randint(1, 300)),
-        'ApartName': maybe_null(fake.street_name()),
-        'StreetName': maybe_null(fake.street_name()),
-        'State': fake.state(),
-        'City': maybe_null(fake.city()),
-        'Pincode': maybe_wrong_type(fake.random_number(digits=6)),
-        'Customer_Customer_id': maybe_invalid_fk(customer_ids)
-    }
-
-def generate_review(rid):
-    return {
-        'Review_id': rid,
-        'Description': fake.sentence(),
-        'Rating': maybe_wrong_type(random.choice([1, 2, 3, 4, 5])),
-        'Product_Product_id': maybe_invalid_fk(product_ids),
-        'Customer_Customer_id': maybe_invalid_fk(customer_ids)
-    }
-
-def generate_payment(pid):
-    return {
-        'Payment_id': pid,
-        'ORDER_Order_id': maybe_invalid_fk(order_ids),
-        'PaymentMode': maybe_invalid_enum(['Card', 'Cash', 'UPI', 'Wallet']),
-        'Customer_Customer_id': maybe_invalid_fk(customer_ids),
-        'DateOfPayment': maybe_wrong_type(fake.date_time_between(start_date='-1y', end_date='now'))
-    }
-
-def generate_wishlist(wid):
-    return {
-        'Wishlist_id': wid,
-        'Customer_id': maybe_invalid_fk(customer_ids),
-        'Created_at': maybe_wrong_type(fake.date_time_this_year())
-    }
-
-def generate_delivery(did):
-    return {
-        'Delivery_id': did,
-        'Order_id': maybe_invalid_fk(order_ids),
-        'Delivery_status': maybe_invalid_enum(['Pending', 'Shipped', 'Delivered']),
-        'Delivery_date': maybe_wrong_type(fake.date_time_between(start_date='now', end_date='+20d')),
-        'Courier': maybe_null(fake.company())
-    }
-
-# Populate all tables
-for i in range(N):
-    dataframes['customers'].append(generate_customer(customer_ids[i]))
-    dataframes['sellers'].append(generate_seller(seller_ids[i]))
-    dataframes['categories'].append(generate_category(category_ids[i]))
-    dataframes['products'].append(generate_product(product_ids[i]))
-    dataframes['orders'].append(generate_order(order_ids[i]))
-    dataframes['addresses'].append(generate_address(address_ids[i]))
-    dataframes['reviews'].append(generate_review(review_ids[i]))
-    dataframes['payments'].append(generate_payment(payment_ids[i]))
-    dataframes['wishlists'].append(generate_wishlist(wishlist_ids[i]))
-    dataframes['deliveries'].append(generate_delivery(delivery_ids[i]))
-
-for _ in range(N):
-    dataframes['order_items'].append(generate_orderitem())
-
-# Save all to CSV
-for table, data in dataframes.items():
-    df = pd.DataFrame(data)
-    df.to_csv(f"{table}.csv", index=False)
\ No newline at end of file
+import argparse
+import math
+import random
+from faker import Faker
+import pandas as pd
+from datetime import datetime, timedelta
+from metrics import record
+from sharding import int_seed, run_shards
+from writers import WRITERS, chunks, make_writer
+
+fake = Faker()
+
+N = 7000
+CHUNK_ROWS = 50_000
+# Anchor for every relative date, fixed per run so shards agree with each other
+AS_OF = datetime.combine(datetime.now().date(), datetime.min.time())
+
+# Utility functions
+class ShuffledIds:
+    """Random permutation of 1..n without materialising it.
+
+    i -> (a*i + b) mod n is a bijection whenever gcd(a, n) == 1, so ids come out
+    shuffled while memory stays O(1) in n.
+    """
+    def __init__(self, n, rng):
+        self.n = n
+        self.a = rng.randrange(1, max(n, 2))
+        while math.gcd(self.a, n) != 1:
+            self.a = rng.randrange(1, n)
+        self.b = rng.randrange(n)
+
+    def __getitem__(self, i):
+        return (self.a * i + self.b) % self.n + 1
+
+    def __len__(self):
+        return self.n
+
+# ID pools
+TABLES = ["customers", "sellers", "categories", "products", "orders", "addresses",
+          "reviews", "payments", "wishlists", "deliveries"]
+customer_ids = seller_ids = category_ids = product_ids = order_ids = None
+
+# Helpers to introduce errors
+def maybe_null(val):
+    return val if random.random() > 0.1 else None
+
+def maybe_wrong_type(val):
+    return val if random.random() > 0.1 else random.choice(['N/A', 'unknown', '###'])
+
+def maybe_invalid_enum(enum_list):
+    return random.choice(enum_list + ['INVALID', ''])
+
+def maybe_invalid_fk(fk_ids):
+    # Same distribution as random.choice(ids + [999999, None]) without copying the pool
+    r = random.randrange(len(fk_ids) + 2)
+    if r < len(fk_ids):
+        return fk_ids[r]
+    return 999999 if r == len(fk_ids) else None
+
+# Data generators
+def generate_customer(cid):
+    return {
+        'Customer_id': cid,
+        'FirstName': maybe_null(fake.first_name()),
+        'MiddleName': '' if random.random() > 0.9 else fake.first_name(),
+        'LastName': fake.last_name(),
+        'Email': fake.email() if random.random() > 0.05 else 'not-an-email',
+        'DateOfBirth': maybe_wrong_type(fake.date_between(AS_OF - timedelta(days=80 * 365), AS_OF - timedelta(days=18 * 365))),
+        'Phone': maybe_wrong_type(fake.random_number(digits=10)),
+        'Age': maybe_null(random.randint(18, 80))
+    }
+
+def generate_seller(sid):
+    return {
+        'Seller_id': sid,
+        'Name': maybe_null(fake.company()),
+        'Phone': maybe_wrong_type(fake.phone_number()),
+        'Total_sales': maybe_wrong_type(round(random.uniform(1000, 100000), 2))
+    }
+
+def generate_category(cid):
+    return {
+        'Category_id': cid,
+        'Category_name': maybe_null(fake.word()),
+        'Description': fake.sentence()
+    }
+
+def generate_product(pid):
+    return {
+        'Product_id': pid,
+        'Product_name': maybe_wrong_type(fake.word()),
+        'MRP': maybe_wrong_type(round(random.uniform(5, 2000), 2)),
+        'Stock': random.choice([True, False, 'yes', 'no']) if random.random() < 0.1 else random.choice([True, False]),
+        'Brand': fake.company(),
+        'Category_CategoryID': maybe_invalid_fk(category_ids),
+        'Seller_Seller_id': maybe_invalid_fk(seller_ids)
+    }
+
+def generate_order(oid):
+    return {
+        'Order_id': oid,
+        'Order_date': maybe_wrong_type(fake.date_time_between(AS_OF - timedelta(days=365), AS_OF)),
+        'Order_amount': maybe_wrong_type(round(random.uniform(100, 3000), 2)),
+        'Shipping_Date': maybe_wrong_type(fake.date_time_between(AS_OF, AS_OF + timedelta(days=10))),
+        'Order_status': maybe_invalid_enum(['Pending', 'Shipped', 'Delivered', 'Cancelled']),
+        'Customer_customer_id': maybe_invalid_fk(customer_ids)
+    }
+
+def generate_orderitem():
+    return {
+        'Order_Order_id': maybe_invalid_fk(order_ids),
+        'Product_product_id': maybe_invalid_fk(product_ids),
+        'MRP': maybe_wrong_type(round(random.uniform(5, 2000), 2)),
+        'Quantity': maybe_wrong_type(random.randint(1, 5))
+    }
+
+def generate_address(aid):
+    return {
+        'Address_id': aid,
+        'Apart_no': maybe_wrong_type(random.randint(1, 300)),
+        'ApartName': maybe_null(fake.street_name()),
+        'StreetName': maybe_null(fake.street_name()),
+        'State': fake.state(),
+        'City': maybe_null(fake.city()),
+        'Pincode': maybe_wrong_type(fake.random_number(digits=6)),
+        'Customer_Customer_id': maybe_invalid_fk(customer_ids)
+    }
+
+def generate_review(rid):
+    return {
+        'Review_id': rid,
+        'Description': fake.sentence(),
+        'Rating': maybe_wrong_type(random.choice([1, 2, 3, 4, 5])),
+        'Product_Product_id': maybe_invalid_fk(product_ids),
+        'Customer_Customer_id': maybe_invalid_fk(customer_ids)
+    }
+
+def generate_payment(pid):
+    return {
+        'Payment_id': pid,
+        'ORDER_Order_id': maybe_invalid_fk(order_ids),
+        'PaymentMode': maybe_invalid_enum(['Card', 'Cash', 'UPI', 'Wallet']),
+        'Customer_Customer_id': maybe_invalid_fk(customer_ids),
+        'DateOfPayment': maybe_wrong_type(fake.date_time_between(AS_OF - timedelta(days=365), AS_OF))
+    }
+
+def generate_wishlist(wid):
+    return {
+        'Wishlist_id': wid,
+        'Customer_id': maybe_invalid_fk(customer_ids),
+        'Created_at': maybe_wrong_type(fake.date_time_between(AS_OF.replace(month=1, day=1), AS_OF))
+    }
+
+def generate_delivery(did):
+    return {
+        'Delivery_id': did,
+        'Order_id': maybe_invalid_fk(order_ids),
+        'Delivery_status': maybe_invalid_enum(['Pending', 'Shipped', 'Delivered']),
+        'Delivery_date': maybe_wrong_type(fake.date_time_between(AS_OF, AS_OF + timedelta(days=20))),
+        'Courier': maybe_null(fake.company())
+    }
+
+GENERATORS = {
+    "customers": generate_customer, "sellers": generate_seller,
+    "categories": generate_category, "products": generate_product,
+    "orders": generate_order, "addresses": generate_address,
+    "reviews": generate_review, "payments": generate_payment,
+    "wishlists": generate_wishlist, "deliveries": generate_delivery,
+}
+
+
+def make_pools(n, seed):
+    global customer_ids, seller_ids, category_ids, product_ids, order_ids
+    pools = {table: ShuffledIds(n, random.Random(int_seed(seed, table, -1))) for table in TABLES}
+    customer_ids, seller_ids = pools["customers"], pools["sellers"]
+    category_ids, product_ids = pools["categories"], pools["products"]
+    order_ids = pools["orders"]
+    return pools
+
+
+_pools = None
+_out_dir = None
+_fmt = "csv"
+
+
+def _init_worker(n, seed, out_dir, as_of, fmt):
+    global _pools, _out_dir, AS_OF, _fmt
+    _pools, _out_dir, AS_OF, _fmt = make_pools(n, seed), out_dir, as_of, fmt
+
+
+def gen_shard(seed, table, shard, lo, hi):
+    # Reseed the shared random/Faker state per shard so output never depends on scheduling
+    random.seed(int_seed(seed, table, shard))
+    fake.seed_instance(int_seed(seed, table, shard))
+    if table == "order_items":
+        return pd.DataFrame([generate_orderitem() for _ in range(lo, hi)])
+    ids, gen = _pools[table], GENERATORS[table]
+    return pd.DataFrame([gen(ids[i]) for i in range(lo, hi)])
+
+
+def _write_part(task):
+    seed, table, shard, lo, hi = task
+    # Closed here, so Parquet parts get their footer; generate() reports the counts
+    with make_writer(_fmt, _out_dir, part=shard, typed=False, report=False) as out:
+        out.write(table, gen_shard(seed, table, shard, lo, hi))
+    return table, out.rows[table], out.seconds[table]
+
+
+def generate(n=N, out_dir=".", chunk_rows=CHUNK_ROWS, seed=0, workers=1, parts=False, as_of=None,
+             fmt="csv"):
+    as_of = as_of or AS_OF
+    tasks = [(seed, table, shard, lo, hi)
+             for table in TABLES + ["order_items"]
+             for shard, (lo, hi) in enumerate(chunks(n, chunk_rows, start=0))]
+
+    if workers > 1 or parts:
+        counts, seconds = {}, {}
+        for table, rows, spent in run_shards(_write_part, tasks, workers, _init_worker,
+                                             (n, seed, out_dir, as_of, fmt)):
+            counts[table] = counts.get(table, 0) + rows
+            seconds[table] = seconds.get(table, 0) + spent
+        for table, rows in counts.items():
+            print(f"{table}: {rows} rows")
+            # Worker seconds, summed over the table's shards
+            record(f"write_{table}", seconds[table], rows=rows, workers=workers)
+        return
+
+    # Each table is streamed chunk by chunk; nothing is held beyond one chunk.
+    # Values are dirty on purpose, so columns stay untyped.
+    _init_worker(n, seed, out_dir, as_of, fmt)
+    with make_writer(fmt, out_dir, typed=False) as out:
+        for task in tasks:
+            out.write(task[1], gen_shard(*task))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate deliberately messy e-commerce data.")
+    parser.add_argument("--rows", type=int, default=N, help="rows per table")
+    parser.add_argument("--out", default=".", help="output directory")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS, help="rows per shard")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="generator processes")
+    parser.add_argument("--parts", action="store_true",
+                        help="write one part file per shard even with a single worker")
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv", help="output file format")
+    parser.add_argument("--as-of", type=datetime.fromisoformat, default=None,
+                        help="anchor for relative dates (default: today 00:00)")
+    args = parser.parse_args()
+    generate(args.rows, args.out, args.chunk_rows, args.seed, args.workers, args.parts, args.as_of,
+             args.format)
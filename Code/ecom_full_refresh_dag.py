@@ -1,215 +1,357 @@
 # ~/airflow/dags/load_raw_all_sequence.py
 
+import os
+import shutil
+from datetime import datetime, timezone
+
 from airflow import DAG
 from airflow.utils.dates import days_ago
+from airflow.utils.task_group import TaskGroup
+from airflow.operators.python import BranchPythonOperator, PythonOperator, ShortCircuitOperator
 from airflow.providers.snowflake.operators.snowflake import SnowflakeOperator
 
-# List of all 13 raw tables to load
-RAW_TABLES = [
-    "orders",
-    "order_items",
-    "products",
-    "product_categories",
-    "categories",
-    "customers",
-    "addresses",
-    "shippers",
-    "order_statuses",
-    "reviews",
-    "inventory",
-    "customer_wishlist",
-    "payments",
-]
+from backends import SnowflakeBackend
+from calendar_dim import extend_dim_date
+from cleanse import RULES, cleanse
+from key_cache import resolve_fact_keys
+from manifest import record_loaded, table_files
+from metrics import record
+from snapshot_diff import SnapshotBase, diff_batch, link_tables, snapshot_tables
+from splitter import split_table
+from pipeline_sql import (APPEND_FACT_ORDER_ITEM, CDC_TABLE, DATE_EXTENSION_TABLE,
+                          KEYED_FACT_TABLE, MERGE_SOURCES, MERGES, RAW_TABLES, SPLIT_PREFIX,
+                          cdc_delete_sql, copy_sql, is_dimension, ledger_done_sql,
+                          ledger_last_loads_sql, load_action, load_stage, merge_needed,
+                          merge_order, merge_sql, merge_upstream, plan_load, put_sql,
+                          truncate_sql)
+
+# File format written by the generators (--format): "csv" or "parquet"
+LOAD_FORMAT = os.environ.get("ECOM_LOAD_FORMAT", "csv")
+# Directory the batch files are dropped into
+DATA_DIR = os.environ.get("ECOM_DATA_DIR", "/data")
+# Where validated files are written (and staged from); rejects go to quarantine/ below it
+CLEAN_DIR = os.environ.get("ECOM_CLEAN_DIR", os.path.join(DATA_DIR, "clean"))
+# How many warehouse statements may run at once across the table loads
+LOAD_PARALLELISM = int(os.environ.get("ECOM_LOAD_PARALLELISM", "4"))
+# Dimension MERGEs to run in their own group and pool (comma separated task ids),
+# so a slow dimension cannot hold up the slots the light ones need
+HEAVY_MERGES = {m for m in os.environ.get("ECOM_HEAVY_MERGES", "").split(",") if m}
+HEAVY_POOL = os.environ.get("ECOM_HEAVY_POOL", "default_pool")
+# Resolve fact surrogate keys on the worker from a cached key map, then append
+# the keyed rows instead of joining every order line to the dimensions
+PRERESOLVE_FACT = os.environ.get("ECOM_PRERESOLVE_FACT", "0") == "1"
+KEY_CACHE_DIR = os.environ.get("ECOM_KEY_CACHE_DIR", os.path.join(DATA_DIR, ".key_cache"))
+# Upload each distinct file once, gzipped and content-addressed (staging.py);
+# "0" goes back to PUT-ing every file of a table on every load
+STAGE_CACHE = os.environ.get("ECOM_STAGE_CACHE", "1") == "1"
+STAGE_CACHE_DIR = os.environ.get("ECOM_STAGE_CACHE_DIR", os.path.join(DATA_DIR, ".stage_cache"))
+# Load snapshot tables as change sets against the snapshot loaded before
+# (snapshot_diff.py): only changed rows are staged and COPYed, after deleting
+# their keys, and the Type 2 dimensions MERGE only the ids that changed
+CDC = os.environ.get("ECOM_CDC", "0") == "1"
+CDC_DIR = os.environ.get("ECOM_CDC_DIR", os.path.join(DATA_DIR, ".cdc"))
+CDC_BASE_DIR = os.path.join(CDC_DIR, "base")
+# Change sets, plus links to the files of every other table this run loads
+CDC_CHANGES_DIR = os.path.join(CDC_DIR, "changes")
+# Raw tables are split into parts of about this many compressed MB before PUT
+# (splitter.py), so COPY loads them on as many threads as there are parts; "0": no split
+SPLIT_MB = float(os.environ.get("ECOM_SPLIT_MB", "150"))
+SPLIT_DIR = os.environ.get("ECOM_SPLIT_DIR", os.path.join(CLEAN_DIR, "split"))
+# Where the raw loads stage from
+SOURCE_DIR = CDC_CHANGES_DIR if CDC else CLEAN_DIR
+LOAD_DIR = SPLIT_DIR if SPLIT_MB else SOURCE_DIR
+
+
+
+def task_metrics(context):
+    # Every task's duration, plus the row counts it returned (COPY, MERGE,
+    # cleanse), as metrics (ECOM_METRICS_FILE / ECOM_METRICS_PROM)
+    ti = context["ti"]
+    seconds = ((ti.end_date or datetime.now(timezone.utc)) - ti.start_date).total_seconds()
+    result = ti.xcom_pull(task_ids=ti.task_id) if ti.state == "success" else None
+    counts = {k: v for k, v in result.items() if type(v) is int} if isinstance(result, dict) else {}
+    record(ti.task_id, seconds, context["run_id"], status=ti.state, **counts)
+
 
 default_args = {
     "owner": "airflow",
     "snowflake_conn_id": "snowflake_conn",
+    "on_success_callback": task_metrics,
+    "on_failure_callback": task_metrics,
 }
 
+
+def detect_changes(**context):
+    # Full runs (the default) reload every table. Incremental runs, triggered with
+    # {"mode": "incremental"}, only load tables whose files changed since the
+    # last successful load. {"data_dir": ...} loads another batch directory.
+    # Stages the ledger has as done for this batch are skipped, so a retried
+    # run resumes and a batch loaded twice is a no-op, unless {"force": true}.
+    conf = context["dag_run"].conf or {}
+    mode = conf.get("mode", "full")
+    plan = plan_load(mode, conf.get("data_dir", DATA_DIR), LOAD_FORMAT)
+    plan["done"] = []
+    if not conf.get("force"):
+        backend = SnowflakeBackend(default_args["snowflake_conn_id"])
+        plan["done"] = [stage for (stage,) in backend.query(ledger_done_sql(plan["batch_id"]))]
+    print(f"{mode} run of {plan['data_dir']} (batch {plan['batch_id']}), "
+          f"loading: {sorted(plan['changed'])}, already done: {sorted(plan['done'])}")
+    return plan
+
+
+def cleanse_batch(**context):
+    # Validate the tables this run loads; parents that did not change are
+    # checked against their clean files from the last run, and appended
+    # tables' keys against the keys that run appended
+    plan = context["ti"].xcom_pull(task_ids="detect_changes")
+    appended = [t for t in plan["changed"] if load_action(plan, t) == "append"]
+    rows = cleanse(plan["data_dir"], CLEAN_DIR, list(plan["changed"]), LOAD_FORMAT,
+                   append=appended, batch=plan["batch_id"])
+    for table, (clean, rejected) in rows.items():
+        record(f"cleanse_{table}", run=context["run_id"], rows=clean, rejected=rejected)
+    return {"rows": sum(r[0] for r in rows.values()), "rejected": sum(r[1] for r in rows.values())}
+
+
+def diff_snapshots(**context):
+    # Snapshot tables whose last load was the base's batch are diffed; the rest
+    # are linked whole. The base only moves in commit_manifest, so a retried
+    # run diffs the same snapshots again.
+    plan = context["ti"].xcom_pull(task_ids="detect_changes")
+    backend = SnowflakeBackend(default_args["snowflake_conn_id"])
+    last = dict(backend.query(ledger_last_loads_sql(plan["batch_id"])))
+    snapshots = snapshot_tables(plan["changed"])
+    cdc = SnapshotBase(CDC_BASE_DIR).usable(snapshots, {t: last.get(load_stage(t))
+                                                        for t in snapshots})
+    shutil.rmtree(CDC_CHANGES_DIR, ignore_errors=True)
+    counts = diff_batch(CDC_BASE_DIR, CLEAN_DIR, CDC_CHANGES_DIR, cdc, LOAD_FORMAT)
+    link_tables(CLEAN_DIR, CDC_CHANGES_DIR, [t for t in plan["changed"] if t not in cdc],
+                LOAD_FORMAT)
+    return {"tables": cdc, **{k: sum(c[k] for c in counts.values())
+                              for k in ("inserted", "updated", "deleted")}}
+
+
+def cdc_tables(context):
+    return context["ti"].xcom_pull(task_ids="cdc.snapshot_diff")["tables"] if CDC else []
+
+
+def route_table(table, **context):
+    plan = context["ti"].xcom_pull(task_ids="detect_changes")
+    action = load_action(plan, table)
+    if action is None or load_stage(table) in plan["done"]:
+        return []
+    # Appends and change sets go straight to the load
+    if action == "append" or table in cdc_tables(context):
+        return f"load_{table}.split_{table}" if SPLIT_MB else f"load_{table}.put_{table}"
+    return f"load_{table}.truncate_{table}"
+
+
+def sources_changed(merge, **context):
+    plan = context["ti"].xcom_pull(task_ids="detect_changes")
+    return merge_needed(plan, merge) and merge not in plan["done"]
+
+
+def resolve_keys(**context):
+    backend = SnowflakeBackend(default_args["snowflake_conn_id"])
+    return {"rows": resolve_fact_keys(backend, CLEAN_DIR, CLEAN_DIR, LOAD_FORMAT, KEY_CACHE_DIR)}
+
+
+def extend_dates(**context):
+    backend = SnowflakeBackend(default_args["snowflake_conn_id"])
+    return {"rows": extend_dim_date(backend, CLEAN_DIR, LOAD_FORMAT)}
+
+
+def split_clean(table, **context):
+    return {"parts": len(split_table(SOURCE_DIR, SPLIT_DIR, table, LOAD_FORMAT,
+                                     int(SPLIT_MB * (1 << 20))))}
+
+
+def stage_table(table, src_dir, **context):
+    # Staged object names, for copy_staged
+    backend = SnowflakeBackend(default_args["snowflake_conn_id"], STAGE_CACHE_DIR)
+    return backend.staging.stage_files(table, table_files(src_dir, table, LOAD_FORMAT))
+
+
+def copy_staged(table, put_task_id, ledger, **context):
+    names = context["ti"].xcom_pull(task_ids=put_task_id)
+    copy = [copy_sql(table, LOAD_FORMAT, names)] if names else []
+    return run_sql(copy, load_stage(table) if ledger else None, table if ledger else None,
+                   **context)
+
+
+def run_sql(sql, stage=None, table=None, **context):
+    # COPY/MERGE counts for task_metrics; with ``stage`` committed with its ledger row.
+    # The COPY of a change set (``table``) first deletes the keys it replaces.
+    backend = SnowflakeBackend(default_args["snowflake_conn_id"])
+    if table is not None and table in cdc_tables(context):
+        statements = [sql] if isinstance(sql, str) else sql
+        sql = [cdc_delete_sql(table, RULES[table]["key"])] + statements
+    if stage is None:
+        return backend.run(sql) if sql else {}
+    plan = context["ti"].xcom_pull(task_ids="detect_changes")
+    return backend.run_stage(sql, plan["batch_id"], stage, plan["data_dir"])
+
+
+def run_merge(merge, sql, **context):
+    # Dimensions whose sources were all loaded as change sets MERGE only those ids
+    if sql == MERGES[merge]:
+        plan = context["ti"].xcom_pull(task_ids="detect_changes")
+        sql = merge_sql(merge, plan["changed"], cdc_tables(context))
+    return run_sql(sql, merge, **context)
+
+
+def put_and_copy(table, group=None, ledger=True, src_dir=CLEAN_DIR, **put_kwargs):
+    """(put, copy) tasks of a table's files in ``src_dir``: the staging cache's,
+    or a plain PUT and COPY (of the table's whole stage prefix, for split parts).
+
+    With ``ledger`` the COPY commits together with the table's ledger row.
+    """
+    if not STAGE_CACHE:
+        prefix = SPLIT_PREFIX if src_dir == SPLIT_DIR else None
+        put = SnowflakeOperator(task_id=f"put_{table}",
+                                sql=put_sql(table, LOAD_FORMAT, src_dir, prefix),
+                                task_group=group, **put_kwargs)
+        copy = PythonOperator(task_id=f"copy_{table}", python_callable=run_sql,
+                              op_kwargs={"sql": copy_sql(table, LOAD_FORMAT, prefix=prefix),
+                                         "stage": load_stage(table) if ledger else None,
+                                         "table": table if ledger else None},
+                              task_group=group)
+        return put, copy
+    put = PythonOperator(task_id=f"put_{table}", python_callable=stage_table,
+                         op_kwargs={"table": table, "src_dir": src_dir}, task_group=group,
+                         **put_kwargs)
+    copy = PythonOperator(task_id=f"copy_{table}", python_callable=copy_staged,
+                          op_kwargs={"table": table, "put_task_id": put.task_id, "ledger": ledger},
+                          task_group=group)
+    return put, copy
+
+
+def worker_stage(task_id, python_callable, table, group, src_dir=CLEAN_DIR):
+    """A worker task writing {src_dir}/{table} files, loaded like a raw table; (first, last) task."""
+    compute = PythonOperator(task_id=task_id, python_callable=python_callable, task_group=group)
+    truncate = SnowflakeOperator(task_id=f"truncate_{table}", sql=truncate_sql(table),
+                                 task_group=group)
+    put, copy = put_and_copy(table, group, ledger=False, src_dir=src_dir)
+    compute >> truncate >> put >> copy
+    return compute, copy
+
+
+def commit_manifest(**context):
+    plan = context["ti"].xcom_pull(task_ids="detect_changes")
+    if CDC:
+        # The snapshots the next batch is diffed against
+        SnapshotBase(CDC_BASE_DIR).save(snapshot_tables(plan["changed"]), CLEAN_DIR,
+                                        plan["batch_id"], LOAD_FORMAT)
+    record_loaded(plan["data_dir"], {t: d for t, d in plan["changed"].items() if d})
+
+
 with DAG(
     dag_id="load_raw_all_sequence",
     default_args=default_args,
     start_date=days_ago(1),
     schedule_interval=None,
     catchup=False,
-    concurrency=1,
+    max_active_tasks=LOAD_PARALLELISM,
     max_active_runs=1,
 ) as dag:
-    prev_task = None
-
-    # 1) Truncate, upload, and load each raw table sequentially
-    for table in RAW_TABLES:
-        # Truncate existing data
-        truncate = SnowflakeOperator(
-            task_id=f"truncate_{table}",
-            sql=f"TRUNCATE TABLE raw.{table};"
-        )
-
-        # Stage CSV into user stage
-        put = SnowflakeOperator(
-            task_id=f"put_{table}",
-            sql=f"PUT file:///data/{table}.csv @~/ OVERWRITE = TRUE;"
-        )
-
-        # Copy staged file into raw table with lenient parsing (so that no rows are skipped)
-        copy = SnowflakeOperator(
-            task_id=f"copy_{table}",
-            sql=f"""
-COPY INTO raw.{table}
-FROM @~/{table}.csv
-FILE_FORMAT=(
-  TYPE = 'CSV',
-  SKIP_HEADER = 1,
-  FIELD_OPTIONALLY_ENCLOSED_BY = '"',
-  TRIM_SPACE = TRUE,
-  ERROR_ON_COLUMN_COUNT_MISMATCH = FALSE
-)
-ON_ERROR = 'CONTINUE';
-"""
-        )
-
-        # Chain tasks: ensure sequential execution
-        if prev_task:
-            prev_task >> truncate
-        truncate >> put >> copy
-        prev_task = copy
-
-    # 2) Sequentially upsert dimensions and fact
-    merge_dim_product = SnowflakeOperator(
-        task_id="merge_dim_product",
-        sql="""
-MERGE INTO dwh.dim_product AS tgt
-USING (
-  SELECT product_id, sku, name, description,
-         base_price, created_at, category_id,
-         category_name, category_description
-  FROM (
-    SELECT p.product_id, p.sku, p.name, p.description,
-           p.base_price, p.created_at,
-           pc.category_id, c.name        AS category_name,
-           c.description                 AS category_description,
-           ROW_NUMBER() OVER (
-             PARTITION BY p.product_id
-             ORDER BY pc.category_id
-           ) AS rn
-    FROM raw.products p
-    JOIN raw.product_categories pc USING(product_id)
-    JOIN raw.categories c         USING(category_id)
-  ) ranked
-  WHERE rn = 1
-) src
-ON tgt.product_id = src.product_id
-WHEN NOT MATCHED THEN
-  INSERT (product_id, sku, name, description,
-          base_price, created_at,
-          category_id, category_name, category_description)
-  VALUES (src.product_id, src.sku, src.name, src.description,
-          src.base_price, src.created_at,
-          src.category_id, src.category_name, src.category_description);
-"""
+    detect = PythonOperator(
+        task_id="detect_changes",
+        python_callable=detect_changes,
     )
 
-    merge_dim_customer = SnowflakeOperator(
-        task_id="merge_dim_customer",
-        sql="""
-MERGE INTO dwh.dim_customer AS tgt
-USING (
-  SELECT customer_id, first_name, last_name, email,
-         phone, join_date, default_address_id,
-         default_city, default_state,
-         default_country, default_postal_code
-  FROM (
-    SELECT c.customer_id, c.first_name, c.last_name,
-           c.email, c.phone, c.date_joined      AS join_date,
-           a.address_id        AS default_address_id,
-           a.city              AS default_city,
-           a.state             AS default_state,
-           a.country           AS default_country,
-           a.postal_code       AS default_postal_code,
-           ROW_NUMBER() OVER (
-             PARTITION BY c.customer_id
-             ORDER BY a.is_default DESC NULLS LAST
-           ) AS rn
-    FROM raw.customers c
-    LEFT JOIN raw.addresses a ON c.customer_id = a.customer_id
-                            AND a.is_default = TRUE
-  ) filtered
-  WHERE rn = 1
-) src
-ON tgt.customer_id = src.customer_id
-WHEN NOT MATCHED THEN
-  INSERT (customer_id, first_name, last_name, email, phone,
-          join_date, default_address_id,
-          default_city, default_state,
-          default_country, default_postal_code)
-  VALUES (src.customer_id, src.first_name, src.last_name, src.email, src.phone,
-          src.join_date, src.default_address_id,
-          src.default_city, src.default_state,
-          src.default_country, src.default_postal_code);
-"""
+    clean = PythonOperator(
+        task_id="cleanse",
+        python_callable=cleanse_batch,
     )
+    detect >> clean
 
-    merge_dim_shipper = SnowflakeOperator(
-        task_id="merge_dim_shipper",
-        sql="""
-MERGE INTO dwh.dim_shipper AS tgt
-USING (
-  SELECT shipper_id, name, phone, tracking_url_template
-  FROM raw.shippers
-) src
-ON tgt.shipper_id = src.shipper_id
-WHEN NOT MATCHED THEN
-  INSERT (shipper_id, name, phone, tracking_url_template)
-  VALUES (src.shipper_id, src.name, src.phone, src.tracking_url_template);
-"""
-    )
+    # Change sets: raw.cdc_changes is loaded before any table whose rows it deletes
+    if CDC:
+        with TaskGroup(group_id="cdc") as cdc_group:
+            worker_stage("snapshot_diff", diff_snapshots, CDC_TABLE, cdc_group, CDC_CHANGES_DIR)
+        clean >> cdc_group
 
-    merge_dim_order_status = SnowflakeOperator(
-        task_id="merge_dim_order_status",
-        sql="""
-MERGE INTO dwh.dim_order_status AS tgt
-USING (
-  SELECT order_status_id, status_name, description
-  FROM raw.order_statuses
-) src
-ON tgt.order_status_id = src.order_status_id
-WHEN NOT MATCHED THEN
-  INSERT (order_status_id, status_name, description)
-  VALUES (src.order_status_id, src.status_name, src.description);
-"""
-    )
+    # 1) Truncate, upload, and load each changed raw table. Raw tables do not
+    #    depend on each other, so every table is its own group and they fan out.
+    loads = {}
+    for table in RAW_TABLES:
+        with TaskGroup(group_id=f"load_{table}") as load:
+            # Skip unchanged tables, append deltas, truncate and reload snapshots
+            route = BranchPythonOperator(
+                task_id=f"route_{table}",
+                python_callable=route_table,
+                op_kwargs={"table": table},
+            )
 
-    merge_fact_order_item = SnowflakeOperator(
-        task_id="merge_fact_order_item",
-        sql="""
-MERGE INTO dwh.fact_order_item AS tgt
-USING (
-  SELECT o.order_id,
-         TO_NUMBER(TO_CHAR(o.order_date,'YYYYMMDD')) AS order_date_key,
-         dp.product_key, dc.customer_key,
-         ds.shipper_key, dos.status_key,
-         oi.quantity, oi.unit_price,
-         oi.quantity * oi.unit_price       AS extended_price
-  FROM raw.orders o
-  JOIN raw.order_items     oi  ON o.order_id = oi.order_id
-  JOIN dwh.dim_product     dp  ON dp.product_id       = oi.product_id
-  JOIN dwh.dim_customer    dc  ON dc.customer_id      = o.customer_id
-  JOIN dwh.dim_shipper     ds  ON ds.shipper_id       = o.shipper_id
-  JOIN dwh.dim_order_status dos ON dos.order_status_id = o.order_status_id
-) src
-ON tgt.order_id    = src.order_id
-AND tgt.product_key = src.product_key
-WHEN NOT MATCHED THEN
-  INSERT (order_id, order_date_key, product_key, customer_key,
-          shipper_key, status_key, quantity, unit_price, extended_price)
-  VALUES (src.order_id, src.order_date_key, src.product_key, src.customer_key,
-          src.shipper_key, src.status_key, src.quantity, src.unit_price, src.extended_price);
-"""
-    )
+            # Truncate existing data
+            truncate = SnowflakeOperator(
+                task_id=f"truncate_{table}",
+                sql=truncate_sql(table)
+            )
+
+            # Upload and load (unchanged file contents are not uploaded again)
+            if SPLIT_MB:
+                # Size-targeted parts first, so COPY loads the table in parallel
+                first = PythonOperator(task_id=f"split_{table}", python_callable=split_clean,
+                                       op_kwargs={"table": table},
+                                       trigger_rule="none_failed_min_one_success")
+                put, copy = put_and_copy(table, src_dir=LOAD_DIR)
+                first >> put
+            else:
+                put, copy = put_and_copy(table, src_dir=SOURCE_DIR,
+                                         trigger_rule="none_failed_min_one_success")
+                first = put
 
-    # 3) Sequence merges after the final raw copy
-    prev_task >> merge_dim_product
-    merge_dim_product >> merge_dim_customer
-    merge_dim_customer >> merge_dim_shipper
-    merge_dim_shipper >> merge_dim_order_status
-    merge_dim_order_status >> merge_fact_order_item
+            route >> [truncate, first]
+            truncate >> first
+            put >> copy
+        # Change-set loads delete by raw.cdc_changes, so they wait for it
+        (cdc_group if CDC else clean) >> load
+        loads[table] = load
+
+    # 2) Transform: the dimension MERGEs are independent of each other and run
+    #    concurrently, each as soon as the raw tables it reads are loaded; the
+    #    fact starts once its dimensions are done. Every MERGE is skipped when
+    #    none of its inputs were reloaded.
+    merges = {}
+    with TaskGroup(group_id="transform"):
+        dims = TaskGroup(group_id="dims")
+        heavy_dims = TaskGroup(group_id="heavy_dims")
+        for merge in merge_order():
+            group = None
+            if is_dimension(merge):
+                group = heavy_dims if merge in HEAVY_MERGES else dims
+            pool = HEAVY_POOL if merge in HEAVY_MERGES else "default_pool"
+            check = ShortCircuitOperator(
+                task_id=f"check_{merge}",
+                python_callable=sources_changed,
+                op_kwargs={"merge": merge},
+                ignore_downstream_trigger_rules=False,
+                trigger_rule="none_failed",
+                task_group=group,
+            )
+            sql = MERGES[merge]
+            upstream = check
+            if merge == "merge_dim_date":
+                # Calendar rows for the loaded orders' dates, computed on the worker
+                first, upstream = worker_stage("extend_dim_date", extend_dates,
+                                               DATE_EXTENSION_TABLE, group)
+                check >> first
+            if PRERESOLVE_FACT and merge == "merge_fact_order_item":
+                # Keys resolved on the worker, staged and loaded like a raw table
+                first, upstream = worker_stage("resolve_fact_keys", resolve_keys,
+                                               KEYED_FACT_TABLE, group)
+                check >> first
+                sql = APPEND_FACT_ORDER_ITEM
+            merges[merge] = PythonOperator(task_id=merge, python_callable=run_merge,
+                                           op_kwargs={"merge": merge, "sql": sql},
+                                           pool=pool, task_group=group)
+            [loads[table] for table in MERGE_SOURCES[merge]] >> check
+            [merges[m] for m in merge_upstream(merge)] >> check
+            upstream >> merges[merge]
+
+    # 3) Remember what was loaded, so the next incremental run can skip it
+    list(loads.values()) + list(merges.values()) >> PythonOperator(
+        task_id="commit_manifest",
+        python_callable=commit_manifest,
+        trigger_rule="none_failed",
+    )
@@ -0,0 +1,238 @@
+"""Resolve fact surrogate keys outside the warehouse.
+
+DimKeyCache keeps one natural -> surrogate key map per dimension, as a flat
+array indexed by the natural id. For Type 2 dimensions the array holds the
+current version, and replaced versions are kept as validity ranges. Between runs it is saved to disk, and a
+refresh only fetches the rows a dimension MERGE added since. With it, the
+order lines of a delta are turned into fully keyed fact rows in memory. The
+fact load then appends them (APPEND_FACT_ORDER_ITEM) instead of joining every
+line to the four dimensions.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+from manifest import table_files
+from pipeline_sql import KEYED_FACT_TABLE, SCD2_TRACKED
+from writers import make_writer
+
+CHUNK_ROWS = 500_000
+CACHE_FILE = "dim_keys.npz"
+# Fact column -> (dimension, natural id column, surrogate key column)
+DIM_KEYS = {
+    "product_key": ("dwh.dim_product", "product_id", "product_key"),
+    "customer_key": ("dwh.dim_customer", "customer_id", "customer_key"),
+    "shipper_key": ("dwh.dim_shipper", "shipper_id", "shipper_key"),
+    "status_key": ("dwh.dim_order_status", "order_status_id", "status_key"),
+}
+
+
+# Natural ids of a Type 2 dimension map to the current version; older
+# versions are kept apart as (natural, valid_from, valid_to, key) ranges
+ALWAYS = np.iinfo(np.int64).min
+HISTORY = ["natural", "valid_from", "valid_to", "key"]
+
+
+class KeyMap:
+    """Natural id -> surrogate key as an array; 0 means unknown.
+
+    ``since`` holds when the current version became valid (ns since the
+    epoch, ALWAYS for first versions). Versions it replaced go to ``history``.
+    """
+
+    def __init__(self, keys=None, since=None, history=None, high=0, count=0):
+        self.keys = np.zeros(0, np.int64) if keys is None else keys
+        self.since = np.full(len(self.keys), ALWAYS, np.int64) if since is None else since
+        self.history = pd.DataFrame({c: np.zeros(0, np.int64) for c in HISTORY}) \
+            if history is None else history
+        self.high = high      # largest surrogate key seen
+        self.count = count    # dimension rows mapped
+
+    def add(self, natural, surrogate, since=None):
+        """Adds dimension rows; a natural id seen again is a new version."""
+        rows = pd.DataFrame({"natural": np.asarray(natural, np.int64),
+                             "key": np.asarray(surrogate, np.int64)})
+        if not len(rows):
+            return
+        rows["since"] = ALWAYS if since is None else np.asarray(since, np.int64)
+        rows = rows.sort_values("key")
+        top = int(rows["natural"].max())
+        if top >= len(self.keys):
+            size = max(top + 1, 2 * len(self.keys))
+            self.keys = np.concatenate([self.keys, np.zeros(size - len(self.keys), np.int64)])
+            self.since = np.concatenate([self.since, np.full(size - len(self.since), ALWAYS, np.int64)])
+
+        # Versions ended by a later one: earlier rows of this batch, and the
+        # current version of an id that has a new one
+        until = rows.groupby("natural")["since"].shift(-1)
+        ended = rows[until.notna()].assign(until=until[until.notna()])
+        first = rows.drop_duplicates("natural")
+        first = first[self.keys[first["natural"].to_numpy()] > 0]
+        replaced = pd.DataFrame({"natural": first["natural"].to_numpy(),
+                                 "key": self.keys[first["natural"].to_numpy()],
+                                 "since": self.since[first["natural"].to_numpy()],
+                                 "until": first["since"].to_numpy()})
+        for versions in (replaced, ended):
+            if len(versions):
+                versions = versions.rename(columns={"since": "valid_from", "until": "valid_to"})
+                self.history = pd.concat([self.history, versions[HISTORY].astype(np.int64)],
+                                         ignore_index=True)
+
+        last = rows.drop_duplicates("natural", keep="last")
+        self.keys[last["natural"].to_numpy()] = last["key"].to_numpy()
+        self.since[last["natural"].to_numpy()] = last["since"].to_numpy()
+        self.high = max(self.high, int(rows["key"].max()))
+        self.count += len(rows)
+
+    def get(self, natural, at=None):
+        """Keys of ``natural``, or of the versions valid at ``at`` (ns since the epoch)."""
+        natural = np.asarray(natural, np.int64)
+        out = np.zeros(len(natural), np.int64)
+        inside = (natural >= 0) & (natural < len(self.keys))
+        out[inside] = self.keys[natural[inside]]
+        if at is None:
+            return out
+        at = np.asarray(at, np.int64)
+        early = np.zeros(len(natural), bool)
+        early[inside] = at[inside] < self.since[natural[inside]]
+        if early.any():
+            out[early] = 0
+            pos = np.flatnonzero(early)
+            found = pd.DataFrame({"pos": pos, "natural": natural[pos], "at": at[pos]}) \
+                .merge(self.history, on="natural")
+            found = found[(found["at"] >= found["valid_from"]) & (found["at"] < found["valid_to"])]
+            out[found["pos"].to_numpy()] = found["key"].to_numpy()
+        return out
+
+
+def timestamps(values):
+    """ns since the epoch, as compared with the dimension's effective_from/to."""
+    return pd.to_datetime(pd.Series(values)).astype("datetime64[ns]").to_numpy().view(np.int64)
+
+
+class DimKeyCache:
+    def __init__(self, cache_dir=None):
+        self.path = os.path.join(cache_dir, CACHE_FILE) if cache_dir else None
+        self.maps = {column: KeyMap() for column in DIM_KEYS}
+        if self.path and os.path.exists(self.path):
+            saved = np.load(self.path)
+            # A cache written before the Type 2 ranges is rebuilt by refresh()
+            current = all(f"{column}_since" in saved.files for column in DIM_KEYS)
+            for column in DIM_KEYS if current else []:
+                high, count = saved[f"{column}_meta"]
+                history = pd.DataFrame({c: saved[f"{column}_{c}"] for c in HISTORY})
+                self.maps[column] = KeyMap(saved[column], saved[f"{column}_since"], history,
+                                           int(high), int(count))
+
+    def refresh(self, backend):
+        """Fetch the keys added since the last refresh; reload a dimension if that does not add up."""
+        for column, (dim, natural, surrogate) in DIM_KEYS.items():
+            key_map = self.maps[column]
+            scd2 = dim in SCD2_TRACKED
+            select = f"SELECT {natural}, {surrogate}" + (", effective_from" if scd2 else "")
+            total = backend.query(f"SELECT COUNT(*) FROM {dim}")[0][0]
+            rows = []
+            if total >= key_map.count:
+                rows = backend.query(f"{select} FROM {dim} WHERE {surrogate} > {key_map.high} "
+                                     f"AND {natural} IS NOT NULL ORDER BY {surrogate}")
+            # Rows are only ever added, with increasing keys (a Type 2 change
+            # adds a version and closes the previous one); anything else
+            # (a rebuilt dimension, out-of-order keys) means a full reload
+            if key_map.count + len(rows) != total:
+                key_map = self.maps[column] = KeyMap()
+                rows = backend.query(f"{select} FROM {dim} WHERE {natural} IS NOT NULL "
+                                     f"ORDER BY {surrogate}")
+            if rows:
+                fields = list(zip(*rows))
+                key_map.add(fields[0], fields[1], timestamps(fields[2]) if scd2 else None)
+
+    def save(self):
+        if not self.path:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        arrays = {}
+        for column, key_map in self.maps.items():
+            arrays[column] = key_map.keys
+            arrays[f"{column}_since"] = key_map.since
+            arrays[f"{column}_meta"] = np.array([key_map.high, key_map.count], np.int64)
+            for c in HISTORY:
+                arrays[f"{column}_{c}"] = key_map.history[c].to_numpy(np.int64)
+        # Write-then-rename, like the load manifest
+        tmp = f"{self.path}.tmp.npz"
+        np.savez(tmp, **arrays)
+        os.replace(tmp, self.path)
+
+
+def read_table(data_dir, table, fmt, usecols, chunk_rows=CHUNK_ROWS):
+    for path in table_files(data_dir, table, fmt):
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=usecols):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(path, usecols=usecols, chunksize=chunk_rows)
+
+
+def date_keys(dates):
+    dates = pd.to_datetime(dates)
+    return (dates.dt.year * 10000 + dates.dt.month * 100 + dates.dt.day).to_numpy(np.int64)
+
+
+def resolve_fact_keys(backend, data_dir, out_dir, fmt="csv", cache_dir=None, chunk_rows=CHUNK_ROWS):
+    """Writes {out_dir}/fact_order_item_keyed.<fmt> for the orders above the fact watermark.
+
+    ``data_dir`` holds the orders and order_items files of this run (clean
+    files). Lines whose order, product, customer, shipper or status has no
+    dimension row are left out, as the fact MERGE's inner joins would.
+    """
+    cache = DimKeyCache(cache_dir)
+    cache.refresh(backend)
+    cache.save()
+    last_order_id = backend.query("SELECT last_order_id FROM dwh.etl_watermark "
+                                  "WHERE source_name = 'fact_order_item'")[0][0] or 0
+
+    # Orders of this run, keyed once: order_id -> row of the arrays below
+    order_cols = ["order_id", "customer_id", "order_status_id", "shipper_id", "order_date"]
+    orders = [o[o["order_id"] > last_order_id]
+              for o in read_table(data_dir, "orders", fmt, order_cols, chunk_rows)]
+    orders = pd.concat(orders) if orders else pd.DataFrame(columns=order_cols)
+    orders = orders.dropna(subset=["order_id"]).drop_duplicates("order_id")
+    order_index = pd.Index(orders["order_id"].astype(np.int64))
+    order_date_key = date_keys(orders["order_date"])
+    # Type 2 dimensions resolve to the version valid on the order date
+    order_at = timestamps(pd.to_datetime(orders["order_date"]).dt.normalize())
+    order_keys = {
+        "customer_key": cache.maps["customer_key"].get(orders["customer_id"].fillna(-1), order_at),
+        "status_key": cache.maps["status_key"].get(orders["order_status_id"].fillna(-1)),
+        "shipper_key": cache.maps["shipper_key"].get(orders["shipper_id"].fillna(-1)),
+    }
+
+    written = dropped = 0
+    with make_writer(fmt, out_dir) as out:
+        # Header first, so the file exists even when nothing is new
+        out.write(KEYED_FACT_TABLE, pd.DataFrame(columns=[
+            "order_id", "order_date_key", "product_key", "customer_key", "shipper_key",
+            "status_key", "quantity", "unit_price", "extended_price"]).astype(np.int64))
+        for items in read_table(data_dir, "order_items", fmt,
+                                ["order_id", "product_id", "quantity", "unit_price"], chunk_rows):
+            pos = order_index.get_indexer(items["order_id"].fillna(-1).astype(np.int64))
+            items, pos = items[pos >= 0], pos[pos >= 0]
+            rows = pd.DataFrame({
+                "order_id": items["order_id"].astype(np.int64).values,
+                "order_date_key": order_date_key[pos],
+                "product_key": cache.maps["product_key"].get(items["product_id"].fillna(-1),
+                                                             order_at[pos]),
+                "customer_key": order_keys["customer_key"][pos],
+                "shipper_key": order_keys["shipper_key"][pos],
+                "status_key": order_keys["status_key"][pos],
+                "quantity": items["quantity"].values,
+                "unit_price": items["unit_price"].values,
+                "extended_price": np.round(items["quantity"].values * items["unit_price"].values, 2),
+            })
+            keyed = (rows[list(DIM_KEYS)] > 0).all(axis=1)
+            dropped += int((~keyed).sum())
+            written += int(keyed.sum())
+            out.write(KEYED_FACT_TABLE, rows[keyed])
+    print(f"{KEYED_FACT_TABLE}: {dropped} lines without a dimension row left out")
+    return written
@@ -0,0 +1,192 @@
+"""Run the load_raw_all_sequence pipeline without Airflow.
+
+Same tables, same SQL, same order as the DAG, against an embedded DuckDB
+database (or Snowflake, through the DAG's connection). Every stage is timed:
+
+    python local_run.py Data/Batch1 Data/Batch2 Data/Batch3 --db ecom.duckdb --init
+"""
+import argparse
+import os
+import shutil
+import tempfile
+import time
+from contextlib import contextmanager
+
+from backends import BACKENDS, make_backend
+from calendar_dim import extend_dim_date
+from cleanse import RULES, cleanse
+from manifest import record_loaded
+from metrics import add_counts, timed
+from key_cache import resolve_fact_keys
+from pipeline_sql import (APPEND_FACT_ORDER_ITEM, CDC_TABLE, DATE_EXTENSION_TABLE,
+                          KEYED_FACT_TABLE, RAW_TABLES, cdc_delete_sql, ledger_done_sql,
+                          ledger_last_loads_sql, ledger_record_sql, load_action, load_stage,
+                          merge_needed, merge_order, merge_sql, plan_load)
+from snapshot_diff import SnapshotBase, diff_batch, snapshot_tables
+from splitter import split_table
+
+
+def run_pipeline(backend, data_dir, fmt="csv", mode="full", manifest_path=None, clean_dir=None,
+                 key_cache_dir=None, force=False, split_mb=0, cdc_dir=None):
+    """One DAG run over ``data_dir``; returns {task_id: seconds}.
+
+    With ``clean_dir`` the batch is validated first (cleanse.py) and loaded
+    from there, as the DAG does; without it the files are loaded as they are.
+    With ``key_cache_dir`` (needs ``clean_dir``) fact keys are resolved by
+    key_cache.py and the fact is appended instead of MERGEd from a join.
+    With ``split_mb`` (needs ``clean_dir`` too) the raw tables are split into
+    parts of about that many compressed MB (splitter.py) and loaded from those.
+    With ``cdc_dir`` (needs ``clean_dir``) snapshot tables are diffed against
+    the snapshot loaded before (snapshot_diff.py, kept in ``cdc_dir``) and
+    loaded as change sets, and the Type 2 dimensions MERGE only what changed.
+    Stages this batch already completed (dwh.etl_ledger) are skipped unless
+    ``force`` is set.
+    """
+    if (key_cache_dir or split_mb or cdc_dir) and not clean_dir:
+        raise ValueError("key pre-resolution, splitting and change sets work from the clean "
+                         "files; set clean_dir")
+    timings = {}
+    plan = plan_load(mode, data_dir, fmt, manifest_path)
+    batch = plan["batch_id"]
+
+    @contextmanager
+    def step(stage):
+        # The block adds its row counts to the yielded dict; both go to metrics.py
+        with timed(stage, batch, timings) as counts:
+            yield counts
+        print(f"  {stage}: {timings[stage]:.3f}s" + "".join(f", {k} {v}" for k, v in counts.items()))
+
+    done = set() if force else {stage for (stage,) in backend.query(ledger_done_sql(batch))}
+    loads = [t for t in RAW_TABLES if load_action(plan, t) and load_stage(t) not in done]
+    merges = [m for m in merge_order() if merge_needed(plan, m) and m not in done]
+    print(f"{data_dir}: {mode} run of batch {batch[:12]}, loading: {loads}")
+    if done:
+        print(f"  {len(done)} stages already done, skipped")
+
+    load_dir = data_dir
+    if clean_dir and (loads or merges):
+        with step("cleanse") as counts:
+            appended = [t for t in plan["changed"] if load_action(plan, t) == "append"]
+            rows = cleanse(data_dir, clean_dir, list(plan["changed"]), fmt,
+                           append=appended, batch=batch).values()
+            counts.update(rows=sum(r[0] for r in rows), rejected=sum(r[1] for r in rows))
+        load_dir = clean_dir
+
+    # Change sets of the snapshot tables whose last load was the base's batch.
+    # The base only moves once the whole batch is in, so a resumed run diffs
+    # the same snapshots again and reloads raw.cdc_changes for the MERGEs.
+    cdc, snapshots = [], snapshot_tables(plan["changed"])
+    if cdc_dir and (loads or merges):
+        base = SnapshotBase(os.path.join(cdc_dir, "base"))
+        changes_dir = os.path.join(cdc_dir, "changes")
+        last = dict(backend.query(ledger_last_loads_sql(batch)))
+        cdc = base.usable(snapshots, {t: last.get(load_stage(t)) for t in snapshots})
+        if cdc:
+            shutil.rmtree(changes_dir, ignore_errors=True)
+            with step("snapshot_diff") as counts:
+                counts.update(add_counts(*diff_batch(base.root, clean_dir, changes_dir,
+                                                     cdc, fmt).values()))
+            with step(f"copy_{CDC_TABLE}") as counts:
+                backend.truncate(CDC_TABLE)
+                counts.update(backend.load(CDC_TABLE, fmt, changes_dir))
+
+    # 1) Raw loads (the load_{table} groups); each COPY commits with its ledger row
+    split_dir = os.path.join(clean_dir, "split") if split_mb else None
+    for table in loads:
+        copy_dir = changes_dir if table in cdc else load_dir
+        if split_mb:
+            with step(f"split_{table}"):
+                split_table(copy_dir, split_dir, table, fmt, int(split_mb * (1 << 20)))
+            copy_dir = split_dir
+        before = []
+        if table in cdc:
+            before = [cdc_delete_sql(table, RULES[table]["key"])]
+        elif load_action(plan, table) == "replace":
+            with step(f"truncate_{table}"):
+                backend.truncate(table)
+        with step(f"copy_{table}") as counts:
+            counts.update(backend.load(table, fmt, copy_dir,
+                                       [ledger_record_sql(batch, load_stage(table), data_dir)],
+                                       before))
+
+    # 2) Transform, dimensions before the fact
+    for merge in merges:
+        sql = merge_sql(merge, plan["changed"], cdc)
+        if merge == "merge_dim_date":
+            with step("extend_dim_date") as counts:
+                with tempfile.TemporaryDirectory() as work:
+                    counts["rows"] = extend_dim_date(backend, clean_dir or work, fmt)
+                    backend.truncate(DATE_EXTENSION_TABLE)
+                    backend.load(DATE_EXTENSION_TABLE, fmt, clean_dir or work)
+        if key_cache_dir and merge == "merge_fact_order_item":
+            with step("resolve_fact_keys") as counts:
+                counts["rows"] = resolve_fact_keys(backend, load_dir, load_dir, fmt, key_cache_dir)
+            with step(f"copy_{KEYED_FACT_TABLE}") as counts:
+                backend.truncate(KEYED_FACT_TABLE)
+                counts.update(backend.load(KEYED_FACT_TABLE, fmt, load_dir))
+            sql = APPEND_FACT_ORDER_ITEM
+        with step(merge) as counts:
+            counts.update(backend.run_stage(sql, batch, merge, data_dir))
+
+    # 3) Manifest, and the snapshots the next batch is diffed against
+    if cdc_dir and (loads or merges):
+        base.save(snapshots, clean_dir, batch, fmt)
+    record_loaded(data_dir, {t: d for t, d in plan["changed"].items() if d}, manifest_path)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the pipeline locally, batch by batch.")
+    parser.add_argument("batches", nargs="+", help="data directories, loaded in order")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="duckdb")
+    parser.add_argument("--db", default=None,
+                        help="DuckDB database file (default: in memory) or Snowflake conn id")
+    parser.add_argument("--init", action="store_true",
+                        help="create the raw/dwh schemas from snowflake.sql first")
+    parser.add_argument("--mode", choices=["full", "incremental"], default="full")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--manifest", default=None,
+                        help="load manifest (default: next to the database file)")
+    parser.add_argument("--clean-dir", default=None,
+                        help="validated files and quarantine (default: next to the database file)")
+    parser.add_argument("--preresolve", action="store_true",
+                        help="resolve fact keys from a cached key map and append the fact")
+    parser.add_argument("--force", action="store_true",
+                        help="rerun stages the ledger has as done for these batches")
+    parser.add_argument("--split-mb", type=float, default=0,
+                        help="split each raw table into parts of about this many compressed MB")
+    parser.add_argument("--cdc", action="store_true",
+                        help="load snapshot tables as change sets against the previous batch")
+    parser.add_argument("--stage-cache", default=None,
+                        help="load through the staging cache kept in this directory "
+                             "(DuckDB: the directory is also the stage)")
+    args = parser.parse_args()
+
+    # An in-memory database starts empty, so its manifest and clean files should too
+    workdir = tempfile.TemporaryDirectory()
+    persistent = args.backend == "duckdb" and args.db not in (None, ":memory:")
+    state = args.db if persistent else os.path.join(workdir.name, "local")
+    manifest_path = args.manifest or f"{state}.manifest.json"
+    clean_dir = args.clean_dir or f"{state}.clean"
+    key_cache_dir = f"{state}.keys" if args.preresolve else None
+    cdc_dir = f"{state}.cdc" if args.cdc else None
+
+    options = {}
+    if args.stage_cache:
+        options = {"stage_dir" if args.backend == "duckdb" else "stage_cache_dir": args.stage_cache}
+
+    with make_backend(args.backend, args.db, **options) as backend:
+        if args.init:
+            start = time.perf_counter()
+            backend.init_schema()
+            print(f"init_schema: {time.perf_counter() - start:.3f}s")
+        for data_dir in args.batches:
+            start = time.perf_counter()
+            run_pipeline(backend, data_dir, args.format, args.mode, manifest_path, clean_dir,
+                         key_cache_dir, args.force, args.split_mb, cdc_dir)
+            print(f"{data_dir}: {time.perf_counter() - start:.3f}s total")
+    workdir.cleanup()
+
+
+if __name__ == "__main__":
+    main()
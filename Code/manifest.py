@@ -0,0 +1,145 @@
+import glob
+import hashlib
+import json
+import os
+import re
+
+# Where the DAG remembers what it last loaded from a data directory
+LOADED_MANIFEST = ".loaded_manifest.json"
+# What a generator wrote into a batch directory (write_batch_manifest)
+BATCH_MANIFEST = "batch.json"
+
+
+def file_digest(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def table_files(data_dir, table, fmt="csv"):
+    # {table}.<fmt> and its part files {table}-00000.<fmt>, in name order
+    pattern = re.compile(rf"{re.escape(table)}(-\d+)?\.{fmt}$")
+    return sorted(p for p in glob.glob(os.path.join(data_dir, f"{table}*.{fmt}"))
+                  if pattern.match(os.path.basename(p)))
+
+
+def table_digest(data_dir, table, fmt="csv"):
+    """One digest over every file of a table, or None when it has no files."""
+    files = table_files(data_dir, table, fmt)
+    if not files:
+        return None
+    h = hashlib.sha256()
+    for path in files:
+        h.update(os.path.basename(path).encode())
+        h.update(file_digest(path).encode())
+    return h.hexdigest()
+
+
+def file_rows(path):
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    with open(path, "rb") as f:
+        return max(sum(block.count(b"\n") for block in iter(lambda: f.read(1 << 20), b"")) - 1, 0)
+
+
+def batch_id(digests):
+    """Content id of a batch: one digest over its tables' digests."""
+    h = hashlib.sha256()
+    for table in sorted(t for t, d in digests.items() if d is not None):
+        h.update(f"{table}={digests[table]};".encode())
+    return h.hexdigest()
+
+
+def read_manifest(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(path, manifest):
+    # Write-then-rename so a crash never leaves a half-written manifest behind
+    tmp = f"{path}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def changed_tables(data_dir, tables, fmt="csv", manifest_path=None, digests=None):
+    """Tables whose files differ from the last recorded load, with their digests.
+
+    Tables with no files at all are never reported as changed. ``digests``
+    are the tables' digests when already computed.
+    """
+    manifest_path = manifest_path or os.path.join(data_dir, LOADED_MANIFEST)
+    loaded = read_manifest(manifest_path)
+    changed = {}
+    for table in tables:
+        digest = digests[table] if digests else table_digest(data_dir, table, fmt)
+        if digest is not None and loaded.get(table) != digest:
+            changed[table] = digest
+    return changed
+
+
+def record_loaded(data_dir, digests, manifest_path=None):
+    manifest_path = manifest_path or os.path.join(data_dir, LOADED_MANIFEST)
+    loaded = read_manifest(manifest_path)
+    loaded.update(digests)
+    write_manifest(manifest_path, loaded)
+
+
+def write_batch_manifest(data_dir, tables, fmt="csv", **info):
+    """Writes {data_dir}/batch.json: files, row counts and checksums per table.
+
+    ``info`` (generator, seed, ...) is recorded as given, to say how the batch
+    was made. Returns the manifest.
+    """
+    entries, digests = {}, {}
+    for table in tables:
+        files = table_files(data_dir, table, fmt)
+        if not files:
+            continue
+        digests[table] = table_digest(data_dir, table, fmt)
+        entries[table] = {
+            "digest": digests[table],
+            "rows": sum(file_rows(p) for p in files),
+            "files": {os.path.basename(p): {"sha256": file_digest(p), "bytes": os.path.getsize(p)}
+                      for p in files},
+        }
+    batch = {"batch_id": batch_id(digests), "format": fmt, **info, "tables": entries}
+    write_manifest(os.path.join(data_dir, BATCH_MANIFEST), batch)
+    return batch
+
+
+def read_batch_manifest(data_dir):
+    """The batch.json of ``data_dir``, or None for a batch without one."""
+    path = os.path.join(data_dir, BATCH_MANIFEST)
+    return read_manifest(path) if os.path.exists(path) else None
+
+
+def check_batch(data_dir, digests, fmt="csv"):
+    """Raises ValueError when files differ from what batch.json lists (a partial copy, an edit)."""
+    batch = read_batch_manifest(data_dir)
+    if batch is None or batch.get("format", fmt) != fmt:
+        return
+    listed = {t: e["digest"] for t, e in batch["tables"].items()}
+    found = {t: d for t, d in digests.items() if d is not None}
+    bad = sorted(t for t in set(listed) | set(found) if listed.get(t) != found.get(t))
+    if bad:
+        raise ValueError(f"{data_dir}: files do not match {BATCH_MANIFEST} for {bad}")
+
+
+if __name__ == "__main__":
+    import argparse
+    from pipeline_sql import RAW_TABLES
+
+    parser = argparse.ArgumentParser(description="Write batch.json for existing batch directories.")
+    parser.add_argument("batches", nargs="+")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    args = parser.parse_args()
+    for data_dir in args.batches:
+        batch = write_batch_manifest(data_dir, RAW_TABLES, args.format)
+        print(f"{data_dir}: batch {batch['batch_id']}")
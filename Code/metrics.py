@@ -0,0 +1,124 @@
+"""Stage metrics: durations, row counts and throughput, as JSON lines.
+
+Every record is one line in ECOM_METRICS_FILE:
+
+    {"ts": ..., "job": "local_run", "run": ..., "stage": "copy_orders",
+     "seconds": 0.41, "rows_loaded": 1000, "rows_per_sec": 2439.0}
+
+With ECOM_METRICS_PROM set, the latest value of every metric is also kept in
+a Prometheus textfile (node_exporter's textfile collector), one gauge per
+count: ecom_stage_seconds, ecom_stage_rows_loaded, ecom_stage_inserted, ...
+labelled with job and stage. Unset, nothing is written.
+
+Counts come from the statements' own results (statement_counts): COPY's
+rows_parsed/rows_loaded/errors_seen per file, MERGE's inserted/updated/deleted,
+or DuckDB's single affected-row count ("rows").
+"""
+import fcntl
+import json
+import os
+import re
+import sys
+import time
+from contextlib import contextmanager
+
+METRICS_FILE = os.environ.get("ECOM_METRICS_FILE", "")
+METRICS_PROM = os.environ.get("ECOM_METRICS_PROM", "")
+JOB = os.path.splitext(os.path.basename(sys.argv[0] or "python"))[0]
+
+# Result column (lower case) -> count it adds to
+RESULT_COUNTS = {
+    "rows_parsed": "rows_parsed",
+    "rows_loaded": "rows_loaded",
+    "errors_seen": "errors_seen",
+    "number of rows inserted": "inserted",
+    "number of rows updated": "updated",
+    "number of rows deleted": "deleted",
+    "count": "rows",
+}
+# Counts a rows_per_sec figure is derived from, first found wins
+THROUGHPUT_OF = ["rows_loaded", "rows", "inserted"]
+
+
+def statement_counts(cursor):
+    """Counts in the result of the statement ``cursor`` just ran ({} when it has none)."""
+    if not cursor.description:
+        return {}
+    names = [RESULT_COUNTS.get(d[0].lower()) for d in cursor.description]
+    counts = {}
+    for row in cursor.fetchall():
+        for name, value in zip(names, row):
+            if name and isinstance(value, int):
+                counts[name] = counts.get(name, 0) + value
+    return counts
+
+
+def add_counts(*counts):
+    total = {}
+    for c in counts:
+        for name, value in (c or {}).items():
+            total[name] = total.get(name, 0) + value
+    return total
+
+
+def record(stage, seconds=None, run=None, **counts):
+    """Writes one record for ``stage``; returns it."""
+    entry = {"ts": round(time.time(), 3), "job": JOB, "run": run, "stage": stage}
+    if seconds is not None:
+        entry["seconds"] = round(seconds, 6)
+    entry.update(counts)
+    rows = next((counts[c] for c in THROUGHPUT_OF if c in counts), None)
+    if seconds and rows is not None:
+        entry["rows_per_sec"] = round(rows / seconds, 1)
+    if METRICS_FILE:
+        with open(METRICS_FILE, "a") as f:
+            f.write(json.dumps(entry, default=str) + "\n")
+    if METRICS_PROM:
+        write_prometheus(METRICS_PROM, entry)
+    return entry
+
+
+@contextmanager
+def timed(stage, run=None, timings=None):
+    """Records the block's duration plus the counts it puts in the yielded dict.
+
+    With ``timings``, the duration is also kept there, under ``stage``.
+    """
+    counts = {}
+    start = time.perf_counter()
+    yield counts
+    seconds = time.perf_counter() - start
+    if timings is not None:
+        timings[stage] = seconds
+    record(stage, seconds, run, **counts)
+
+
+def prom_name(name):
+    return "ecom_stage_" + re.sub(r"[^a-zA-Z0-9_]", "_", name)
+
+
+def write_prometheus(path, entry):
+    # The textfile is its own state: read it, replace this stage's samples,
+    # write it back whole (renamed into place, so the collector never sees half
+    # a file). The lock serializes concurrent tasks and generator workers.
+    labels = f'{{job="{entry["job"]}",stage="{entry["stage"]}"}}'
+    with open(f"{path}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        samples = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    if line.strip() and not line.startswith("#"):
+                        key, value = line.rsplit(" ", 1)
+                        samples[key] = value.strip()
+        for name, value in entry.items():
+            if name not in ("ts", "job", "run", "stage") and isinstance(value, (int, float)):
+                samples[prom_name(name) + labels] = str(value)
+        lines = []
+        for metric in sorted({key.split("{")[0] for key in samples}):
+            lines.append(f"# TYPE {metric} gauge")
+            lines += [f"{key} {value}" for key, value in sorted(samples.items())
+                      if key.split("{")[0] == metric]
+        with open(f"{path}.tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(f"{path}.tmp", path)
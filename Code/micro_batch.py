@@ -0,0 +1,260 @@
+"""Continuous ingestion: load what lands in a directory, in micro-batches.
+
+A drop is a directory of table files with a batch.json, such as new_data.py
+writes (``--out landing/<name>``). batch.json is written last, so its presence
+marks the drop complete. The watcher polls the landing directory and collects
+complete drops into a micro-batch. The micro-batch closes once it holds
+``max_bytes``, or once its oldest drop has waited ``window`` seconds. It then
+runs through the incremental pipeline (local_run.run_pipeline). Delta tables
+are appended, and only the MERGEs that read them run: dim_date, the fact, and
+the daily aggregate. Fresh orders reach the fact a window after they land:
+
+    python micro_batch.py landing --db ecom.duckdb --window 2
+
+A micro-batch is built in ``{landing}/.batches/mb-<time>/``: every drop's files,
+hard-linked as part files ({table}-00000.csv, ...), and a batch.json that names
+the drops. Only then are the drops moved to ``{landing}/.loaded/``. After a
+crash, unfinished micro-batches are loaded again on start; the ETL ledger
+skips the stages they had committed. A drop with snapshot (non-delta) tables
+is loaded as a micro-batch of its own, since its tables are replaced rather
+than appended. A drop in another format goes to ``{landing}/.rejected/``, as
+does a drop whose order_ids overlap a drop waiting before it or orders already
+loaded (raw.orders, or at or below the fact watermark): appending it would
+attach its lines to other orders.
+"""
+import argparse
+import os
+import shutil
+import time
+
+import pandas as pd
+
+from backends import BACKENDS, make_backend
+from key_cache import read_table
+from local_run import run_pipeline
+from manifest import read_batch_manifest, table_files, write_batch_manifest
+from metrics import record
+from pipeline_sql import DELTA_TABLES, RAW_TABLES, loaded_orders_sql
+
+BATCHES_DIR = ".batches"
+LOADED_DIR = ".loaded"
+REJECTED_DIR = ".rejected"
+WINDOW = 2.0
+MAX_MB = 64
+POLL = 0.5
+
+
+def link(src, dst):
+    # Hard links cost nothing; a landing dir on another filesystem gets copies
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
+
+
+class Watcher:
+    def __init__(self, backend, landing, fmt="csv", window=WINDOW, max_bytes=MAX_MB << 20,
+                 **pipeline):
+        """``pipeline``: run_pipeline's manifest_path, clean_dir, key_cache_dir, ..."""
+        self.backend = backend
+        self.landing = landing
+        self.fmt = fmt
+        self.window = window
+        self.max_bytes = max_bytes
+        self.pipeline = pipeline
+        self.seen = {}
+        # (first, last) order_id of each drop waiting to load
+        self.orders = {}
+        for sub in (BATCHES_DIR, LOADED_DIR, REJECTED_DIR):
+            os.makedirs(os.path.join(landing, sub), exist_ok=True)
+
+    def path(self, *parts):
+        return os.path.join(self.landing, *parts)
+
+    def tables(self, drop):
+        return [t for t in RAW_TABLES if table_files(self.path(drop), t, self.fmt)]
+
+    def size(self, drop):
+        return sum(os.path.getsize(p) for t in self.tables(drop)
+                   for p in table_files(self.path(drop), t, self.fmt))
+
+    def order_range(self, drop):
+        """(first, last) order_id of the drop's orders, or None when it has none."""
+        ids = [pd.to_numeric(chunk["order_id"], errors="coerce").dropna()
+               for chunk in read_table(self.path(drop), "orders", self.fmt, ["order_id"])]
+        ids = pd.concat(ids) if ids else pd.Series(dtype=float)
+        return (int(ids.min()), int(ids.max())) if len(ids) else None
+
+    def overlap(self, drop):
+        """Why the drop's orders clash with earlier ones, or None."""
+        ids = self.order_range(drop)
+        if ids is None:
+            return None
+        first, last = ids
+        for other, (lo, hi) in self.orders.items():
+            if first <= hi and lo <= last:
+                return f"order_ids {first}-{last} overlap {other} ({lo}-{hi})"
+        loaded, watermark = self.backend.query(loaded_orders_sql(first, last))[0]
+        if loaded or first <= (watermark or 0):
+            return f"order_ids {first}-{last} are already loaded"
+        self.orders[drop] = ids
+        return None
+
+    def reject(self, drop, reason):
+        print(f"{drop}: {reason}; rejected")
+        os.replace(self.path(drop), self.path(REJECTED_DIR, drop))
+
+    def ready(self, now):
+        """Complete drops, oldest first; remembers when each was first seen.
+
+        A drop is checked for overlapping order_ids once, when first seen.
+        """
+        drops = []
+        for entry in sorted(os.scandir(self.landing), key=lambda e: e.name):
+            if entry.name.startswith(".") or not entry.is_dir():
+                continue
+            batch = read_batch_manifest(entry.path)
+            if batch is None:
+                continue
+            if batch.get("format", self.fmt) != self.fmt:
+                self.reject(entry.name, f"{batch['format']} drop, expected {self.fmt}")
+                continue
+            if entry.name not in self.seen:
+                reason = self.overlap(entry.name)
+                if reason:
+                    self.reject(entry.name, reason)
+                    continue
+            self.seen.setdefault(entry.name, now)
+            drops.append(entry.name)
+        return sorted(drops, key=lambda d: (self.seen[d], d))
+
+    def group(self, drops, now, flush=False):
+        """Micro-batches to load now, as lists of drops."""
+        batch, size = [], 0
+        for drop in drops:
+            if not set(self.tables(drop)) <= DELTA_TABLES:
+                if batch:
+                    yield batch
+                batch, size = [], 0
+                yield [drop]
+                continue
+            batch.append(drop)
+            size += self.size(drop)
+            if size >= self.max_bytes:
+                yield batch
+                batch, size = [], 0
+        if batch and (flush or now - self.seen[batch[0]] >= self.window):
+            yield batch
+
+    def build(self, drops):
+        """The micro-batch directory of ``drops``; the drops move to .loaded."""
+        name = f"mb-{time.time_ns()}"
+        tmp = self.path(BATCHES_DIR, f".tmp-{name}")
+        os.makedirs(tmp)
+        tables = [t for t in RAW_TABLES if any(t in self.tables(d) for d in drops)]
+        for table in tables:
+            paths = [p for d in drops for p in table_files(self.path(d), table, self.fmt)]
+            for part, path in enumerate(paths):
+                link(path, os.path.join(tmp, f"{table}-{part:05d}.{self.fmt}"))
+        write_batch_manifest(tmp, tables, self.fmt, generator="micro_batch.py", drops=drops)
+        os.replace(tmp, self.path(BATCHES_DIR, name))
+        for drop in drops:
+            os.replace(self.path(drop), self.path(LOADED_DIR, drop))
+        return self.path(BATCHES_DIR, name)
+
+    def pending(self):
+        """Micro-batches built but not loaded yet (a crash), oldest first.
+
+        Drops such a batch already holds, but that were not moved yet, are moved now.
+        """
+        batches = sorted(e.path for e in os.scandir(self.path(BATCHES_DIR))
+                         if e.is_dir() and e.name.startswith("mb-"))
+        for batch in batches:
+            for drop in read_batch_manifest(batch)["drops"]:
+                if os.path.isdir(self.path(drop)):
+                    os.replace(self.path(drop), self.path(LOADED_DIR, drop))
+        for tmp in os.scandir(self.path(BATCHES_DIR)):
+            if tmp.name.startswith(".tmp-"):
+                shutil.rmtree(tmp.path)
+        return batches
+
+    def load(self, batch_dir, landed=None):
+        start = time.perf_counter()
+        run_pipeline(self.backend, batch_dir, self.fmt, "incremental", **self.pipeline)
+        drops = read_batch_manifest(batch_dir)["drops"]
+        shutil.rmtree(batch_dir)
+        seconds = time.perf_counter() - start
+        counts = {"drops": len(drops)}
+        if landed is not None:
+            # From the oldest drop first being seen to its rows being in the fact
+            counts["lag_seconds"] = round(time.time() - landed, 3)
+        record("micro_batch", seconds, os.path.basename(batch_dir), **counts)
+        print(f"{os.path.basename(batch_dir)}: {len(drops)} drops loaded in {seconds:.3f}s")
+
+    def poll(self, flush=False):
+        """Loads every micro-batch that is due; returns how many."""
+        now = time.time()
+        loaded = 0
+        for drops in list(self.group(self.ready(now), now, flush)):
+            landed = min(self.seen.pop(d) for d in drops)
+            for drop in drops:
+                self.orders.pop(drop, None)
+            self.load(self.build(drops), landed)
+            loaded += 1
+        return loaded
+
+    def run(self, poll=POLL, once=False):
+        """Watches until interrupted; with ``once``, loads what is there and returns."""
+        for batch in self.pending():
+            self.load(batch)
+        if once:
+            self.poll(flush=True)
+            return
+        print(f"watching {self.landing} (window {self.window}s, {self.max_bytes >> 20} MB)")
+        while True:
+            if not self.poll():
+                time.sleep(poll)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load drops from a landing directory in micro-batches.")
+    parser.add_argument("landing", help="directory the drops (new_data.py --out) land in")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="duckdb")
+    parser.add_argument("--db", default=None,
+                        help="DuckDB database file (default: in memory) or Snowflake conn id")
+    parser.add_argument("--init", action="store_true",
+                        help="create the raw/dwh schemas from snowflake.sql first")
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--window", type=float, default=WINDOW,
+                        help="seconds a drop may wait for others to join its micro-batch")
+    parser.add_argument("--max-mb", type=float, default=MAX_MB,
+                        help="micro-batch size that is loaded without waiting")
+    parser.add_argument("--poll", type=float, default=POLL, help="seconds between scans")
+    parser.add_argument("--once", action="store_true", help="load what has landed, then exit")
+    parser.add_argument("--manifest", default=None,
+                        help="load manifest (default: next to the database file, as local_run.py)")
+    parser.add_argument("--clean-dir", default=None,
+                        help="clean files, whose parent keys drops are checked against "
+                             "(default: next to the database file, as local_run.py)")
+    parser.add_argument("--preresolve", action="store_true",
+                        help="resolve fact keys from a cached key map and append the fact")
+    args = parser.parse_args()
+
+    persistent = args.backend == "duckdb" and args.db not in (None, ":memory:")
+    state = args.db if persistent else os.path.join(args.landing, BATCHES_DIR, "local")
+    with make_backend(args.backend, args.db) as backend:
+        if args.init:
+            backend.init_schema()
+        watcher = Watcher(backend, args.landing, args.format, args.window,
+                          int(args.max_mb * (1 << 20)),
+                          manifest_path=args.manifest or f"{state}.manifest.json",
+                          clean_dir=args.clean_dir or f"{state}.clean",
+                          key_cache_dir=f"{state}.keys" if args.preresolve else None)
+        try:
+            watcher.run(args.poll, args.once)
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == "__main__":
+    main()
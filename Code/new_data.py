@@ -1,98 +1,122 @@
+import argparse
+import os
 import pandas as pd
 import numpy as np
-import random
-from datetime import datetime, timedelta
+from datetime import datetime
+from manifest import read_batch_manifest, table_files, write_batch_manifest
+from writers import WRITERS, chunks, make_writer
 
+NUM_NEW_ORDERS = 3500       # Number of new orders to generate
+MAX_ITEMS_PER_ORDER = 5
+CHUNK_ROWS = 500_000        # orders generated and written at once
+PAYMENT_METHODS = np.array(["Visa", "Mastercard", "Stripe", "PayPal"])
 
-# Load existing dimension files
-df_products         = pd.read_csv("products.csv")
-df_customers        = pd.read_csv("customers.csv")
-df_shippers         = pd.read_csv("shippers.csv")
-df_statuses         = pd.read_csv("order_statuses.csv")
-df_addresses        = pd.read_csv("addresses.csv")
+parser = argparse.ArgumentParser(description="Generate an incremental batch of orders.")
+parser.add_argument("--orders", type=int, default=NUM_NEW_ORDERS, help="number of new orders")
+parser.add_argument("--in", dest="in_dir", default=".", help="directory with the current batch")
+parser.add_argument("--out", default="new", help="output directory")
+parser.add_argument("--after", nargs="*", default=[],
+                    help="earlier drops whose order and payment ids this one continues")
+parser.add_argument("--seed", type=int, default=None)
+parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+parser.add_argument("--format", choices=sorted(WRITERS), default="csv", help="output file format")
+args = parser.parse_args()
 
-# Load existing raw files to determine max keys
-df_existing_orders  = pd.read_csv("orders.csv")
-df_existing_items   = pd.read_csv("order_items.csv")
-df_existing_payments= pd.read_csv("payments.csv")
 
-max_order_id   = df_existing_orders["order_id"].max()
-max_payment_id = df_existing_payments["payment_id"].max()
+def read(table, usecols=None, data_dir=None):
+    # Every part file of the table, as one frame, in the format named in the
+    # directory's batch.json (--format when it has none)
+    data_dir = data_dir or args.in_dir
+    batch = read_batch_manifest(data_dir)
+    fmt = batch["format"] if batch else args.format
+    files = table_files(data_dir, table, fmt)
+    if not files:
+        raise FileNotFoundError(os.path.join(data_dir, f"{table}.{fmt}"))
+    if fmt == "parquet":
+        parts = (pd.read_parquet(p, columns=usecols) for p in files)
+    else:
+        parts = (pd.read_csv(p, usecols=usecols) for p in files)
+    return pd.concat(parts, ignore_index=True)
 
-NUM_NEW_ORDERS = 3500       # Number of new orders to generate
 
-# 1) Generate new orders
-new_orders = []
-for i in range(NUM_NEW_ORDERS):
-    oid = int(max_order_id + i + 1)
-    cid = int(df_customers.sample(1)["customer_id"])  # random customer
-    sid = int(df_statuses.sample(1)["order_status_id"])  # random status
-    shid = int(df_shippers.sample(1)["shipper_id"])
-    # choose any address id for the customer
-    aid = np.random.choice(df_addresses["address_id"], 1)[0]
-    # random order date within last 2 days
-    od = (datetime.now().date() - timedelta(days=random.randint(0,365)))
-    new_orders.append({
-        "order_id": oid,
-        "customer_id": cid,
-        "order_status_id": sid,
-        "ship_address_id": aid,
-        "shipper_id": shid,
-        "order_date": od,
-        "total_amount": 0  # placeholder
-    })
+# Load existing dimension files (only the columns we draw from)
+df_products  = read("products")
+customer_ids = read("customers", usecols=["customer_id"])["customer_id"].values
+shipper_ids  = read("shippers", usecols=["shipper_id"])["shipper_id"].values
+status_ids   = read("order_statuses", usecols=["order_status_id"])["order_status_id"].values
+address_ids  = read("addresses", usecols=["address_id"])["address_id"].values
+
+product_ids = df_products["product_id"].values
+price_col = next((c for c in ("base_price", "unit_price") if c in df_products.columns), None)
+product_prices = df_products[price_col].to_numpy(float) if price_col else np.zeros(len(df_products))
+
+# Load existing raw files, and the earlier drops', to determine max keys
+max_order_id = max(read("orders", ["order_id"], d)["order_id"].max()
+                   for d in [args.in_dir] + args.after)
+max_payment_id = max(read("payments", ["payment_id"], d)["payment_id"].max()
+                     for d in [args.in_dir] + args.after)
+
+rng = np.random.default_rng(args.seed)
+today = np.datetime64(datetime.now().date(), "D")
+
 
-df_new_orders = pd.DataFrame(new_orders)
-
-# 2) Generate order_items and compute totals
-new_items = []
-for idx, row in df_new_orders.iterrows():
-    oid = row["order_id"]
-    n_items = random.randint(1,5)
-    total = 0.0
-    for _ in range(n_items):
-        prod = df_products.sample(1).iloc[0]
-        pid = int(prod["product_id"])
-        price = float(prod.get("base_price", prod.get("unit_price", 0)))
-        qty = random.randint(1,10)
-        new_items.append({
-            "order_id": oid,
-            "product_id": pid,
-            "quantity": qty,
-            "unit_price": price
-        })
-        total += qty * price
-    df_new_orders.at[idx, "total_amount"] = total
-
-df_new_items = pd.DataFrame(new_items)
-
-# 3) Generate payments for each new order
-new_payments = []
-for i, row in df_new_orders.iterrows():
-    pid = int(max_payment_id + i + 1)
-    oid = row["order_id"]
-    pmeth = random.choice(["Visa", "Mastercard", "Stripe", "PayPal"])
-    pdate = row["order_date"] + timedelta(days=random.randint(0,1))
-    amt = row["total_amount"]
-    stat = "Captured"
-    new_payments.append({
-        "payment_id": pid,
-        "order_id": oid,
-        "payment_method": pmeth,
-        "payment_date": pdate,
-        "amount": amt,
-        "status": stat
+def gen_batch(start, stop):
+    """Orders [start, stop) of this delta, with their items and payments, as arrays."""
+    n = stop - start
+
+    # 1) New orders: every column drawn at once
+    order_ids = max_order_id + 1 + np.arange(start, stop)
+    order_dates = today - rng.integers(0, 366, n).astype("timedelta64[D]")
+
+    # 2) Order items: index products by position, so ids and prices come from the same draw
+    n_items = rng.integers(1, MAX_ITEMS_PER_ORDER + 1, n)
+    picked = rng.integers(0, len(product_ids), n_items.sum())
+    quantity = rng.integers(1, 11, len(picked))
+    unit_price = product_prices[picked]
+
+    # Segmented sum of line totals: one segment per order, no groupby
+    offsets = np.cumsum(n_items) - n_items
+    totals = np.round(np.add.reduceat(quantity * unit_price, offsets), 2)
+
+    orders = pd.DataFrame({
+        "order_id": order_ids,
+        "customer_id": rng.choice(customer_ids, n),
+        "order_status_id": rng.choice(status_ids, n),
+        "ship_address_id": rng.choice(address_ids, n),
+        "shipper_id": rng.choice(shipper_ids, n),
+        "order_date": order_dates,
+        "total_amount": totals,
+    })
+    items = pd.DataFrame({
+        "order_id": np.repeat(order_ids, n_items),
+        "product_id": product_ids[picked],
+        "quantity": quantity,
+        "unit_price": unit_price,
     })
 
-df_new_payments = pd.DataFrame(new_payments)
+    # 3) Payments from the same arrays
+    payments = pd.DataFrame({
+        "payment_id": max_payment_id + 1 + np.arange(start, stop),
+        "order_id": order_ids,
+        "payment_method": PAYMENT_METHODS[rng.integers(0, len(PAYMENT_METHODS), n)],
+        "payment_date": order_dates + rng.integers(0, 2, n).astype("timedelta64[D]"),
+        "amount": totals,
+        "status": "Captured",
+    })
+    return orders, items, payments
 
-# 4) Write out incremental CSVs
 
-df_new_orders.to_csv("new/orders.csv", index=False)
-df_new_items.to_csv("new/order_items.csv", index=False)
-df_new_payments.to_csv("new/payments.csv", index=False)
+# 4) Write out incremental files
+print(f"Generated incremental {args.format} files:")
+with make_writer(args.format, args.out) as out:
+    for lo, hi in chunks(args.orders, args.chunk_rows, start=0):
+        orders, items, payments = gen_batch(lo, hi)
+        out.write("orders", orders)
+        out.write("order_items", items)
+        out.write("payments", payments)
 
-print("Generated incremental CSVs:")
-print(f" - {len(df_new_orders)} orders")
-print(f" - {len(df_new_items)} order_items")
-print(f" - {len(df_new_payments)} payments")
+# 5) Batch manifest, naming the batch the new orders extend
+parent = read_batch_manifest(args.in_dir)
+write_batch_manifest(args.out, ["orders", "order_items", "payments"], args.format,
+                     generator="new_data.py", seed=args.seed, orders=args.orders,
+                     extends=parent["batch_id"] if parent else None)
@@ -0,0 +1,834 @@
+# SQL and load metadata shared by the Airflow DAG and anything else that runs the
+# pipeline. Kept free of Airflow imports.
+
+from manifest import batch_id, changed_tables, check_batch, table_digest
+
+# List of all 13 raw tables to load
+RAW_TABLES = [
+    "orders",
+    "order_items",
+    "products",
+    "product_categories",
+    "categories",
+    "customers",
+    "addresses",
+    "shippers",
+    "order_statuses",
+    "reviews",
+    "inventory",
+    "customer_wishlist",
+    "payments",
+]
+
+# PUT options and COPY file format per load format. Files are loaded after
+# cleanse.py has validated them against raw.* (bad rows are quarantined there),
+# so any row that still does not fit is a real error and aborts the COPY.
+FILE_FORMATS = {
+    "csv": {
+        "put_options": "",
+        "copy_options": """FILE_FORMAT=(
+  TYPE = 'CSV',
+  SKIP_HEADER = 1,
+  FIELD_OPTIONALLY_ENCLOSED_BY = '"'
+)
+ON_ERROR = 'ABORT_STATEMENT'""",
+    },
+    "parquet": {
+        "put_options": " AUTO_COMPRESS = FALSE",
+        "copy_options": """FILE_FORMAT=(TYPE = 'PARQUET')
+MATCH_BY_COLUMN_NAME = CASE_INSENSITIVE
+ON_ERROR = 'ABORT_STATEMENT'""",
+    },
+}
+
+# Stage folder of the content-addressed uploads (staging.py)
+STAGE_PREFIX = "staged"
+# Stage folder of the split parts (splitter.py), one prefix per table
+SPLIT_PREFIX = "split"
+
+# Tables new_data.py produces as deltas: appended in incremental runs, not truncated
+DELTA_TABLES = {"orders", "order_items", "payments"}
+
+
+def plan_load(mode, data_dir, fmt="csv", manifest_path=None):
+    """Which raw tables a run loads: {"mode": ..., "changed": {table: digest}}.
+
+    Full runs (the default) reload every table; incremental runs only the tables
+    whose files changed since the last recorded load. The plan also carries the
+    batch's content id, which keys its stages in dwh.etl_ledger.
+    """
+    digests = {t: table_digest(data_dir, t, fmt) for t in RAW_TABLES}
+    check_batch(data_dir, digests, fmt)
+    if mode == "incremental":
+        changed = changed_tables(data_dir, RAW_TABLES, fmt, manifest_path, digests)
+    else:
+        changed = digests
+    return {"mode": mode, "changed": changed, "data_dir": data_dir, "batch_id": batch_id(digests)}
+
+
+def load_action(plan, table):
+    """"append", "replace", or None when the table is not loaded in this run."""
+    if table not in plan["changed"]:
+        return None
+    # Deltas are appended; everything else is a snapshot and replaces the table
+    if plan["mode"] == "incremental" and table in DELTA_TABLES:
+        return "append"
+    return "replace"
+
+
+def merge_needed(plan, merge):
+    return any(table in plan["changed"] for table in merge_inputs(merge))
+
+
+def load_stage(table):
+    # Ledger name of a raw table load (MERGE stages use their task id)
+    return f"load_{table}"
+
+
+def ledger_done_sql(batch):
+    return f"SELECT stage FROM dwh.etl_ledger WHERE batch_id = '{batch}';"
+
+
+def ledger_record_sql(batch, stage, data_dir):
+    return f"""
+INSERT INTO dwh.etl_ledger (batch_id, stage, data_dir, finished_at)
+SELECT '{batch}', '{stage}', '{data_dir}', CURRENT_TIMESTAMP
+WHERE NOT EXISTS (SELECT 1 FROM dwh.etl_ledger
+                  WHERE batch_id = '{batch}' AND stage = '{stage}');
+"""
+
+
+def ledger_last_loads_sql(batch):
+    # (stage, batch_id) of each table's latest load by another batch
+    return f"""
+SELECT stage, batch_id FROM dwh.etl_ledger
+WHERE stage LIKE 'load_%' AND batch_id <> '{batch}'
+QUALIFY ROW_NUMBER() OVER (PARTITION BY stage ORDER BY finished_at DESC) = 1;
+"""
+
+
+def loaded_orders_sql(first, last):
+    # Orders of [first, last] already in raw.orders, and the fact watermark
+    return f"""
+SELECT (SELECT COUNT(*) FROM raw.orders WHERE order_id BETWEEN {first} AND {last}),
+       (SELECT COALESCE(MAX(last_order_id), 0) FROM dwh.etl_watermark
+        WHERE source_name = 'fact_order_item');
+"""
+
+
+def with_ledger(sql, batch, stage, data_dir):
+    """``sql`` plus the ledger row of its stage, committed together.
+
+    ``sql`` that is already a BEGIN ... COMMIT list gets the row before its
+    COMMIT. A stage that fails leaves no row, so the next run redoes it.
+    """
+    record = ledger_record_sql(batch, stage, data_dir)
+    statements = [sql] if isinstance(sql, str) else list(sql)
+    if statements and statements[0].strip() == "BEGIN;" and statements[-1].strip() == "COMMIT;":
+        return statements[:-1] + [record, "COMMIT;"]
+    return ["BEGIN;"] + statements + [record, "COMMIT;"]
+
+
+def truncate_sql(table):
+    return f"TRUNCATE TABLE raw.{table};"
+
+
+def put_sql(table, fmt="csv", data_dir="/data", prefix=None):
+    # Stage file (or sharded part files: {table}-00000.csv, ...) into user stage.
+    # With ``prefix`` the table gets @~/{prefix}/{table}/ to itself, emptied first
+    put = f"OVERWRITE = TRUE{FILE_FORMATS[fmt]['put_options']};"
+    if prefix is None:
+        return f"PUT file://{data_dir}/{table}*.{fmt} @~/ {put}"
+    return [f"REMOVE @~/{prefix}/{table}/;",
+            f"PUT file://{data_dir}/{table}*.{fmt} @~/{prefix}/{table}/ {put}"]
+
+
+def copy_sql(table, fmt="csv", files=None, prefix=None):
+    # Copy staged file(s) into raw table: the ones put_sql uploaded (every file
+    # under ``prefix`` when given), or the content-addressed ``files`` staging.py
+    # uploaded under STAGE_PREFIX
+    if files is not None:
+        source = f"@~/{STAGE_PREFIX}/{table}/\nFILES = ({', '.join(repr(f) for f in files)})"
+    elif prefix is not None:
+        source = f"@~/{prefix}/{table}/"
+    else:
+        source = f"@~/\nPATTERN = '(.*/)?{table}(-[0-9]+)?[.]{fmt}([.]gz)?'"
+    return f"""
+COPY INTO raw.{table}
+FROM {source}
+{FILE_FORMATS[fmt]['copy_options']};
+"""
+
+
+# Type 2 dimensions: a change to any tracked attribute closes the current
+# version (effective_to, is_current) and opens a new one with its own surrogate
+# key. Changes are found by comparing one MD5 per row, computed from the
+# tracked attributes, with the row_hash stored on the current version.
+SCD2_TRACKED = {
+    "dwh.dim_product": ["sku", "name", "description", "base_price",
+                        "category_id", "category_name", "category_description"],
+    "dwh.dim_customer": ["first_name", "last_name", "email", "phone", "default_address_id",
+                         "default_city", "default_state", "default_country",
+                         "default_postal_code"],
+}
+# First versions are valid for every order; the current version until this date
+SCD2_FIRST_FROM = "1900-01-01"
+SCD2_OPEN_TO = "9999-12-31"
+
+
+def row_hash_sql(columns, alias=None):
+    """MD5 of ``columns`` as one expression; must match the initial build in snowflake.sql."""
+    prefix = f"{alias}." if alias else ""
+    values = ", ".join(f"COALESCE(CAST({prefix}{c} AS VARCHAR), '')" for c in columns)
+    return f"MD5(CONCAT_WS('|', {values}))"
+
+
+def scd2_merge(dim, natural, source, columns):
+    """One MERGE applying ``source`` (one row per ``natural`` id) to a Type 2 dimension.
+
+    Every source row is matched to the current version of its id; a changed
+    row closes it (WHEN MATCHED) and comes again, unmatched, to insert the new
+    version. Only the current versions of the ids in ``source`` are read.
+    """
+    insert = ", ".join(columns)
+    values = ", ".join(f"src.{c}" for c in columns)
+    return f"""
+MERGE INTO {dim} AS tgt
+USING (
+  WITH s AS (
+    SELECT {insert}, {row_hash_sql(SCD2_TRACKED[dim])} AS row_hash
+    FROM ({source}) src
+  )
+  SELECT s.*, s.{natural} AS merge_id, FALSE AS is_change FROM s
+  UNION ALL
+  SELECT s.*, NULL, TRUE
+  FROM s
+  JOIN {dim} cur ON cur.{natural} = s.{natural}
+               AND cur.is_current AND cur.row_hash <> s.row_hash
+) src
+ON tgt.{natural} = src.merge_id AND tgt.is_current
+WHEN MATCHED AND tgt.row_hash <> src.row_hash THEN
+  UPDATE SET is_current = FALSE, effective_to = CAST(CURRENT_TIMESTAMP AS TIMESTAMP)
+WHEN NOT MATCHED THEN
+  INSERT ({insert}, row_hash, effective_from, effective_to, is_current)
+  VALUES ({values}, src.row_hash,
+          CASE WHEN src.is_change THEN CAST(CURRENT_TIMESTAMP AS TIMESTAMP)
+               ELSE CAST('{SCD2_FIRST_FROM}' AS TIMESTAMP) END,
+          CAST('{SCD2_OPEN_TO}' AS TIMESTAMP), TRUE);
+"""
+
+
+DIM_PRODUCT_SOURCE = """
+  SELECT product_id, sku, name, description,
+         base_price, created_at, category_id,
+         category_name, category_description
+  FROM (
+    SELECT p.product_id, p.sku, p.name, p.description,
+           p.base_price, p.created_at,
+           pc.category_id, c.name        AS category_name,
+           c.description                 AS category_description,
+           ROW_NUMBER() OVER (
+             PARTITION BY p.product_id
+             ORDER BY pc.category_id
+           ) AS rn
+    FROM raw.products p
+    JOIN raw.product_categories pc USING(product_id)
+    JOIN raw.categories c         USING(category_id)
+  ) ranked
+  WHERE rn = 1
+"""
+
+DIM_PRODUCT_COLUMNS = ["product_id", "sku", "name", "description", "base_price", "created_at",
+                       "category_id", "category_name", "category_description"]
+
+MERGE_DIM_PRODUCT = scd2_merge("dwh.dim_product", "product_id", DIM_PRODUCT_SOURCE,
+                               DIM_PRODUCT_COLUMNS)
+
+DIM_CUSTOMER_SOURCE = """
+  SELECT customer_id, first_name, last_name, email,
+         phone, join_date, default_address_id,
+         default_city, default_state,
+         default_country, default_postal_code
+  FROM (
+    SELECT c.customer_id, c.first_name, c.last_name,
+           c.email, c.phone, c.date_joined      AS join_date,
+           a.address_id        AS default_address_id,
+           a.city              AS default_city,
+           a.state             AS default_state,
+           a.country           AS default_country,
+           a.postal_code       AS default_postal_code,
+           ROW_NUMBER() OVER (
+             PARTITION BY c.customer_id
+             ORDER BY a.is_default DESC NULLS LAST
+           ) AS rn
+    FROM raw.customers c
+    LEFT JOIN raw.addresses a ON c.customer_id = a.customer_id
+                            AND a.is_default = TRUE
+  ) filtered
+  WHERE rn = 1
+"""
+
+DIM_CUSTOMER_COLUMNS = ["customer_id", "first_name", "last_name", "email", "phone", "join_date",
+                        "default_address_id", "default_city", "default_state",
+                        "default_country", "default_postal_code"]
+
+MERGE_DIM_CUSTOMER = scd2_merge("dwh.dim_customer", "customer_id", DIM_CUSTOMER_SOURCE,
+                                DIM_CUSTOMER_COLUMNS)
+
+MERGE_DIM_SHIPPER = """
+MERGE INTO dwh.dim_shipper AS tgt
+USING (
+  SELECT shipper_id, name, phone, tracking_url_template
+  FROM raw.shippers
+) src
+ON tgt.shipper_id = src.shipper_id
+WHEN NOT MATCHED THEN
+  INSERT (shipper_id, name, phone, tracking_url_template)
+  VALUES (src.shipper_id, src.name, src.phone, src.tracking_url_template);
+"""
+
+MERGE_DIM_ORDER_STATUS = """
+MERGE INTO dwh.dim_order_status AS tgt
+USING (
+  SELECT order_status_id, status_name, description
+  FROM raw.order_statuses
+) src
+ON tgt.order_status_id = src.order_status_id
+WHEN NOT MATCHED THEN
+  INSERT (order_status_id, status_name, description)
+  VALUES (src.order_status_id, src.status_name, src.description);
+"""
+
+# Late-arriving or updated order lines at or below the watermark are re-merged
+# only when their order_date is within this many days of the newest loaded date
+LATE_ARRIVAL_DAYS = 7
+
+# Fact source rows joined to the watermark row; callers add the watermark filter.
+# Type 2 dimensions resolve to the version valid on the order date.
+FACT_ORDER_ITEM_SOURCE = """
+  SELECT o.order_id,
+         TO_NUMBER(TO_CHAR(o.order_date,'YYYYMMDD')) AS order_date_key,
+         dp.product_key, dc.customer_key,
+         ds.shipper_key, dos.status_key,
+         oi.quantity, oi.unit_price,
+         oi.quantity * oi.unit_price       AS extended_price
+  FROM raw.orders o
+  JOIN dwh.etl_watermark   wm  ON wm.source_name      = 'fact_order_item'
+  JOIN raw.order_items     oi  ON o.order_id = oi.order_id
+  JOIN dwh.dim_product     dp  ON dp.product_id       = oi.product_id
+                              AND o.order_date >= dp.effective_from
+                              AND o.order_date <  dp.effective_to
+  JOIN dwh.dim_customer    dc  ON dc.customer_id      = o.customer_id
+                              AND o.order_date >= dc.effective_from
+                              AND o.order_date <  dc.effective_to
+  JOIN dwh.dim_shipper     ds  ON ds.shipper_id       = o.shipper_id
+  JOIN dwh.dim_order_status dos ON dos.order_status_id = o.order_status_id
+"""
+
+# Late-arriving or updated rows at or below the watermark
+FACT_LATE_MERGE = f"""
+MERGE INTO dwh.fact_order_item AS tgt
+USING ({FACT_ORDER_ITEM_SOURCE}  WHERE o.order_id <= wm.last_order_id
+    AND o.order_date >= wm.last_order_date - {LATE_ARRIVAL_DAYS}
+) src
+ON tgt.order_id    = src.order_id
+AND tgt.product_key = src.product_key
+WHEN MATCHED AND (tgt.quantity <> src.quantity
+               OR tgt.unit_price <> src.unit_price
+               OR tgt.status_key <> src.status_key
+               OR tgt.shipper_key <> src.shipper_key) THEN
+  UPDATE SET quantity = src.quantity, unit_price = src.unit_price,
+             extended_price = src.extended_price, status_key = src.status_key,
+             shipper_key = src.shipper_key
+WHEN NOT MATCHED THEN
+  INSERT (order_id, order_date_key, product_key, customer_key,
+          shipper_key, status_key, quantity, unit_price, extended_price)
+  VALUES (src.order_id, src.order_date_key, src.product_key, src.customer_key,
+          src.shipper_key, src.status_key, src.quantity, src.unit_price, src.extended_price);
+"""
+
+# Order dates the fact build below is about to touch (new rows and the late
+# window), queued for the aggregate refresh
+FACT_TOUCHED_DATES = f"""
+INSERT INTO dwh.agg_pending_dates (date_key)
+SELECT DISTINCT TO_NUMBER(TO_CHAR(o.order_date,'YYYYMMDD'))
+FROM raw.orders o
+JOIN dwh.etl_watermark wm ON wm.source_name = 'fact_order_item'
+WHERE o.order_id > wm.last_order_id
+   OR o.order_date >= wm.last_order_date - {LATE_ARRIVAL_DAYS};
+"""
+
+# Order lines above the watermark that another run already inserted; an order
+# held back by FACT_WATERMARK_UPDATE comes again, with its lines that did join
+FACT_NOT_LOADED = """
+  NOT EXISTS (SELECT 1 FROM dwh.fact_order_item f
+              WHERE f.order_id = {alias}.order_id AND f.product_key = {alias}.product_key)
+"""
+
+# The watermark stops below the first order above it with a line the dimension
+# joins dropped (fewer fact rows than raw.order_items lines), so that order is
+# INSERTed again by the next run. An order is only waited for while its
+# order_date is within LATE_ARRIVAL_DAYS of the newest one; older orders with
+# missing lines are passed and counted in dropped_orders. Without an order to
+# wait for, the watermark moves to the highest order_id now in the fact.
+FACT_WATERMARK_UPDATE = f"""
+UPDATE dwh.etl_watermark
+SET last_order_date = COALESCE(GREATEST(last_order_date, delta.max_date),
+                               last_order_date, delta.max_date),
+    last_order_id   = COALESCE(delta.first_held_id - 1,
+                               GREATEST(last_order_id, delta.max_loaded_id)),
+    dropped_orders  = COALESCE(dropped_orders, 0) + delta.passed_orders,
+    updated_at      = CURRENT_TIMESTAMP
+FROM (
+  SELECT MAX(order_date) AS max_date,
+         MIN(first_held_id) AS first_held_id,
+         MAX(CASE WHEN loaded THEN order_id END) AS max_loaded_id,
+         COUNT(CASE WHEN missing AND NOT recent
+                     AND (first_held_id IS NULL OR order_id < first_held_id) THEN 1 END)
+           AS passed_orders
+  FROM (
+    SELECT *, MIN(CASE WHEN missing AND recent THEN order_id END) OVER () AS first_held_id
+    FROM (
+      SELECT o.order_id, o.order_date,
+             COALESCE(f.lines, 0) < l.lines AS missing,
+             f.lines > 0 AS loaded,
+             o.order_date >= COALESCE(GREATEST(w.last_order_date, MAX(o.order_date) OVER ()),
+                                      MAX(o.order_date) OVER ()) - {LATE_ARRIVAL_DAYS} AS recent
+      FROM raw.orders o
+      JOIN dwh.etl_watermark w ON w.source_name = 'fact_order_item'
+      LEFT JOIN (SELECT oi.order_id, COUNT(*) AS lines
+                 FROM raw.order_items oi
+                 JOIN dwh.etl_watermark w ON w.source_name = 'fact_order_item'
+                 WHERE oi.order_id > w.last_order_id
+                 GROUP BY oi.order_id) l ON l.order_id = o.order_id
+      LEFT JOIN (SELECT fi.order_id, COUNT(*) AS lines
+                 FROM dwh.fact_order_item fi
+                 JOIN dwh.etl_watermark w ON w.source_name = 'fact_order_item'
+                 WHERE fi.order_id > w.last_order_id
+                 GROUP BY fi.order_id) f ON f.order_id = o.order_id
+      WHERE o.order_id > w.last_order_id
+    ) orders
+  ) held
+) delta
+WHERE source_name = 'fact_order_item';
+"""
+
+# Watermarked fact build, one transaction so the watermark only moves with the rows:
+#  1. order_ids above the watermark are new, or held back -> plain INSERT of
+#     the lines not in the fact yet
+#  2. rows at or below it (late or updated) -> MERGE, bounded by LATE_ARRIVAL_DAYS
+#  3. advance the watermark up to the first recent order with a line still missing
+# The order dates involved are queued for REFRESH_AGG_DAILY_SALES first.
+# New rows go in date order, to keep the fact clustered on order_date_key.
+MERGE_FACT_ORDER_ITEM = [
+    "BEGIN;",
+    FACT_TOUCHED_DATES,
+    f"""
+INSERT INTO dwh.fact_order_item
+  (order_id, order_date_key, product_key, customer_key,
+   shipper_key, status_key, quantity, unit_price, extended_price)
+SELECT order_id, order_date_key, product_key, customer_key,
+       shipper_key, status_key, quantity, unit_price, extended_price
+FROM ({FACT_ORDER_ITEM_SOURCE}  WHERE o.order_id > wm.last_order_id
+) src
+WHERE {FACT_NOT_LOADED.format(alias="src")}
+ORDER BY order_date_key;
+""",
+    FACT_LATE_MERGE,
+    FACT_WATERMARK_UPDATE,
+    "COMMIT;",
+]
+
+# Same build when key_cache.py has already resolved the new rows into
+# raw.fact_order_item_keyed: step 1 is a straight append, no dimension joins,
+# plus the join for orders still held back
+APPEND_FACT_ORDER_ITEM = [
+    "BEGIN;",
+    FACT_TOUCHED_DATES,
+    f"""
+INSERT INTO dwh.fact_order_item
+  (order_id, order_date_key, product_key, customer_key,
+   shipper_key, status_key, quantity, unit_price, extended_price)
+SELECT k.order_id, k.order_date_key, k.product_key, k.customer_key,
+       k.shipper_key, k.status_key, k.quantity, k.unit_price, k.extended_price
+FROM raw.fact_order_item_keyed k
+JOIN dwh.etl_watermark wm ON wm.source_name = 'fact_order_item'
+WHERE k.order_id > wm.last_order_id
+  AND {FACT_NOT_LOADED.format(alias="k")}
+ORDER BY k.order_date_key;
+""",
+    # Orders held back by an earlier run are not in this run's keyed files
+    f"""
+INSERT INTO dwh.fact_order_item
+  (order_id, order_date_key, product_key, customer_key,
+   shipper_key, status_key, quantity, unit_price, extended_price)
+SELECT order_id, order_date_key, product_key, customer_key,
+       shipper_key, status_key, quantity, unit_price, extended_price
+FROM ({FACT_ORDER_ITEM_SOURCE}  WHERE o.order_id > wm.last_order_id
+    AND o.order_id NOT IN (SELECT order_id FROM raw.fact_order_item_keyed)
+) src
+WHERE {FACT_NOT_LOADED.format(alias="src")}
+ORDER BY order_date_key;
+""",
+    FACT_LATE_MERGE,
+    FACT_WATERMARK_UPDATE,
+    "COMMIT;",
+]
+
+# Rebuild the aggregate for the queued order dates only: their rows are
+# replaced from the fact (clustered on order_date_key, so only those dates'
+# partitions are read), then the queue is cleared. One transaction, so a
+# failed refresh leaves the dates queued for the next run.
+REFRESH_AGG_DAILY_SALES = [
+    "BEGIN;",
+    """
+DELETE FROM dwh.agg_daily_sales
+WHERE date_key IN (SELECT date_key FROM dwh.agg_pending_dates);
+""",
+    """
+INSERT INTO dwh.agg_daily_sales
+  (date_key, category_id, category_name, shipper_key, status_key,
+   order_lines, quantity, extended_price, updated_at)
+SELECT f.order_date_key, dp.category_id, MAX(dp.category_name),
+       f.shipper_key, f.status_key,
+       COUNT(*), SUM(f.quantity), SUM(f.extended_price), CURRENT_TIMESTAMP
+FROM dwh.fact_order_item f
+JOIN dwh.dim_product dp ON dp.product_key = f.product_key
+WHERE f.order_date_key IN (SELECT date_key FROM dwh.agg_pending_dates)
+GROUP BY f.order_date_key, dp.category_id, f.shipper_key, f.status_key;
+""",
+    "DELETE FROM dwh.agg_pending_dates;",
+    "COMMIT;",
+]
+
+# Review and inventory-snapshot facts, rebuilt one date partition at a time:
+# the partitions a batch touches are queued in dwh.fact_pending_partitions,
+# deleted and inserted again from raw. Their per-product aggregates move by
+# the difference, the replaced rows subtracted before the delete and the new
+# ones added after the insert, so a run reads no more of a fact than the
+# partitions it replaces, and BI reads neither the facts nor raw.*.
+PENDING_PARTITIONS = "dwh.fact_pending_partitions"
+
+
+def pending_sql(fact):
+    return f"SELECT date_key FROM {PENDING_PARTITIONS} WHERE fact_name = '{fact}'"
+
+
+def partition_rebuild(fact, date_key, columns, source, queue, aggregate, after=()):
+    """One transaction replacing the partitions ``queue`` adds for ``fact``.
+
+    ``aggregate(sign)`` adds (1) or subtracts (-1) the fact rows of the queued
+    partitions to the fact's per-product aggregate.
+    """
+    names = ", ".join(columns)
+    return [
+        "BEGIN;",
+        queue,
+        aggregate(-1),
+        f"DELETE FROM dwh.{fact} WHERE {date_key} IN ({pending_sql(fact)});",
+        f"""
+INSERT INTO dwh.{fact} ({names})
+SELECT {names}
+FROM ({source}) src
+WHERE {date_key} IN ({pending_sql(fact)})
+ORDER BY {date_key};
+""",
+        aggregate(1),
+        *after,
+        f"DELETE FROM {PENDING_PARTITIONS} WHERE fact_name = '{fact}';",
+        "COMMIT;",
+    ]
+
+
+def signed_counts(sign, counts):
+    # "{sign} * <expr> AS <name>" select items
+    return ",\n         ".join(f"{sign} * {expr} AS {name}" for name, expr in counts.items())
+
+
+# Reviews; Type 2 dimensions resolve to the version valid on the review date
+FACT_REVIEW_SOURCE = """
+  SELECT r.review_id,
+         TO_NUMBER(TO_CHAR(r.review_date,'YYYYMMDD')) AS review_date_key,
+         dp.product_key, dc.customer_key, r.rating
+  FROM raw.reviews r
+  JOIN dwh.dim_product  dp ON dp.product_id  = r.product_id
+                          AND r.review_date >= dp.effective_from
+                          AND r.review_date <  dp.effective_to
+  JOIN dwh.dim_customer dc ON dc.customer_id = r.customer_id
+                          AND r.review_date >= dc.effective_from
+                          AND r.review_date <  dc.effective_to
+"""
+
+# raw.reviews is a snapshot; its watermark (last_review_id/last_review_date)
+# picks the partitions: the dates of new reviews, and every date within
+# LATE_ARRIVAL_DAYS of the newest, where reviews may still be edited or removed
+FACT_REVIEW_QUEUE = f"""
+INSERT INTO {PENDING_PARTITIONS} (fact_name, date_key)
+SELECT 'fact_review', TO_NUMBER(TO_CHAR(r.review_date,'YYYYMMDD'))
+FROM raw.reviews r
+JOIN dwh.etl_watermark wm ON wm.source_name = 'fact_review'
+WHERE r.review_id > wm.last_review_id
+   OR r.review_date >= wm.last_review_date - {LATE_ARRIVAL_DAYS}
+UNION
+SELECT 'fact_review', f.review_date_key
+FROM dwh.fact_review f
+JOIN dwh.etl_watermark wm ON wm.source_name = 'fact_review'
+WHERE f.review_date_key >= TO_NUMBER(TO_CHAR(wm.last_review_date - {LATE_ARRIVAL_DAYS},'YYYYMMDD'));
+"""
+
+FACT_REVIEW_WATERMARK_UPDATE = """
+UPDATE dwh.etl_watermark
+SET last_review_date = COALESCE(GREATEST(last_review_date, src.max_date),
+                                last_review_date, src.max_date),
+    last_review_id   = (SELECT COALESCE(MAX(review_id), 0) FROM dwh.fact_review),
+    updated_at      = CURRENT_TIMESTAMP
+FROM (SELECT MAX(review_date) AS max_date FROM raw.reviews) src
+WHERE source_name = 'fact_review';
+"""
+
+# agg_product_rating counts, from fact_review rows (f)
+RATING_COUNTS = {"review_count": "COUNT(*)", "rating_sum": "SUM(f.rating)",
+                 **{f"rating_{n}": f"SUM(CASE WHEN f.rating = {n} THEN 1 ELSE 0 END)"
+                    for n in range(1, 6)}}
+
+
+def product_rating_delta(sign):
+    counts = list(RATING_COUNTS)
+    return f"""
+MERGE INTO dwh.agg_product_rating AS tgt
+USING (
+  SELECT dp.product_id,
+         {signed_counts(sign, RATING_COUNTS)}
+  FROM dwh.fact_review f
+  JOIN dwh.dim_product dp ON dp.product_key = f.product_key
+  WHERE f.review_date_key IN ({pending_sql("fact_review")})
+  GROUP BY dp.product_id
+) src
+ON tgt.product_id = src.product_id
+WHEN MATCHED THEN
+  UPDATE SET {", ".join(f"{c} = tgt.{c} + src.{c}" for c in counts)},
+             avg_rating = CAST((tgt.rating_sum + src.rating_sum)
+                               / NULLIF(tgt.review_count + src.review_count, 0) AS NUMBER(4, 2)),
+             updated_at = CURRENT_TIMESTAMP
+WHEN NOT MATCHED THEN
+  INSERT (product_id, {", ".join(counts)}, avg_rating, updated_at)
+  VALUES (src.product_id, {", ".join(f"src.{c}" for c in counts)},
+          CAST(src.rating_sum / NULLIF(src.review_count, 0) AS NUMBER(4, 2)), CURRENT_TIMESTAMP);
+"""
+
+
+MERGE_FACT_REVIEW = partition_rebuild(
+    "fact_review", "review_date_key",
+    ["review_id", "review_date_key", "product_key", "customer_key", "rating"],
+    FACT_REVIEW_SOURCE, FACT_REVIEW_QUEUE, product_rating_delta,
+    after=[FACT_REVIEW_WATERMARK_UPDATE])
+
+# Inventory: one row per product and snapshot date. raw.inventory is one
+# snapshot, as of its newest last_updated, so each load replaces that date.
+INVENTORY_AS_OF = "SELECT MAX(last_updated) AS as_of FROM raw.inventory"
+
+FACT_INVENTORY_SNAPSHOT_SOURCE = f"""
+  SELECT snapshot_date_key, product_key, quantity_available, reorder_level, last_updated,
+         quantity_available <= 0             AS is_stock_out,
+         quantity_available <= reorder_level AS below_reorder
+  FROM (
+    SELECT TO_NUMBER(TO_CHAR(s.as_of,'YYYYMMDD')) AS snapshot_date_key, dp.product_key,
+           SUM(i.quantity_available) AS quantity_available,
+           SUM(i.reorder_level)      AS reorder_level,
+           MAX(i.last_updated)       AS last_updated
+    FROM raw.inventory i
+    CROSS JOIN ({INVENTORY_AS_OF}) s
+    JOIN dwh.dim_product dp ON dp.product_id = i.product_id
+                           AND s.as_of >= dp.effective_from
+                           AND s.as_of <  dp.effective_to
+    GROUP BY 1, 2
+  ) per_product
+"""
+
+FACT_INVENTORY_SNAPSHOT_QUEUE = f"""
+INSERT INTO {PENDING_PARTITIONS} (fact_name, date_key)
+SELECT 'fact_inventory_snapshot', TO_NUMBER(TO_CHAR(as_of,'YYYYMMDD'))
+FROM ({INVENTORY_AS_OF}) s
+WHERE as_of IS NOT NULL;
+"""
+
+# agg_product_stock counts, from fact_inventory_snapshot rows (f)
+STOCK_COUNTS = {"snapshot_days": "COUNT(*)",
+                "stock_out_days": "SUM(CASE WHEN f.is_stock_out THEN 1 ELSE 0 END)",
+                "below_reorder_days": "SUM(CASE WHEN f.below_reorder THEN 1 ELSE 0 END)"}
+# Latest-snapshot columns, kept from the newest partition added, and how the
+# queued partition's single row per product is picked (no MAX over BOOLEAN)
+STOCK_LATEST = ["quantity_available", "reorder_level", "is_stock_out"]
+STOCK_LATEST_SELECT = ["MAX(f.quantity_available) AS quantity_available",
+                       "MAX(f.reorder_level) AS reorder_level",
+                       "MAX(CASE WHEN f.is_stock_out THEN 1 ELSE 0 END) = 1 AS is_stock_out"]
+
+
+def product_stock_delta(sign):
+    # One partition at a time, so MAX picks each product's single queued row
+    counts = list(STOCK_COUNTS)
+    latest = ""
+    if sign > 0:
+        newer = "src.last_snapshot_date_key >= COALESCE(tgt.last_snapshot_date_key, 0)"
+        latest = "".join(f",\n             {c} = CASE WHEN {newer} THEN src.{c} ELSE tgt.{c} END"
+                         for c in ["last_snapshot_date_key"] + STOCK_LATEST)
+    return f"""
+MERGE INTO dwh.agg_product_stock AS tgt
+USING (
+  SELECT dp.product_id,
+         {signed_counts(sign, STOCK_COUNTS)},
+         MAX(f.snapshot_date_key) AS last_snapshot_date_key,
+         {", ".join(STOCK_LATEST_SELECT)}
+  FROM dwh.fact_inventory_snapshot f
+  JOIN dwh.dim_product dp ON dp.product_key = f.product_key
+  WHERE f.snapshot_date_key IN ({pending_sql("fact_inventory_snapshot")})
+  GROUP BY dp.product_id
+) src
+ON tgt.product_id = src.product_id
+WHEN MATCHED THEN
+  UPDATE SET {", ".join(f"{c} = tgt.{c} + src.{c}" for c in counts)}{latest},
+             updated_at = CURRENT_TIMESTAMP
+WHEN NOT MATCHED THEN
+  INSERT (product_id, {", ".join(counts)}, last_snapshot_date_key, {", ".join(STOCK_LATEST)},
+          updated_at)
+  VALUES (src.product_id, {", ".join(f"src.{c}" for c in counts)}, src.last_snapshot_date_key,
+          {", ".join(f"src.{c}" for c in STOCK_LATEST)}, CURRENT_TIMESTAMP);
+"""
+
+
+MERGE_FACT_INVENTORY_SNAPSHOT = partition_rebuild(
+    "fact_inventory_snapshot", "snapshot_date_key",
+    ["snapshot_date_key", "product_key", "quantity_available", "reorder_level", "last_updated",
+     "is_stock_out", "below_reorder"],
+    FACT_INVENTORY_SNAPSHOT_SOURCE, FACT_INVENTORY_SNAPSHOT_QUEUE, product_stock_delta)
+
+# Table the pre-resolved fact rows are loaded into
+KEYED_FACT_TABLE = "fact_order_item_keyed"
+
+# dim_date rows computed by calendar_dim.py for the dates the loaded facts
+# need, added to the dimension unless already there
+DATE_EXTENSION_TABLE = "dim_date_extension"
+DIM_DATE_COLUMNS = """date_key, actual_date, day_name, day_of_month, week, month, quarter, year,
+  is_weekend, fiscal_year, fiscal_quarter, is_holiday, holiday_name"""
+
+EXTEND_DIM_DATE = f"""
+INSERT INTO dwh.dim_date ({DIM_DATE_COLUMNS})
+SELECT {DIM_DATE_COLUMNS}
+FROM raw.{DATE_EXTENSION_TABLE} e
+WHERE NOT EXISTS (SELECT 1 FROM dwh.dim_date d WHERE d.date_key = e.date_key);
+"""
+
+# Snapshot tables can be loaded as change sets (snapshot_diff.py). The keys
+# that changed since the previous batch are loaded into raw.cdc_changes; the
+# table's rows with those keys are deleted and the changed rows COPYed in the
+# same transaction, and the Type 2 dimensions MERGE only the ids they feed.
+CDC_TABLE = "cdc_changes"
+
+
+def cdc_delete_sql(table, keys):
+    """Deletes the rows of ``table`` whose key (``keys`` columns) changed."""
+    match = " AND ".join(f"t.{key} = c.key{i}" for i, key in enumerate(keys, 1))
+    return (f"DELETE FROM raw.{table} t USING raw.{CDC_TABLE} c "
+            f"WHERE c.table_name = '{table}' AND {match};")
+
+
+def cdc_changed(*tables):
+    names = ", ".join(f"'{t}'" for t in tables)
+    return f"SELECT ref_id FROM raw.{CDC_TABLE} WHERE table_name IN ({names})"
+
+
+CDC_MERGES = {
+    "merge_dim_product": scd2_merge(
+        "dwh.dim_product", "product_id",
+        DIM_PRODUCT_SOURCE + f"""    AND (product_id IN ({cdc_changed("products", "product_categories")})
+         OR category_id IN ({cdc_changed("categories")}))
+""", DIM_PRODUCT_COLUMNS),
+    "merge_dim_customer": scd2_merge(
+        "dwh.dim_customer", "customer_id",
+        DIM_CUSTOMER_SOURCE + f"""    AND customer_id IN ({cdc_changed("customers", "addresses")})
+""", DIM_CUSTOMER_COLUMNS),
+}
+
+
+def merge_sql(merge, loaded, cdc_tables=()):
+    """The MERGE to run: the change-set form when every source loaded was a change set."""
+    if merge in CDC_MERGES and set(MERGE_SOURCES[merge]) & set(loaded) <= set(cdc_tables):
+        return CDC_MERGES[merge]
+    return MERGES[merge]
+
+
+# Raw tables each MERGE reads directly
+MERGE_SOURCES = {
+    "merge_dim_product": ["products", "product_categories", "categories"],
+    "merge_dim_customer": ["customers", "addresses"],
+    "merge_dim_shipper": ["shippers"],
+    "merge_dim_order_status": ["order_statuses"],
+    "merge_dim_date": ["orders", "reviews", "inventory"],
+    "merge_fact_order_item": ["orders", "order_items"],
+    "merge_agg_daily_sales": [],
+    "merge_fact_review": ["reviews"],
+    "merge_fact_inventory_snapshot": ["inventory"],
+}
+
+# MERGEs whose output another MERGE reads (the facts join their dimensions);
+# their inputs count as the reading MERGE's own
+MERGE_DEPENDS = {
+    "merge_fact_order_item": ["merge_dim_product", "merge_dim_customer",
+                              "merge_dim_shipper", "merge_dim_order_status"],
+    "merge_agg_daily_sales": ["merge_fact_order_item"],
+    "merge_fact_review": ["merge_dim_product", "merge_dim_customer"],
+    "merge_fact_inventory_snapshot": ["merge_dim_product"],
+}
+
+# MERGEs another one only has to run after: every fact's date keys need their
+# dim_date rows, but dim_date's sources are the facts' own (orders, reviews,
+# inventory), so an orders-only batch does not rebuild the other facts
+MERGE_AFTER = {
+    "merge_fact_order_item": ["merge_dim_date"],
+    "merge_fact_review": ["merge_dim_date"],
+    "merge_fact_inventory_snapshot": ["merge_dim_date"],
+}
+
+
+def merge_upstream(merge):
+    """MERGEs that run before ``merge``."""
+    return MERGE_DEPENDS.get(merge, []) + MERGE_AFTER.get(merge, [])
+
+
+def merge_order():
+    """MERGE names in dependency order (every MERGE after the ones it reads)."""
+    ordered = []
+
+    def visit(merge):
+        if merge not in ordered:
+            for upstream in merge_upstream(merge):
+                visit(upstream)
+            ordered.append(merge)
+    for merge in MERGES:
+        visit(merge)
+    return ordered
+
+
+def is_dimension(merge):
+    return merge.startswith("merge_dim_")
+
+
+def merge_inputs(merge):
+    """Every raw table a MERGE depends on, directly or through other MERGEs."""
+    tables = set(MERGE_SOURCES[merge])
+    for upstream in MERGE_DEPENDS.get(merge, []):
+        tables |= merge_inputs(upstream)
+    return tables
+
+
+MERGES = {
+    "merge_dim_product": MERGE_DIM_PRODUCT,
+    "merge_dim_customer": MERGE_DIM_CUSTOMER,
+    "merge_dim_shipper": MERGE_DIM_SHIPPER,
+    "merge_dim_order_status": MERGE_DIM_ORDER_STATUS,
+    "merge_dim_date": EXTEND_DIM_DATE,
+    "merge_fact_order_item": MERGE_FACT_ORDER_ITEM,
+    "merge_agg_daily_sales": REFRESH_AGG_DAILY_SALES,
+    "merge_fact_review": MERGE_FACT_REVIEW,
+    "merge_fact_inventory_snapshot": MERGE_FACT_INVENTORY_SNAPSHOT,
+}
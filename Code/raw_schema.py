@@ -0,0 +1,135 @@
+# Column layout of the raw.* landing tables, mirroring snowflake.sql.
+# Order matters: CSV COPY is positional, so files must follow it too.
+RAW_SCHEMA = {
+    "orders": [
+        ("order_id", "INT"),
+        ("customer_id", "INT"),
+        ("order_status_id", "INT"),
+        ("ship_address_id", "INT"),
+        ("shipper_id", "INT"),
+        ("order_date", "DATE"),
+        ("total_amount", "NUMBER(12,2)"),
+    ],
+    "order_items": [
+        ("order_id", "INT"),
+        ("product_id", "INT"),
+        ("quantity", "INT"),
+        ("unit_price", "NUMBER(12,2)"),
+    ],
+    "products": [
+        ("product_id", "INT"),
+        ("name", "VARCHAR"),
+        ("description", "TEXT"),
+        ("sku", "VARCHAR"),
+        ("base_price", "NUMBER(12,2)"),
+        ("created_at", "TIMESTAMP"),
+    ],
+    "product_categories": [
+        ("product_id", "INT"),
+        ("category_id", "INT"),
+    ],
+    "categories": [
+        ("category_id", "INT"),
+        ("name", "VARCHAR"),
+        ("description", "TEXT"),
+    ],
+    "customers": [
+        ("customer_id", "INT"),
+        ("first_name", "VARCHAR"),
+        ("last_name", "VARCHAR"),
+        ("email", "VARCHAR"),
+        ("phone", "VARCHAR"),
+        ("date_joined", "DATE"),
+    ],
+    "addresses": [
+        ("address_id", "INT"),
+        ("customer_id", "INT"),
+        ("line1", "VARCHAR"),
+        ("line2", "VARCHAR"),
+        ("city", "VARCHAR"),
+        ("state", "VARCHAR"),
+        ("postal_code", "VARCHAR"),
+        ("country", "VARCHAR"),
+        ("is_default", "BOOLEAN"),
+    ],
+    "shippers": [
+        ("shipper_id", "INT"),
+        ("name", "VARCHAR"),
+        ("phone", "VARCHAR"),
+        ("tracking_url_template", "VARCHAR"),
+    ],
+    "order_statuses": [
+        ("order_status_id", "INT"),
+        ("status_name", "VARCHAR"),
+        ("description", "TEXT"),
+    ],
+    "reviews": [
+        ("review_id", "INT"),
+        ("product_id", "INT"),
+        ("customer_id", "INT"),
+        ("rating", "INT"),
+        ("review_text", "TEXT"),
+        ("review_date", "DATE"),
+    ],
+    "inventory": [
+        ("inventory_id", "INT"),
+        ("product_id", "INT"),
+        ("quantity_available", "INT"),
+        ("reorder_level", "INT"),
+        ("last_updated", "TIMESTAMP"),
+    ],
+    "customer_wishlist": [
+        ("customer_id", "INT"),
+        ("product_id", "INT"),
+        ("added_at", "TIMESTAMP"),
+    ],
+    "payments": [
+        ("payment_id", "INT"),
+        ("order_id", "INT"),
+        ("payment_method", "VARCHAR"),
+        ("payment_date", "DATE"),
+        ("amount", "NUMBER(12,2)"),
+        ("status", "VARCHAR"),
+    ],
+    # Fact rows with their surrogate keys already resolved (key_cache.py)
+    "fact_order_item_keyed": [
+        ("order_id", "INT"),
+        ("order_date_key", "INT"),
+        ("product_key", "INT"),
+        ("customer_key", "INT"),
+        ("shipper_key", "INT"),
+        ("status_key", "INT"),
+        ("quantity", "INT"),
+        ("unit_price", "NUMBER(12,2)"),
+        ("extended_price", "NUMBER(12,2)"),
+    ],
+    # Missing dwh.dim_date rows (calendar_dim.py)
+    "dim_date_extension": [
+        ("date_key", "INT"),
+        ("actual_date", "DATE"),
+        ("day_name", "VARCHAR"),
+        ("day_of_month", "INT"),
+        ("week", "INT"),
+        ("month", "INT"),
+        ("quarter", "INT"),
+        ("year", "INT"),
+        ("is_weekend", "BOOLEAN"),
+        ("fiscal_year", "INT"),
+        ("fiscal_quarter", "INT"),
+        ("is_holiday", "BOOLEAN"),
+        ("holiday_name", "VARCHAR"),
+    ],
+    # Keys a snapshot diff found changed (snapshot_diff.py): op I/U/D, the row's
+    # key (key2 for two-column keys) and the dimension id it feeds
+    "cdc_changes": [
+        ("table_name", "VARCHAR"),
+        ("op", "VARCHAR"),
+        ("key1", "INT"),
+        ("key2", "INT"),
+        ("ref_id", "INT"),
+    ],
+}
+
+
+def columns(table):
+    return [name for name, _ in RAW_SCHEMA[table]]
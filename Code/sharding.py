@@ -0,0 +1,25 @@
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+def shard_seed(seed, table, shard):
+    # Entropy for one shard; depends only on (seed, table, shard), never on the worker
+    return [seed, zlib.crc32(table.encode()), shard]
+
+
+def int_seed(seed, table, shard):
+    # Same derivation folded into one int, for the stdlib random / Faker APIs
+    return zlib.crc32(f"{seed}:{table}:{shard}".encode())
+
+
+def run_shards(fn, tasks, workers=1, initializer=None, initargs=()):
+    """Runs ``fn(task)`` for every task, in a process pool when workers > 1.
+
+    Results come back in task order either way.
+    """
+    if workers <= 1:
+        if initializer:
+            initializer(*initargs)
+        return [fn(task) for task in tasks]
+    with ProcessPoolExecutor(workers, initializer=initializer, initargs=initargs) as pool:
+        return list(pool.map(fn, tasks))
@@ -0,0 +1,231 @@
+"""Change sets for snapshot tables: the rows a batch inserted, updated or deleted.
+
+Every table but the deltas (orders, order_items, payments) arrives as a full
+snapshot. diff_table compares a table's clean snapshot with the one loaded
+before it, by primary key (cleanse.RULES), without holding either in memory:
+
+1. Both snapshots are streamed in chunks. Each row is reduced to its key, the
+   dimension id it feeds (REF_COLUMNS) and a 64-bit hash of its values. These
+   are spilled to disk in hash partitions of the key.
+2. Partition by partition, keys are matched. A new key is an insert, a key
+   with another hash an update, and a key that is gone a delete.
+3. The new snapshot is streamed once more, and its inserted and updated rows
+   are written out as they are, as {out}/{table}.<fmt>.
+
+The keys of all three go to {out}/cdc_changes.<fmt>, for raw.cdc_changes
+(pipeline_sql.CDC_TABLE). Loading a change set deletes the changed keys and
+COPYs the rows, so raw tables stay complete while only changes are moved:
+
+    python snapshot_diff.py --base Data/Batch1/clean --new Data/Batch2/clean --out changes
+
+SnapshotBase keeps the last loaded snapshot of each table to diff against.
+"""
+import argparse
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from cleanse import RULES, read_chunks
+from manifest import read_manifest, table_files, write_manifest
+from pipeline_sql import CDC_TABLE, DELTA_TABLES
+from raw_schema import columns
+from unique_keys import mix64
+from writers import make_writer
+
+CHUNK_ROWS = 200_000
+# Input bytes per spill partition; a partition's keys are matched in memory
+PARTITION_BYTES = 256 << 20
+MAX_PARTITIONS = 256
+# Dimension id a table's rows feed, when it is not the first key column
+REF_COLUMNS = {"addresses": "customer_id"}
+SPILL = np.dtype([("key1", "i8"), ("key2", "i8"), ("ref", "i8"), ("hash", "u8"), ("row", "i8")])
+
+
+def snapshot_tables(tables):
+    return [t for t in tables if t not in DELTA_TABLES]
+
+
+def link_tables(src_dir, out_dir, tables, fmt="csv"):
+    """Links (copies across filesystems) to the files of ``tables``, to load them
+    whole from ``out_dir``, next to the change sets."""
+    os.makedirs(out_dir, exist_ok=True)
+    for table in tables:
+        for path in table_files(src_dir, table, fmt):
+            dst = os.path.join(out_dir, os.path.basename(path))
+            try:
+                os.link(path, dst)
+            except OSError:
+                shutil.copyfile(path, dst)
+
+
+def int_column(chunk, column):
+    return pd.to_numeric(chunk[column], errors="coerce").fillna(-1).to_numpy(np.int64)
+
+
+class Spill:
+    """Key, ref and row hash of every row of one snapshot, in hash partitions on disk."""
+
+    def __init__(self, work, side, partitions):
+        self.paths = [os.path.join(work, f"{side}-{p:03d}.bin") for p in range(partitions)]
+        self.files = [open(p, "wb") for p in self.paths]
+
+    def add(self, table, chunk, first_row):
+        keys = RULES[table]["key"]
+        cols = columns(table)
+        rows = np.zeros(len(chunk), SPILL)
+        rows["key1"] = int_column(chunk, keys[0])
+        if len(keys) > 1:
+            rows["key2"] = int_column(chunk, keys[1])
+        rows["ref"] = int_column(chunk, REF_COLUMNS.get(table, keys[0]))
+        rows["hash"] = pd.util.hash_pandas_object(chunk[cols], index=False).to_numpy()
+        rows["row"] = np.arange(first_row, first_row + len(chunk))
+        part = mix64(rows["key1"].astype(np.uint64) ^ mix64(rows["key2"].astype(np.uint64)))
+        part = (part % np.uint64(len(self.files))).astype(np.int64)
+        for p in np.unique(part):
+            rows[part == p].tofile(self.files[p])
+
+    def close(self):
+        for f in self.files:
+            f.close()
+
+    def partition(self, p):
+        return pd.DataFrame(np.fromfile(self.paths[p], SPILL))
+
+
+def spill(files, table, fmt, work, side, partitions, chunk_rows):
+    out = Spill(work, side, partitions)
+    n = 0
+    for path in files:
+        for chunk in read_chunks(path, table, fmt, chunk_rows):
+            out.add(table, chunk, n)
+            n += len(chunk)
+    out.close()
+    return out
+
+
+def write_rows(files, table, fmt, rows, out_dir, chunk_rows):
+    """Writes the rows of ``files`` at (sorted, global) positions ``rows``, as they are."""
+    n = 0
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        writer = None
+        for path in files:
+            source = pq.ParquetFile(path)
+            writer = writer or pq.ParquetWriter(os.path.join(out_dir, f"{table}.parquet"),
+                                                source.schema_arrow, compression="snappy")
+            for batch in source.iter_batches(batch_size=chunk_rows):
+                keep = np.isin(np.arange(n, n + batch.num_rows), rows)
+                writer.write_batch(batch.filter(keep))
+                n += batch.num_rows
+        writer.close()
+        return
+    with make_writer(fmt, out_dir) as out:
+        out.write(table, pd.DataFrame(columns=columns(table)))
+        for path in files:
+            for chunk in read_chunks(path, table, fmt, chunk_rows):
+                keep = np.isin(np.arange(n, n + len(chunk)), rows)
+                out.write(table, chunk.loc[keep, columns(table)])
+                n += len(chunk)
+
+
+def diff_table(base_dir, new_dir, out_dir, table, fmt="csv", chunk_rows=CHUNK_ROWS):
+    """Writes the table's inserted and updated rows to ``out_dir``; its cdc_changes rows."""
+    base_files, new_files = table_files(base_dir, table, fmt), table_files(new_dir, table, fmt)
+    size = sum(os.path.getsize(p) for p in base_files + new_files)
+    partitions = min(max(math.ceil(size / PARTITION_BYTES), 1), MAX_PARTITIONS)
+    changes, rows = [], []
+    with tempfile.TemporaryDirectory() as work:
+        base = spill(base_files, table, fmt, work, "base", partitions, chunk_rows)
+        new = spill(new_files, table, fmt, work, "new", partitions, chunk_rows)
+        for p in range(partitions):
+            both = new.partition(p).merge(base.partition(p), on=["key1", "key2"], how="outer",
+                                          suffixes=("", "_base"), indicator=True)
+            inserted = both[both["_merge"] == "left_only"]
+            deleted = both[both["_merge"] == "right_only"]
+            updated = both[(both["_merge"] == "both") & (both["hash"] != both["hash_base"])]
+            # An update that moves a row to another dimension id changes both ids
+            moved = updated[updated["ref"] != updated["ref_base"]]
+            for op, part, ref in [("I", inserted, "ref"), ("U", updated, "ref"),
+                                  ("U", moved, "ref_base"), ("D", deleted, "ref_base")]:
+                changes.append(pd.DataFrame({"op": op, "key1": part["key1"],
+                                             "key2": part["key2"], "ref_id": part[ref]}))
+            rows.append(inserted["row"].to_numpy(np.int64))
+            rows.append(updated["row"].to_numpy(np.int64))
+    os.makedirs(out_dir, exist_ok=True)
+    write_rows(new_files, table, fmt, np.sort(np.concatenate(rows)), out_dir, chunk_rows)
+
+    changes = pd.concat(changes, ignore_index=True).astype({"key1": "int64", "ref_id": "int64"})
+    changes.insert(0, "table_name", table)
+    changes["key2"] = changes["key2"].astype("int64").astype("Int64")
+    if len(RULES[table]["key"]) == 1:
+        changes["key2"] = pd.NA
+    return changes[columns(CDC_TABLE)]
+
+
+def diff_batch(base_dir, new_dir, out_dir, tables, fmt="csv", chunk_rows=CHUNK_ROWS):
+    """Change sets of ``tables`` in ``out_dir``, with one cdc_changes file for them all.
+
+    Returns {table: {"inserted": n, "updated": n, "deleted": n}}.
+    """
+    changes = [diff_table(base_dir, new_dir, out_dir, t, fmt, chunk_rows) for t in tables]
+    changes = pd.concat(changes, ignore_index=True) if changes else \
+        pd.DataFrame(columns=columns(CDC_TABLE))
+    with make_writer(fmt, out_dir) as out:
+        out.write(CDC_TABLE, changes)
+    counts = {}
+    for table in tables:
+        ops = changes[changes["table_name"] == table].drop_duplicates(["op", "key1", "key2"])["op"]
+        counts[table] = {"inserted": int((ops == "I").sum()), "updated": int((ops == "U").sum()),
+                         "deleted": int((ops == "D").sum())}
+        print(f"{table}: {counts[table]['inserted']} inserted, {counts[table]['updated']} updated, "
+              f"{counts[table]['deleted']} deleted")
+    return counts
+
+
+class SnapshotBase:
+    """The last loaded clean snapshot of each table, and the batch it came from."""
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, "base.json")
+
+    def batches(self):
+        return read_manifest(self.manifest_path)
+
+    def save(self, tables, clean_dir, batch, fmt="csv"):
+        """Makes the clean files of ``tables`` the base; call once the batch is loaded."""
+        os.makedirs(self.root, exist_ok=True)
+        batches = self.batches()
+        for table in tables:
+            for path in table_files(self.root, table, fmt):
+                os.remove(path)
+            for path in table_files(clean_dir, table, fmt):
+                shutil.copyfile(path, os.path.join(self.root, os.path.basename(path)))
+            batches[table] = batch
+        write_manifest(self.manifest_path, batches)
+
+    def usable(self, tables, last_loaded):
+        """Tables whose base is what the warehouse holds: the batch that last loaded them.
+
+        ``last_loaded``: {table: batch id of its last load} (pipeline_sql.ledger_last_loads_sql).
+        """
+        batches = self.batches()
+        return [t for t in tables if t in batches and batches[t] == last_loaded.get(t)]
+
+
+if __name__ == "__main__":
+    from pipeline_sql import RAW_TABLES
+
+    parser = argparse.ArgumentParser(description="Diff snapshot tables against an earlier batch.")
+    parser.add_argument("tables", nargs="*", help="tables to diff (default: every snapshot table)")
+    parser.add_argument("--base", required=True, help="clean files of the earlier batch")
+    parser.add_argument("--new", required=True, help="clean files of this batch")
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    args = parser.parse_args()
+    diff_batch(args.base, args.new, args.out, args.tables or snapshot_tables(RAW_TABLES),
+               args.format)
@@ -151,13 +151,61 @@ TABLE raw.payments (
     status VARCHAR
 );
 
+-- fact rows keyed outside the warehouse (optional pre-resolution stage)
+CREATE
+OR
+REPLACE
+TABLE raw.fact_order_item_keyed (
+    order_id INT,
+    order_date_key INT,
+    product_key INT,
+    customer_key INT,
+    shipper_key INT,
+    status_key INT,
+    quantity INT,
+    unit_price NUMBER (12, 2),
+    extended_price NUMBER (12, 2)
+);
+
+-- missing dim_date rows, computed outside the warehouse (calendar_dim.py)
+CREATE
+OR
+REPLACE
+TABLE raw.dim_date_extension (
+    date_key INT,
+    actual_date DATE,
+    day_name VARCHAR,
+    day_of_month INT,
+    week INT,
+    month INT,
+    quarter INT,
+    year INT,
+    is_weekend BOOLEAN,
+    fiscal_year INT,
+    fiscal_quarter INT,
+    is_holiday BOOLEAN,
+    holiday_name VARCHAR
+);
+
+-- rows a snapshot changed since the previous batch (snapshot_diff.py)
+CREATE
+OR
+REPLACE
+TABLE raw.cdc_changes (
+    table_name VARCHAR,
+    op VARCHAR,
+    key1 INT,
+    key2 INT,
+    ref_id INT
+);
+
 -- Star Schema
 CREATE
 OR
 REPLACE
 TABLE dwh.dim_product (
     product_key INT IDENTITY PRIMARY KEY,
-    product_id INT UNIQUE,
+    product_id INT, -- one row per version (Type 2)
     sku VARCHAR,
     name VARCHAR,
     description TEXT,
@@ -165,7 +213,11 @@ TABLE dwh.dim_product (
     created_at TIMESTAMP,
     category_id INT,
     category_name VARCHAR,
-    category_description TEXT
+    category_description TEXT,
+    row_hash VARCHAR, -- MD5 of the tracked attributes (pipeline_sql.SCD2_TRACKED)
+    effective_from TIMESTAMP DEFAULT '1900-01-01',
+    effective_to TIMESTAMP DEFAULT '9999-12-31',
+    is_current BOOLEAN DEFAULT TRUE
 );
 
 CREATE
@@ -173,7 +225,7 @@ OR
 REPLACE
 TABLE dwh.dim_customer (
     customer_key INT IDENTITY PRIMARY KEY,
-    customer_id INT UNIQUE,
+    customer_id INT, -- one row per version (Type 2)
     first_name VARCHAR,
     last_name VARCHAR,
     email VARCHAR,
@@ -183,7 +235,11 @@ TABLE dwh.dim_customer (
     default_city VARCHAR,
     default_state VARCHAR,
     default_country VARCHAR,
-    default_postal_code VARCHAR
+    default_postal_code VARCHAR,
+    row_hash VARCHAR, -- MD5 of the tracked attributes (pipeline_sql.SCD2_TRACKED)
+    effective_from TIMESTAMP DEFAULT '1900-01-01',
+    effective_to TIMESTAMP DEFAULT '9999-12-31',
+    is_current BOOLEAN DEFAULT TRUE
 );
 
 CREATE
@@ -198,7 +254,11 @@ TABLE dwh.dim_date (
     month INT,
     quarter INT,
     year INT,
-    is_weekend BOOLEAN
+    is_weekend BOOLEAN,
+    fiscal_year INT,
+    fiscal_quarter INT,
+    is_holiday BOOLEAN,
+    holiday_name VARCHAR
 );
 
 CREATE
@@ -237,8 +297,136 @@ TABLE dwh.fact_order_item (
     quantity INT,
     unit_price NUMBER (12, 2),
     extended_price NUMBER (12, 2)
+)
+-- dashboards and the aggregate refresh filter on the order date
+CLUSTER BY (order_date_key);
+
+-- daily sales per product category x shipper x status, for BI refresh
+CREATE
+OR
+REPLACE
+TABLE dwh.agg_daily_sales (
+    date_key INT REFERENCES dwh.dim_date (date_key),
+    category_id INT,
+    category_name VARCHAR,
+    shipper_key INT REFERENCES dwh.dim_shipper (shipper_key),
+    status_key INT REFERENCES dwh.dim_order_status (status_key),
+    order_lines INT,
+    quantity INT,
+    extended_price NUMBER (14, 2),
+    updated_at TIMESTAMP
+)
+CLUSTER BY (date_key);
+
+-- ETL control: order dates whose fact rows changed since the last aggregate refresh
+CREATE
+OR
+REPLACE
+TABLE dwh.agg_pending_dates (date_key INT);
+
+-- product reviews
+CREATE
+OR
+REPLACE
+TABLE dwh.fact_review (
+    review_id INT,
+    review_date_key INT REFERENCES dwh.dim_date (date_key),
+    product_key INT REFERENCES dwh.dim_product (product_key),
+    customer_key INT REFERENCES dwh.dim_customer (customer_key),
+    rating INT
+)
+-- rebuilt one review date at a time
+CLUSTER BY (review_date_key);
+
+-- periodic snapshot: stock per product x snapshot date
+CREATE
+OR
+REPLACE
+TABLE dwh.fact_inventory_snapshot (
+    snapshot_date_key INT REFERENCES dwh.dim_date (date_key),
+    product_key INT REFERENCES dwh.dim_product (product_key),
+    quantity_available INT,
+    reorder_level INT,
+    last_updated TIMESTAMP,
+    is_stock_out BOOLEAN,
+    below_reorder BOOLEAN
+)
+CLUSTER BY (snapshot_date_key);
+
+-- ratings per product, kept up to date with fact_review, for BI
+CREATE
+OR
+REPLACE
+TABLE dwh.agg_product_rating (
+    product_id INT,
+    review_count INT,
+    rating_sum INT,
+    rating_1 INT,
+    rating_2 INT,
+    rating_3 INT,
+    rating_4 INT,
+    rating_5 INT,
+    avg_rating NUMBER (4, 2),
+    updated_at TIMESTAMP
+);
+
+-- stock-outs per product over all snapshots, plus the latest snapshot, for BI
+CREATE
+OR
+REPLACE
+TABLE dwh.agg_product_stock (
+    product_id INT,
+    snapshot_days INT,
+    stock_out_days INT,
+    below_reorder_days INT,
+    last_snapshot_date_key INT,
+    quantity_available INT,
+    reorder_level INT,
+    is_stock_out BOOLEAN,
+    updated_at TIMESTAMP
+);
+
+-- ETL control: date partitions of fact_review / fact_inventory_snapshot being rebuilt
+CREATE
+OR
+REPLACE
+TABLE dwh.fact_pending_partitions (fact_name VARCHAR, date_key INT);
+
+-- ETL control: completed stages per batch (content id), so a retried run
+-- resumes where it stopped and a batch loaded twice is a no-op
+CREATE
+OR
+REPLACE
+TABLE dwh.etl_ledger (
+    batch_id VARCHAR,
+    stage VARCHAR,
+    data_dir VARCHAR,
+    finished_at TIMESTAMP,
+    PRIMARY KEY (batch_id, stage)
 );
 
+-- ETL control: high watermark per incremental source, in the columns of its
+-- own id and date (fact_order_item: last_order_*, fact_review: last_review_*).
+-- dropped_orders: orders the fact watermark passed with order lines missing
+CREATE
+OR
+REPLACE
+TABLE dwh.etl_watermark (
+    source_name VARCHAR PRIMARY KEY,
+    last_order_id INT,
+    last_order_date DATE,
+    updated_at TIMESTAMP,
+    last_review_id INT,
+    last_review_date DATE,
+    dropped_orders INT
+);
+
+INSERT INTO dwh.etl_watermark (source_name, last_order_id, last_order_date, updated_at, dropped_orders)
+VALUES ('fact_order_item', 0, NULL, CURRENT_TIMESTAMP, 0);
+
+INSERT INTO dwh.etl_watermark (source_name, last_review_id, last_review_date, updated_at)
+VALUES ('fact_review', 0, NULL, CURRENT_TIMESTAMP);
+
 -- adding data role bug fixing
 USE ROLE ACCOUNTADMIN;
 
@@ -249,22 +437,11 @@ GRANT USAGE ON SCHEMA ecommerce_dwh.raw TO ROLE ACCOUNTADMIN;
 GRANT USAGE ON ALL STAGES IN SCHEMA ecommerce_dwh.raw TO ROLE ACCOUNTADMIN;
 
 -- Populating dim tables
--- dim date
-INSERT INTO dwh.dim_date
-SELECT
-  TO_NUMBER(TO_CHAR(d,'YYYYMMDD')) AS date_key,
-  d                                AS actual_date,
-  TO_CHAR(d,'DY')                  AS day_name,
-  DATE_PART('DAY', d)              AS day_of_month,   -- new!
-  DATE_PART('WEEK', d)             AS week,
-  DATE_PART('MONTH', d)            AS month,
-  DATE_PART('QUARTER', d)          AS quarter,
-  DATE_PART('YEAR', d)             AS year,
-  CASE WHEN DAYOFWEEK(d) IN (1,7) THEN TRUE ELSE FALSE END AS is_weekend
-FROM (
-  SELECT DATEADD(day, seq8(), '2020-01-01'::date) AS d
-  FROM TABLE(GENERATOR(ROWCOUNT => 3653))
-) AS calendar;
+-- dim date: not prefilled; every pipeline run adds the dates its orders need
+-- (pipeline_sql.EXTEND_DIM_DATE). To preload a range in bulk:
+--   python calendar_dim.py --start 2020-01-01 --end 2030-12-31 --out calendar
+-- then load calendar/dim_date_extension.csv into raw.dim_date_extension and
+-- run EXTEND_DIM_DATE.
 
 -- dim product
 MERGE INTO dwh.dim_product AS tgt USING (
@@ -301,7 +478,8 @@ INSERT (
         created_at,
         category_id,
         category_name,
-        category_description
+        category_description,
+        row_hash
     )
 VALUES (
         src.product_id,
@@ -312,7 +490,8 @@ VALUES (
         src.created_at,
         src.category_id,
         src.category_name,
-        src.category_description
+        src.category_description,
+        MD5(CONCAT_WS('|', COALESCE(CAST(src.sku AS VARCHAR), ''), COALESCE(CAST(src.name AS VARCHAR), ''), COALESCE(CAST(src.description AS VARCHAR), ''), COALESCE(CAST(src.base_price AS VARCHAR), ''), COALESCE(CAST(src.category_id AS VARCHAR), ''), COALESCE(CAST(src.category_name AS VARCHAR), ''), COALESCE(CAST(src.category_description AS VARCHAR), '')))
     );
 
 -- dim customer
@@ -354,7 +533,8 @@ INSERT (
         default_city,
         default_state,
         default_country,
-        default_postal_code
+        default_postal_code,
+        row_hash
     )
 VALUES (
         src.customer_id,
@@ -367,7 +547,8 @@ VALUES (
         src.default_city,
         src.default_state,
         src.default_country,
-        src.default_postal_code
+        src.default_postal_code,
+        MD5(CONCAT_WS('|', COALESCE(CAST(src.first_name AS VARCHAR), ''), COALESCE(CAST(src.last_name AS VARCHAR), ''), COALESCE(CAST(src.email AS VARCHAR), ''), COALESCE(CAST(src.phone AS VARCHAR), ''), COALESCE(CAST(src.default_address_id AS VARCHAR), ''), COALESCE(CAST(src.default_city AS VARCHAR), ''), COALESCE(CAST(src.default_state AS VARCHAR), ''), COALESCE(CAST(src.default_country AS VARCHAR), ''), COALESCE(CAST(src.default_postal_code AS VARCHAR), '')))
     );
 
 -- dim shippers
@@ -457,7 +638,120 @@ VALUES (
         src.extended_price
     );
 
+-- move the fact watermark past the initial load, but not past the first order
+-- within 7 days (LATE_ARRIVAL_DAYS) of the newest with a line the dimension
+-- joins dropped; older such orders are counted (pipeline_sql.FACT_WATERMARK_UPDATE)
+UPDATE dwh.etl_watermark
+SET
+    last_order_id = COALESCE(
+        delta.first_held_id - 1,
+        delta.max_loaded_id,
+        0
+    ),
+    last_order_date = delta.max_date,
+    dropped_orders = delta.passed_orders,
+    updated_at = CURRENT_TIMESTAMP
+FROM (
+        SELECT
+            MAX(order_date) AS max_date,
+            MIN(first_held_id) AS first_held_id,
+            MAX(
+                CASE
+                    WHEN loaded THEN order_id
+                END
+            ) AS max_loaded_id,
+            COUNT(
+                CASE
+                    WHEN missing
+                    AND NOT recent
+                    AND (
+                        first_held_id IS NULL
+                        OR order_id < first_held_id
+                    ) THEN 1
+                END
+            ) AS passed_orders
+        FROM (
+                SELECT
+                    *,
+                    MIN(
+                        CASE
+                            WHEN missing
+                            AND recent THEN order_id
+                        END
+                    ) OVER () AS first_held_id
+                FROM (
+                        SELECT
+                            o.order_id,
+                            o.order_date,
+                            COALESCE(f.lines, 0) < l.lines AS missing,
+                            f.lines > 0 AS loaded,
+                            o.order_date >= MAX(o.order_date) OVER () - 7 AS recent
+                        FROM
+                            raw.orders o
+                            LEFT JOIN (
+                                SELECT order_id, COUNT(*) AS lines
+                                FROM raw.order_items
+                                GROUP BY order_id
+                            ) l ON l.order_id = o.order_id
+                            LEFT JOIN (
+                                SELECT order_id, COUNT(*) AS lines
+                                FROM dwh.fact_order_item
+                                GROUP BY order_id
+                            ) f ON f.order_id = o.order_id
+                    ) orders
+            ) held
+    ) delta
+WHERE
+    source_name = 'fact_order_item';
+
+-- daily sales aggregate from the initial fact
+INSERT INTO dwh.agg_daily_sales
+SELECT
+    fi.order_date_key,
+    dp.category_id,
+    MAX(dp.category_name),
+    fi.shipper_key,
+    fi.status_key,
+    COUNT(*),
+    SUM(fi.quantity),
+    SUM(fi.extended_price),
+    CURRENT_TIMESTAMP
+FROM dwh.fact_order_item fi
+    JOIN dwh.dim_product dp ON fi.product_key = dp.product_key
+GROUP BY
+    fi.order_date_key,
+    dp.category_id,
+    fi.shipper_key,
+    fi.status_key;
+
 -- Some Analytical Queries
+-- revenue by day and category, from the aggregate (what dashboards should read)
+SELECT
+    dd.actual_date,
+    a.category_name,
+    SUM(a.extended_price) AS total_revenue
+FROM dwh.agg_daily_sales a
+    JOIN dwh.dim_date dd ON a.date_key = dd.date_key
+GROUP BY
+    1,
+    2
+ORDER BY 1, 3 DESC;
+
+-- best rated products with at least 5 reviews, from the aggregate
+SELECT dp.name AS product_name, r.avg_rating, r.review_count
+FROM dwh.agg_product_rating r
+    JOIN dwh.dim_product dp ON dp.product_id = r.product_id AND dp.is_current
+WHERE r.review_count >= 5
+ORDER BY 2 DESC, 3 DESC
+LIMIT 10;
+
+-- products out of stock now, and how often they ran out
+SELECT dp.name AS product_name, s.stock_out_days, s.snapshot_days
+FROM dwh.agg_product_stock s
+    JOIN dwh.dim_product dp ON dp.product_id = s.product_id AND dp.is_current
+WHERE s.is_stock_out
+ORDER BY 2 DESC;
+
 -- revenue by day (first 60 days)
 SELECT
     dd.actual_date,
@@ -0,0 +1,139 @@
+"""Split each table's files into size-targeted parts before they are staged.
+
+COPY loads files in parallel but every file on one thread, so a table staged
+as one large file loads no faster on a bigger warehouse. split_table rewrites
+a table's files as ``{table}-00000.<fmt>``, ``{table}-00001.<fmt>``, ... of
+about ``target_bytes`` each once compressed, cutting on row boundaries only:
+
+    python splitter.py --in Data/Batch1/clean --out Data/Batch1/split --target-mb 150
+
+CSV is streamed in blocks and cut at the first newline past the target that
+is outside a quoted field; each part repeats the header. The target is scaled
+by the compression ratio of the table's first block, since PUT gzips the parts.
+Parquet is re-batched with pyarrow, sized from the source's bytes per row.
+The same input always gives the same parts, so unchanged parts keep their
+content address in the staging cache.
+"""
+import argparse
+import os
+import zlib
+
+from manifest import table_files
+from staging import GZIP_LEVEL
+
+TARGET_MB = 150
+BLOCK_SIZE = 1 << 22
+
+
+def compression_ratio(path, sample_bytes=BLOCK_SIZE):
+    with open(path, "rb") as f:
+        sample = f.read(sample_bytes)
+    return len(zlib.compress(sample, GZIP_LEVEL)) / len(sample) if sample else 1.0
+
+
+class Parts:
+    """Numbered part files of a table in ``out_dir``."""
+
+    def __init__(self, out_dir, table, fmt):
+        self.out_dir, self.table, self.fmt = out_dir, table, fmt
+        self.paths = []
+
+    def next_path(self):
+        self.paths.append(os.path.join(self.out_dir, f"{self.table}-{len(self.paths):05d}.{self.fmt}"))
+        return self.paths[-1]
+
+
+def split_csv(files, parts, raw_target):
+    out, size, header = None, 0, None
+    for path in files:
+        with open(path, "rb") as f:
+            header = f.readline()
+            # Quotes seen since the last row boundary: a newline ends a row only when even
+            quotes, last = 0, b"\n"
+            for block in iter(lambda: f.read(BLOCK_SIZE), b""):
+                start = 0
+                while start < len(block):
+                    if out is None:
+                        out, size = open(parts.next_path(), "wb"), len(header)
+                        out.write(header)
+                    cut = block.find(b"\n", start + max(raw_target - size, 0))
+                    while cut != -1 and (quotes + block.count(b'"', start, cut)) % 2:
+                        cut = block.find(b"\n", cut + 1)
+                    end = len(block) if cut == -1 else cut + 1
+                    out.write(block[start:end])
+                    size += end - start
+                    quotes = (quotes + block.count(b'"', start, end)) % 2
+                    if cut != -1:
+                        out.close()
+                        out = None
+                    start = end
+                last = block[-1:]
+            # A source file without a final newline must not run into the next one
+            if out is not None and last != b"\n":
+                out.write(b"\n")
+    if out is None and header is not None and not parts.paths:
+        # Header-only input still gives the table a file
+        with open(parts.next_path(), "wb") as out:
+            out.write(header)
+    elif out is not None:
+        out.close()
+
+
+def split_parquet(files, parts, target):
+    import pyarrow.parquet as pq
+
+    writer, rows, row_bytes = None, 0, 0
+    for path in files:
+        source = pq.ParquetFile(path)
+        row_bytes = os.path.getsize(path) / max(source.metadata.num_rows, 1)
+        part_rows = max(int(target / row_bytes), 1)
+        for batch in source.iter_batches(batch_size=min(part_rows, 1 << 16)):
+            if writer is None:
+                writer, rows = pq.ParquetWriter(parts.next_path(), batch.schema,
+                                                compression="snappy"), 0
+            writer.write_batch(batch)
+            rows += batch.num_rows
+            if rows >= part_rows:
+                writer.close()
+                writer = None
+        if not parts.paths:
+            pq.write_table(source.schema_arrow.empty_table(), parts.next_path(), compression="snappy")
+    if writer is not None:
+        writer.close()
+
+
+def split_table(data_dir, out_dir, table, fmt="csv", target_bytes=TARGET_MB << 20):
+    """Rewrites the table's files in ``data_dir`` as parts in ``out_dir``; their paths.
+
+    Earlier parts of the table in ``out_dir`` are removed first. A table
+    without files in ``data_dir`` gets no parts.
+    """
+    if os.path.abspath(data_dir) == os.path.abspath(out_dir):
+        raise ValueError(f"{table}: split into a directory of its own, not {data_dir}")
+    os.makedirs(out_dir, exist_ok=True)
+    for path in table_files(out_dir, table, fmt):
+        os.remove(path)
+    files = table_files(data_dir, table, fmt)
+    parts = Parts(out_dir, table, fmt)
+    if files and fmt == "parquet":
+        split_parquet(files, parts, target_bytes)
+    elif files:
+        split_csv(files, parts, int(target_bytes / compression_ratio(files[0])))
+    return parts.paths
+
+
+if __name__ == "__main__":
+    from pipeline_sql import RAW_TABLES
+
+    parser = argparse.ArgumentParser(description="Split table files into size-targeted parts.")
+    parser.add_argument("tables", nargs="*", help="tables to split (default: every raw table)")
+    parser.add_argument("--in", dest="data_dir", required=True)
+    parser.add_argument("--out", required=True)
+    parser.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    parser.add_argument("--target-mb", type=float, default=TARGET_MB,
+                        help="compressed size of a part")
+    args = parser.parse_args()
+    for table in args.tables or RAW_TABLES:
+        paths = split_table(args.data_dir, args.out, table, args.format, int(args.target_mb * (1 << 20)))
+        if paths:
+            print(f"{table}: {len(paths)} parts")
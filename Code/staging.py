@@ -0,0 +1,115 @@
+"""Content-addressed staging: each distinct file is uploaded once.
+
+A file is staged as ``{STAGE_PREFIX}/{table}/{sha256}.<fmt>.gz``, gzip-compressed
+on the way (Parquet is compressed already and goes as it is). A JSON manifest
+per table remembers the digest of every local file, keyed by size and mtime so
+unchanged files are not read again, and which objects the stage holds. A file
+whose content is already staged is not uploaded; COPY names the exact objects
+(copy_sql(..., files=...)), so old objects left on the stage are never loaded.
+
+LocalStage is a directory standing in for the Snowflake stage, used by the
+DuckDB backend (local_run.py --stage-dir).
+"""
+import gzip
+import os
+import shutil
+import tempfile
+from abc import ABC, abstractmethod
+
+from manifest import file_digest, read_manifest, write_manifest
+from pipeline_sql import STAGE_PREFIX
+
+GZIP_LEVEL = 6
+
+
+class Stage(ABC):
+    @abstractmethod
+    def put(self, local_path, table):
+        """Upload ``local_path`` under the table's prefix, keeping its file name."""
+
+    @abstractmethod
+    def list(self, table):
+        """File names staged under the table's prefix."""
+
+
+class LocalStage(Stage):
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, table, name=""):
+        return os.path.join(self.root, STAGE_PREFIX, table, name)
+
+    def put(self, local_path, table):
+        os.makedirs(self.path(table), exist_ok=True)
+        shutil.copyfile(local_path, self.path(table, os.path.basename(local_path)))
+
+    def list(self, table):
+        return os.listdir(self.path(table)) if os.path.isdir(self.path(table)) else []
+
+
+class SnowflakeStage(Stage):
+    """The user stage (or ``stage``), through a SnowflakeBackend."""
+
+    def __init__(self, backend, stage="@~"):
+        self.backend = backend
+        self.stage = stage
+
+    def put(self, local_path, table):
+        self.backend.run(f"PUT file://{local_path} {self.stage}/{STAGE_PREFIX}/{table}/ "
+                         f"AUTO_COMPRESS = FALSE OVERWRITE = TRUE;")
+
+    def list(self, table):
+        rows = self.backend.query(f"LIST {self.stage}/{STAGE_PREFIX}/{table}/")
+        return [row[0].rsplit("/", 1)[-1] for row in rows]
+
+
+class StagingCache:
+    def __init__(self, stage, cache_dir):
+        self.stage = stage
+        self.cache_dir = cache_dir
+
+    def manifest_path(self, table):
+        # One file per table: the DAG stages tables in parallel
+        return os.path.join(self.cache_dir, f"{table}.json")
+
+    def digest(self, manifest, path):
+        st = os.stat(path)
+        key = os.path.abspath(path)
+        known = manifest["files"].get(key)
+        if known and known[:2] == [st.st_size, st.st_mtime_ns]:
+            return known[2]
+        digest = file_digest(path)
+        manifest["files"][key] = [st.st_size, st.st_mtime_ns, digest]
+        return digest
+
+    def stage_files(self, table, files):
+        """Stage ``files`` of ``table``; their staged names, in the same order."""
+        os.makedirs(self.cache_dir, exist_ok=True)
+        manifest = {"files": {}, "staged": {}, **read_manifest(self.manifest_path(table))}
+        # Objects removed from the stage since (PURGE, REMOVE) are uploaded again
+        present = set(self.stage.list(table))
+        manifest["staged"] = {n: b for n, b in manifest["staged"].items() if n in present}
+
+        names, uploaded, skipped = [], 0, 0
+        with tempfile.TemporaryDirectory() as tmp:
+            for path in files:
+                ext = path.rsplit(".", 1)[-1]
+                name = f"{self.digest(manifest, path)}.{ext}" + ("" if ext == "parquet" else ".gz")
+                names.append(name)
+                if name in manifest["staged"]:
+                    skipped += os.path.getsize(path)
+                    continue
+                upload = os.path.join(tmp, name)
+                if ext == "parquet":
+                    shutil.copyfile(path, upload)
+                else:
+                    with open(path, "rb") as src, gzip.open(upload, "wb", GZIP_LEVEL) as dst:
+                        shutil.copyfileobj(src, dst, 1 << 20)
+                self.stage.put(upload, table)
+                manifest["staged"][name] = os.path.getsize(upload)
+                uploaded += manifest["staged"][name]
+                os.remove(upload)
+        write_manifest(self.manifest_path(table), manifest)
+        print(f"{table}: {len(files)} files, uploaded {uploaded} bytes, "
+              f"{skipped} bytes already staged")
+        return names
@@ -0,0 +1,167 @@
+"""Convert data_unclean_gen.py output into the raw.* layout, so it can be loaded.
+
+Only names and shapes are changed. Dirty values are passed through untouched,
+for cleanse.py to coerce or quarantine:
+
+    python data_unclean_gen.py --rows 1000000 --out unclean
+    python unclean_mapping.py --in unclean --out mapped
+    python cleanse.py --in mapped --out clean
+"""
+import argparse
+import os
+
+import pandas as pd
+
+from manifest import table_files
+from raw_schema import columns
+from writers import WRITERS, make_writer
+
+CHUNK_ROWS = 200_000
+
+# raw.* table -> the unclean table its rows come from, and a spec per raw column:
+#   "Col"                      copy the source column
+#   None                       no source, left NULL
+#   {"const": v}               the same value on every row
+#   {"map": "Col", "values": {...}}
+#                              recode; unknown values pass through, for cleanse.py to reject
+#   {"lookup": "Col", "table": t, "key": k, "value": v}
+#                              column v of the first row of unclean table t whose k matches
+UNCLEAN_TO_RAW = {
+    "customers": {"from": "customers", "columns": {
+        "customer_id": "Customer_id", "first_name": "FirstName", "last_name": "LastName",
+        "email": "Email", "phone": "Phone", "date_joined": None}},
+    "categories": {"from": "categories", "columns": {
+        "category_id": "Category_id", "name": "Category_name", "description": "Description"}},
+    "products": {"from": "products", "columns": {
+        "product_id": "Product_id", "name": "Product_name", "description": "Brand",
+        "sku": None, "base_price": "MRP", "created_at": None}},
+    "product_categories": {"from": "products", "columns": {
+        "product_id": "Product_id", "category_id": "Category_CategoryID"}},
+    "addresses": {"from": "addresses", "columns": {
+        "address_id": "Address_id", "customer_id": "Customer_Customer_id",
+        "line1": "StreetName", "line2": "ApartName", "city": "City", "state": "State",
+        "postal_code": "Pincode", "country": None, "is_default": {"const": True}}},
+    # Couriers are per delivery, so each delivery becomes its own shipper row
+    "shippers": {"from": "deliveries", "columns": {
+        "shipper_id": "Delivery_id", "name": "Courier", "phone": None,
+        "tracking_url_template": None}},
+    "orders": {"from": "orders", "columns": {
+        "order_id": "Order_id",
+        "customer_id": "Customer_customer_id",
+        "order_status_id": {"map": "Order_status", "values": {
+            "Pending": 1, "Processing": 2, "Shipped": 3, "Delivered": 4, "Cancelled": 5}},
+        "ship_address_id": {"lookup": "Customer_customer_id", "table": "addresses",
+                            "key": "Customer_Customer_id", "value": "Address_id"},
+        "shipper_id": {"lookup": "Order_id", "table": "deliveries",
+                       "key": "Order_id", "value": "Delivery_id"},
+        "order_date": "Order_date",
+        "total_amount": "Order_amount"}},
+    "order_items": {"from": "order_items", "columns": {
+        "order_id": "Order_Order_id", "product_id": "Product_product_id",
+        "quantity": "Quantity", "unit_price": "MRP"}},
+    "reviews": {"from": "reviews", "columns": {
+        "review_id": "Review_id", "product_id": "Product_Product_id",
+        "customer_id": "Customer_Customer_id", "rating": "Rating",
+        "review_text": "Description", "review_date": None}},
+    "payments": {"from": "payments", "columns": {
+        "payment_id": "Payment_id", "order_id": "ORDER_Order_id",
+        "payment_method": "PaymentMode", "payment_date": "DateOfPayment",
+        "amount": {"lookup": "ORDER_Order_id", "table": "orders",
+                   "key": "Order_id", "value": "Order_amount"},
+        "status": {"const": "Captured"}}},
+}
+
+# raw.* tables the unclean generator has nothing for, given as fixed rows
+FIXED_ROWS = {
+    "order_statuses": [(1, "Pending", None), (2, "Processing", None), (3, "Shipped", None),
+                       (4, "Delivered", None), (5, "Cancelled", None)],
+}
+
+# Unclean tables with no raw.* counterpart (deliveries only feed shippers and lookups)
+UNMAPPED = ["sellers", "wishlists"]
+
+
+def read_source(in_dir, table, fmt, chunk_rows, usecols=None):
+    """String chunks of an unclean table, by column name."""
+    for path in table_files(in_dir, table, fmt):
+        if fmt == "parquet":
+            import pyarrow.parquet as pq
+            for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_rows, columns=usecols):
+                yield batch.to_pandas()
+        else:
+            yield from pd.read_csv(path, dtype=str, keep_default_na=False, usecols=usecols,
+                                   chunksize=chunk_rows)
+
+
+def numeric_key(s):
+    # Ids come back as "635", "635.0" or junk; match them by value
+    return pd.to_numeric(s, errors="coerce")
+
+
+class Mapper:
+    """Streams unclean tables into raw.* files, one chunk at a time.
+
+    Lookup tables are read once, two columns at a time, and kept as hash indexes.
+    """
+
+    def __init__(self, in_dir, fmt="csv", chunk_rows=CHUNK_ROWS):
+        self.in_dir = in_dir
+        self.fmt = fmt
+        self.chunk_rows = chunk_rows
+        self.lookups = {}
+
+    def lookup(self, table, key, value):
+        if (table, key, value) not in self.lookups:
+            parts = [pd.Series(chunk[value].values, index=numeric_key(chunk[key]).values)
+                     for chunk in read_source(self.in_dir, table, self.fmt, self.chunk_rows,
+                                              [key, value])]
+            s = pd.concat(parts) if parts else pd.Series(dtype=object)
+            s = s[s.index.notna()]
+            self.lookups[(table, key, value)] = s[~s.index.duplicated()]
+        return self.lookups[(table, key, value)]
+
+    def column(self, chunk, spec):
+        if spec is None:
+            return pd.Series(None, index=chunk.index, dtype=object)
+        if isinstance(spec, str):
+            return chunk[spec]
+        if "const" in spec:
+            return pd.Series(spec["const"], index=chunk.index)
+        if "map" in spec:
+            return chunk[spec["map"]].astype(object).replace(spec["values"])
+        found = self.lookup(spec["table"], spec["key"], spec["value"])
+        return pd.Series(numeric_key(chunk[spec["lookup"]]).map(found).values, index=chunk.index)
+
+    def chunks(self, table):
+        """raw.<table> chunks, columns in raw.* order."""
+        if table in FIXED_ROWS:
+            yield pd.DataFrame(FIXED_ROWS[table], columns=columns(table))
+            return
+        mapping = UNCLEAN_TO_RAW[table]
+        for chunk in read_source(self.in_dir, mapping["from"], self.fmt, self.chunk_rows):
+            yield pd.DataFrame({name: self.column(chunk, mapping["columns"][name])
+                                for name in columns(table)})
+
+
+def map_unclean(in_dir, out_dir, fmt="csv", chunk_rows=CHUNK_ROWS):
+    if os.path.realpath(in_dir) == os.path.realpath(out_dir):
+        # Several unclean tables share their name with a raw table
+        raise ValueError("--in and --out must be different directories")
+    mapper = Mapper(in_dir, fmt, chunk_rows)
+    tables = [t for t in list(UNCLEAN_TO_RAW) + list(FIXED_ROWS)
+              if t in FIXED_ROWS or table_files(in_dir, UNCLEAN_TO_RAW[t]["from"], fmt)]
+    # Values stay as found, so files are written untyped
+    with make_writer(fmt, out_dir, typed=False) as out:
+        for table in tables:
+            for chunk in mapper.chunks(table):
+                out.write(table, chunk)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Map data_unclean_gen.py output to the raw.* layout.")
+    parser.add_argument("--in", dest="in_dir", required=True, help="data_unclean_gen.py output")
+    parser.add_argument("--out", required=True, help="directory for the raw.* files")
+    parser.add_argument("--chunk-rows", type=int, default=CHUNK_ROWS)
+    parser.add_argument("--format", choices=sorted(WRITERS), default="csv")
+    args = parser.parse_args()
+    map_unclean(args.in_dir, args.out, args.format, args.chunk_rows)
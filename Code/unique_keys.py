@@ -0,0 +1,117 @@
+"""Unique generated values (SKUs, emails) by construction, not by retrying.
+
+A value is the row id pushed through a seeded bijection of a fixed code space
+and written out in a fixed-width alphabet, so two ids never share a value and
+nothing has to remember what was issued. Every function is vectorized over a
+NumPy array of ids and depends only on (seed, id), so shards and workers
+produce the same values for the same ids in any order.
+"""
+import string
+import zlib
+
+import numpy as np
+
+LETTERS = string.ascii_lowercase + string.ascii_uppercase
+DIGITS = string.digits
+BASE36 = string.digits + string.ascii_lowercase
+# SKUs keep the ??##### shape; letters are added once 52**2 * 10**5 codes run out
+SKU_LETTERS, SKU_DIGITS = 2, 5
+# Email tokens are at least this many base-36 characters
+EMAIL_TOKEN_WIDTH = 6
+
+
+def mix64(x):
+    # splitmix64 finalizer: a cheap, well-distributed hash of uint64 values
+    x = np.asarray(x, dtype=np.uint64)
+    with np.errstate(over="ignore"):
+        x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return x ^ (x >> np.uint64(31))
+
+
+class FeistelPermutation:
+    """Seeded bijection of [0, n), without materialising it.
+
+    A Feistel network (unbalanced when the width is odd) permutes the smallest
+    power-of-two range covering n; values that land at or above n are encrypted
+    again (cycle walking) until they fall inside, which keeps the map a bijection
+    of [0, n). The range is under 2n, so that takes two passes on average.
+    """
+
+    def __init__(self, n, seed, name="", rounds=4):
+        if not 0 < n <= 2**62:
+            raise ValueError(f"permutation size out of range: {n}")
+        self.n = n
+        self.bits = max((n - 1).bit_length(), 2)
+        rng = np.random.default_rng([seed, zlib.crc32(name.encode())])
+        self.keys = [np.uint64(k) for k in rng.integers(0, 2**63, rounds)]
+
+    def encrypt(self, x):
+        # Each round moves the right part left and hashes it into the left part,
+        # so the two parts swap widths every round
+        left_bits, right_bits = self.bits - self.bits // 2, self.bits // 2
+        left, right = x >> np.uint64(right_bits), x & np.uint64((1 << right_bits) - 1)
+        for key in self.keys:
+            left, right = right, left ^ (mix64(right ^ key) & np.uint64((1 << left_bits) - 1))
+            left_bits, right_bits = right_bits, left_bits
+        return (left << np.uint64(right_bits)) | right
+
+    def __call__(self, x):
+        x = np.asarray(x, dtype=np.uint64)
+        if x.size and int(x.max()) >= self.n:
+            raise ValueError(f"value outside the permuted range [0, {self.n})")
+        out = self.encrypt(x)
+        outside = out >= np.uint64(self.n)
+        while outside.any():
+            out[outside] = self.encrypt(out[outside])
+            outside = out >= np.uint64(self.n)
+        return out
+
+
+def encode(values, alphabets):
+    """Mixed-radix strings: character i of each value from ``alphabets[i]``."""
+    values = np.asarray(values, dtype=np.uint64).copy()
+    chars = np.empty((len(values), len(alphabets)), dtype=np.uint8)
+    for i in range(len(alphabets) - 1, -1, -1):
+        table = np.frombuffer(alphabets[i].encode("ascii"), dtype=np.uint8)
+        radix = np.uint64(len(table))
+        chars[:, i] = table[values % radix]
+        values //= radix
+    return chars.view(f"S{len(alphabets)}").ravel().astype(str)
+
+
+def capacity(alphabets):
+    size = 1
+    for alphabet in alphabets:
+        size *= len(alphabet)
+    return size
+
+
+def widen(alphabet, min_width, n, fixed=()):
+    """``alphabet`` repeated (at least ``min_width`` times) until, with ``fixed``, n values fit."""
+    width = min_width
+    while capacity([alphabet] * width + list(fixed)) < n:
+        width += 1
+    return [alphabet] * width + list(fixed)
+
+
+class UniqueCodes:
+    """Distinct codes for ids 1..n, spread over the whole code space."""
+
+    def __init__(self, alphabets, seed, name):
+        self.alphabets = alphabets
+        self.permutation = FeistelPermutation(capacity(alphabets), seed, name)
+
+    def __call__(self, ids):
+        return encode(self.permutation(np.asarray(ids, dtype=np.uint64) - np.uint64(1)),
+                      self.alphabets)
+
+
+def sku_codes(n, seed):
+    """SKUs like 'qZ04817' for product ids 1..n."""
+    return UniqueCodes(widen(LETTERS, SKU_LETTERS, n, [DIGITS] * SKU_DIGITS), seed, "sku")
+
+
+def email_tokens(n, seed):
+    """Fixed-width base-36 tokens for customer ids 1..n, to end an email's local part."""
+    return UniqueCodes(widen(BASE36, EMAIL_TOKEN_WIDTH, n), seed, "email")
@@ -0,0 +1,146 @@
+import os
+import time
+
+from metrics import record
+
+
+class CsvWriter:
+    """Appends DataFrame chunks to one ``{table}.csv`` per table.
+
+    The first chunk of a table truncates the file and writes the header, every
+    later chunk is appended, so memory is bounded by the chunk size. With
+    ``part`` set, files are named ``{table}-{part:05d}.csv`` instead. On close
+    every table's rows and the time spent producing and writing them (since the
+    previous write) are printed and recorded as a ``{metric}_{table}`` metric,
+    unless ``report`` is False (a part whose caller sums its counts).
+    """
+    extension = "csv"
+
+    def __init__(self, out_dir=".", part=None, typed=True, metric="write", report=True):
+        self.out_dir = out_dir
+        self.part = part
+        self.typed = typed
+        self.metric = metric
+        self.report = report
+        self.rows = {}
+        self.seconds = {}
+        self._mark = time.perf_counter()
+        os.makedirs(out_dir, exist_ok=True)
+
+    def path(self, table):
+        suffix = "" if self.part is None else f"-{self.part:05d}"
+        return os.path.join(self.out_dir, f"{table}{suffix}.{self.extension}")
+
+    def write(self, table, df):
+        first = table not in self.rows
+        df.to_csv(self.path(table), mode="w" if first else "a", header=first, index=False)
+        self.count(table, len(df))
+
+    def count(self, table, rows):
+        now = time.perf_counter()
+        self.rows[table] = self.rows.get(table, 0) + rows
+        self.seconds[table] = self.seconds.get(table, 0) + now - self._mark
+        self._mark = now
+
+    def close(self):
+        if not self.report:
+            return
+        for table, n in self.rows.items():
+            print(f"{table}: {n} rows")
+            record(f"{self.metric}_{table}", self.seconds[table], rows=n)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def chunks(n, size, start=1):
+    # [start, stop) id ranges covering n ids
+    for lo in range(start, start + n, size):
+        yield lo, min(lo + size, start + n)
+
+
+class ParquetWriter(CsvWriter):
+    """Typed, compressed Parquet: one row group per chunk.
+
+    Tables in raw_schema are cast to the raw.* column names and types, so the
+    warehouse loads them without re-parsing. Other tables, or every table when
+    ``typed`` is False, are written with string columns.
+    """
+    extension = "parquet"
+    compression = "snappy"
+
+    def __init__(self, out_dir=".", part=None, typed=True, report=True):
+        super().__init__(out_dir, part, typed, report=report)
+        self._files = {}
+
+    def write(self, table, df):
+        batch = to_arrow(table, df) if self.typed else to_arrow_strings(df)
+        if table not in self._files:
+            import pyarrow.parquet as pq
+            self._files[table] = pq.ParquetWriter(self.path(table), batch.schema,
+                                                  compression=self.compression)
+        self._files[table].write_table(batch)
+        self.count(table, len(df))
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        super().close()
+
+
+WRITERS = {"csv": CsvWriter, "parquet": ParquetWriter}
+
+
+def make_writer(fmt, out_dir=".", part=None, typed=True, report=True):
+    return WRITERS[fmt](out_dir, part, typed, report=report)
+
+
+def arrow_type(sql_type):
+    import pyarrow as pa
+    if sql_type == "INT":
+        return pa.int64()
+    if sql_type.startswith("NUMBER"):
+        precision, scale = sql_type[sql_type.index("(") + 1:-1].split(",")
+        return pa.decimal128(int(precision), int(scale))
+    return {
+        "DATE": pa.date32(),
+        "TIMESTAMP": pa.timestamp("us"),
+        "BOOLEAN": pa.bool_(),
+    }.get(sql_type, pa.string())
+
+
+def to_arrow(table, df):
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    from raw_schema import RAW_SCHEMA
+
+    if table not in RAW_SCHEMA:
+        return to_arrow_strings(df)
+
+    schema = RAW_SCHEMA[table]
+    if len(schema) != len(df.columns):
+        raise ValueError(f"{table}: expected {len(schema)} columns, got {len(df.columns)}")
+    arrays = {}
+    # Positional, like COPY: the file's own header names do not matter
+    for (name, sql_type), col in zip(schema, df.columns):
+        s, typ = df[col], arrow_type(sql_type)
+        if pa.types.is_decimal(typ):
+            arr = pc.round(pa.array(pd.to_numeric(s), type=pa.float64()), typ.scale).cast(typ, safe=False)
+        elif pa.types.is_date(typ) or pa.types.is_timestamp(typ):
+            arr = pa.array(pd.to_datetime(s)).cast(pa.timestamp("us")).cast(typ, safe=False)
+        elif pa.types.is_string(typ):
+            arr = pa.array(s.astype("string"), type=typ)
+        else:
+            arr = pa.array(s, type=typ, from_pandas=True)
+        arrays[name] = arr
+    return pa.table(arrays)
+
+
+def to_arrow_strings(df):
+    import pyarrow as pa
+    return pa.table({c: pa.array(df[c].astype("string"), type=pa.string()) for c in df.columns})